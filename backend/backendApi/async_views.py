@@ -0,0 +1,82 @@
+import asyncio
+import logging
+from bson import ObjectId
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET
+from typing import TYPE_CHECKING
+
+from .serializers import SecSearchSerializer, SecBatchSearchSerializer
+from .methods.get_sec_urls import aget_sec_urls, aget_sec_urls_batch, SECDataError
+from .methods.updateT212 import updateT212, t212_sync_jobs
+
+from classes.portfolio import Portfolio
+from mylibs.jobQueue import job_status, job_http_status
+from master.mongoDB import mongo_client, get_async_mongo_client
+
+if TYPE_CHECKING:
+    from django.http import HttpRequest
+
+
+logger = logging.getLogger('myapp')
+
+# Async versions of the api views, to be served under ASGI (master/asgi.py).
+# Mongo and SEC calls are awaited on the event loop; the valuation, which relies on the
+# blocking FX store, runs in a worker thread and the T212 sync on the sync job queue.
+
+@require_GET
+async def get_sec_files(request: 'HttpRequest'):
+    serializer = SecSearchSerializer(data=request.GET)
+    if serializer.is_valid():
+        data = serializer.validated_data
+        try:
+            result = await aget_sec_urls(**data)
+            return JsonResponse(result, status=200)
+        except SECDataError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        except Exception as e:
+            logger.error(e)
+            return JsonResponse({'error': 'An unexpected error occurred.'}, status=500)
+    return JsonResponse(serializer.errors, status=400)
+
+@require_GET
+async def get_sec_files_batch(request: 'HttpRequest'):
+    serializer = SecBatchSearchSerializer(data=request.GET)
+    if serializer.is_valid():
+        data = dict(serializer.validated_data)
+        try:
+            result = await aget_sec_urls_batch(data.pop('tickers'), **data)
+            return JsonResponse(result, status=200)
+        except Exception as e:
+            logger.error(e)
+            return JsonResponse({'error': 'An unexpected error occurred.'}, status=500)
+    return JsonResponse(serializer.errors, status=400)
+
+@require_GET
+async def update_t212(request: 'HttpRequest'):
+    '''Not natively async: the blocking job submission runs in a worker thread (asyncio.to_thread)'''
+    client_id = request.COOKIES['client_id']
+    logger.info(f'Async update_t212 request from {client_id}')
+    job_id, created = await asyncio.to_thread(t212_sync_jobs.submit, client_id, updateT212, client_id)
+    return JsonResponse({'job_id': str(job_id), 'created': created}, status=202)
+
+@require_GET
+async def update_t212_status(request: 'HttpRequest', job_id: str):
+    client_id = request.COOKIES['client_id']
+    job = None
+    if ObjectId.is_valid(job_id):
+        job = await get_async_mongo_client().jobs.jobs.find_one({'_id': ObjectId(job_id), 'kind': t212_sync_jobs.kind, 'user_id': ObjectId(client_id)})
+    if not job:
+        return JsonResponse({'error': 'Job not found'}, status=404)
+    return JsonResponse(job_status(job), status=job_http_status(job))
+
+@require_GET
+async def stock_history(request: 'HttpRequest'):
+    '''Only the user and portfolio reads are awaited: the blocking history computation runs in a worker thread (asyncio.to_thread)'''
+    client_id = request.COOKIES['client_id']
+    user = await get_async_mongo_client().users.users.find_one({'_id': ObjectId(client_id)}, {'ptf_ids': 1})
+    if not user or not user.get('ptf_ids'):
+        return JsonResponse({'error': 'No portfolio found'}, status=404)
+    ptf = Portfolio(mongo_client, user['ptf_ids'][0])
+    ptf.hydrate(await get_async_mongo_client().investments.portfolios.find_one({'_id': ptf._id}, {'stocks.orders': 0, 'bonds.orders': 0}))
+    result = await asyncio.to_thread(ptf.stock_history, server_side=True)
+    return JsonResponse(result, status=200)
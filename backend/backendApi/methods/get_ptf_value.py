@@ -0,0 +1,189 @@
+import logging
+from functools import lru_cache
+from datetime import datetime, timedelta, date
+from typing import Dict, List, Optional, Union
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from pymongo import UpdateOne
+
+from classes.portfolio import Portfolio
+from classes.snapshots import SnapshotStore
+from mylibs.exchangeRate import ExchangeRate
+from mylibs.priceStore import PriceStore
+from mylibs.priceSource import yahoo_closes, yahoo_symbol
+
+
+logger = logging.getLogger('myapp')
+# closes are forward filled over weekends and holidays, up to PRICE_LOOKBACK_DAYS before the first day valued
+LOOKBACK = timedelta(days=getattr(settings, 'PRICE_LOOKBACK_DAYS', 10))
+_indexed = set() # ids of the mongo clients whose valuations collection is indexed
+
+
+@lru_cache(maxsize=None)
+def get_price_store() -> PriceStore:
+    '''Default price store of the process, created on first use in PRICE_STORE_DIR (data/prices by default)'''
+    return PriceStore(getattr(settings, 'PRICE_STORE_DIR', settings.BASE_DIR / 'data' / 'prices'), source=yahoo_closes)
+
+
+def get_ptf_value(ptf: Portfolio, currency: str = 'EUR', date_from: Optional[Union[str, date]] = None,
+                  date_to: Optional[Union[str, date]] = None, store: Optional[PriceStore] = None) -> dict:
+    '''
+    Daily market value of the portfolio stocks in `currency`: {YYYY-MM-DD: value}.
+
+    Values are materialized in `investments.valuations`, and the state of each currency (`valuations` array of the portfolio:
+    first_day, computed_to, dirty_from, price_marks) tells which days are stale. Only the days from the first stale one are recomputed:
+    after `computed_to`, after an order change (dirty_from, set by PortfolioWriter) or after the last price used for a security.
+    The daily closes of the stocks are refreshed from the store source (Yahoo Finance) first; the last order price is only the
+    fallback of the securities or days without a close.
+
+    Positions start from the nearest month-end snapshot before the stale days (SnapshotStore), so an update only reads the
+    orders since that snapshot. Only the security headers of the portfolio are needed (lazy load).
+    '''
+    store = store if store is not None else get_price_store()
+    end = _to_day(date_to) if date_to else pd.Timestamp.now().normalize()
+    portfolios = ptf._mongo_client.investments.portfolios
+    doc = portfolios.find_one({'_id': ptf._id}, {'valuations': 1}) or {}
+    state = next((v for v in doc.get('valuations') or () if v['currency'] == currency), None)
+    symbols = {stock.isin: yahoo_symbol(stock.t212_id) for stock in ptf.stocks}
+    if state is not None:
+        # closes published since the last call are appended first, so they mark the days valued without them as stale
+        store.refresh(symbols, _first_day(state).date(), end.date())
+
+    start = _stale_from(state, list(symbols), store)
+    if start is None or start <= end:
+        snapshot_day, opening, orders = SnapshotStore(ptf._mongo_client).window(
+            ptf, start.to_pydatetime() if start is not None else None, end.to_pydatetime())
+        orders['day'] = pd.to_datetime(orders['date']).dt.normalize()
+        if start is None: # first valuation in this currency
+            if orders.empty:
+                return {}
+            start = orders['day'].min()
+            store.refresh(symbols, start.date(), end.date())
+        elif snapshot_day is None and not orders.empty:
+            start = max(start, orders['day'].min()) # no value before the first order
+        if start <= end:
+            values, marks = _compute(opening, orders, start, end, currency, store)
+            _save(ptf, currency, values, marks, start, end, state)
+
+    query = {'ptf_id': ptf._id, 'currency': currency, 'day': {'$lte': end.to_pydatetime()}}
+    if date_from:
+        query['day']['$gte'] = _to_day(date_from).to_pydatetime()
+    stored = ptf._mongo_client.investments.valuations.find(query, {'_id': 0, 'day': 1, 'value': 1}).sort('day', 1)
+    return {doc['day'].strftime('%Y-%m-%d'): doc['value'] for doc in stored}
+
+
+def _first_day(state: dict) -> pd.Timestamp:
+    return pd.Timestamp(state.get('first_day') or state['computed_to'])
+
+
+def _stale_from(state: Optional[dict], isins: List[str], store: PriceStore) -> Optional[pd.Timestamp]:
+    '''First day to recompute, None when nothing was computed yet'''
+    if state is None:
+        return None
+    start = pd.Timestamp(state['computed_to']) + timedelta(days=1)
+    if state.get('dirty_from'):
+        start = min(start, pd.Timestamp(state['dirty_from']).normalize())
+    marks = state.get('price_marks') or {}
+    for isin in isins:
+        last = store.last_date(isin)
+        mark = marks.get(isin)
+        if last is None or (mark and pd.Timestamp(last) <= pd.Timestamp(mark)):
+            continue
+        # days after the last price used were valued at a forward filled (or order) price
+        stale = pd.Timestamp(mark) + timedelta(days=1) if mark else store.read(isin).index[0]
+        start = min(start, stale)
+    return max(start, _first_day(state))
+
+
+def _compute(opening: Dict[str, dict], orders: pd.DataFrame, start: pd.Timestamp, end: pd.Timestamp, currency: str, store: PriceStore):
+    '''
+    Values of the days `start`..`end`: positions from the snapshot `opening` positions and a cumulative quantity sweep of the
+    orders after it, times the closes forward filled on every day, divided by the exchange rate of the quote currency,
+    summed per day in one vectorized pass.
+    '''
+    days = pd.date_range(start, end, freq='D')
+    orders = orders[orders['day'] <= end]
+    snapshot = pd.DataFrame.from_records(list(opening.values()), columns=['isin', 'quantity', 'cost', 'currency']).set_index('isin')
+    before = orders[orders['day'] < start].groupby('isin')['quantity'].sum()
+    opening_quantities = snapshot['quantity'].astype(float).add(before, fill_value=0)
+    flows = orders[orders['day'] >= start].pivot_table(index='day', columns='isin', values='quantity', aggfunc='sum')
+    isins = opening_quantities.index.union(flows.columns)
+    positions = flows.reindex(index=days, columns=isins).fillna(0).cumsum() + opening_quantities.reindex(isins).fillna(0)
+
+    # fallback price: the last order price, or the snapshot average cost for the positions without order since it
+    order_prices = orders.pivot_table(index='day', columns='isin', values='price', aggfunc='last')
+    order_prices = order_prices.reindex(order_prices.index.union(days)).ffill().reindex(index=days, columns=isins)
+    holding = snapshot[snapshot['quantity'] != 0]
+    order_prices = order_prices.fillna(holding['cost'] / holding['quantity'])
+    order_currencies = snapshot['currency'].combine_first(orders.groupby('isin')['currency'].last())
+
+    prices = pd.DataFrame(index=days, columns=isins, dtype=float)
+    currencies = {}
+    marks = {}
+    for isin in isins:
+        closes = store.read(isin, start - LOOKBACK, end)
+        if len(closes):
+            prices[isin] = closes.reindex(closes.index.union(days)).ffill().reindex(days)
+            currencies[isin] = store.currency(isin)
+            marks[isin] = closes.index[-1].strftime('%Y-%m-%d')
+        else:
+            currencies[isin] = order_currencies.get(isin)
+            last = store.last_date(isin)
+            if last is not None:
+                logger.warning(f'{isin}: last close on {last} is older than the {LOOKBACK.days} days lookback, valued at the order prices')
+    fallback = prices.isna() & order_prices.notna()
+    prices = prices.where(~fallback, order_prices)
+
+    codes = sorted({code for code in currencies.values() if code and code != currency})
+    rates = pd.DataFrame(1.0, index=days, columns=[currency])
+    if codes:
+        fx = ExchangeRate.convert(codes, currency, date_from=start.strftime('%Y-%m-%d'), date_to=end.strftime('%Y-%m-%d'))
+        fx.index = pd.to_datetime(fx.index)
+        fx = fx.drop(columns=[currency], errors='ignore') # GBX quotes also return the GBP column, already in `rates`
+        rates = rates.join(fx.reindex(fx.index.union(days)).ffill().bfill().reindex(days))
+    rate_matrix = rates.reindex(columns=[currencies[isin] or currency for isin in isins]).to_numpy()
+
+    values = positions.to_numpy() * prices.to_numpy() / rate_matrix
+    held = positions.to_numpy() != 0
+    missing = held & np.isnan(values)
+    if missing.any():
+        logger.warning(f'{int(missing.sum())} position days without price or exchange rate left out of the valuation')
+    daily = pd.Series(np.where(held, np.nan_to_num(values), 0).sum(axis=1), index=days)
+    return daily, marks
+
+
+def _save(ptf: Portfolio, currency: str, values: pd.Series, marks: dict, start: pd.Timestamp, end: pd.Timestamp, state: Optional[dict]):
+    valuations = ptf._mongo_client.investments.valuations
+    if id(ptf._mongo_client) not in _indexed:
+        valuations.create_index([('ptf_id', 1), ('currency', 1), ('day', 1)], unique=True)
+        _indexed.add(id(ptf._mongo_client))
+    valuations.bulk_write([
+        UpdateOne({'ptf_id': ptf._id, 'currency': currency, 'day': day.to_pydatetime()}, {'$set': {'value': float(value)}}, upsert=True)
+        for day, value in values.items()], ordered=False)
+
+    computed_to = max(end, pd.Timestamp(state['computed_to'])) if state else end
+    price_marks = {**((state or {}).get('price_marks') or {}), **marks}
+    portfolios = ptf._mongo_client.investments.portfolios
+    if state is None:
+        # concurrent first valuations: only one entry per currency
+        portfolios.update_one({'_id': ptf._id, 'valuations.currency': {'$ne': currency}}, {'$push': {'valuations': {
+            'currency': currency, 'first_day': start.to_pydatetime(), 'computed_to': computed_to.to_pydatetime(),
+            'price_marks': price_marks, 'version': 0}}})
+        return
+    portfolios.update_one(
+        {'_id': ptf._id},
+        {'$set': {'valuations.$[v].computed_to': computed_to.to_pydatetime(), 'valuations.$[v].price_marks': price_marks}},
+        array_filters=[{'v.currency': currency}])
+    # orders written meanwhile bumped the version: their dirty_from is kept for the next call.
+    # Days after `end` computed earlier were not recomputed: they stay stale from the day after `end`
+    stale_after_end = end < pd.Timestamp(state['computed_to'])
+    portfolios.update_one(
+        {'_id': ptf._id},
+        {'$set': {'valuations.$[v].dirty_from': (end + timedelta(days=1)).to_pydatetime()}} if stale_after_end
+        else {'$unset': {'valuations.$[v].dirty_from': ''}},
+        array_filters=[{'v.currency': currency, 'v.version': state.get('version', 0)}])
+
+
+def _to_day(value: Union[str, date, datetime]) -> pd.Timestamp:
+    return pd.Timestamp(value).normalize()
@@ -1,18 +1,200 @@
+import json
+import time
+import asyncio
+import logging
+import threading
 import requests
+import httpx
 import posixpath
-from typing import List, Dict, Optional,Literal
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Dict, Optional, Literal, Tuple, Union
+from datetime import date, datetime
+import numpy as np
+
+from mylibs.transport import get_session, get_async_client
+from mylibs.rateLimiter import RateLimiter
 
 
 HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"}
+TICKERS_URL = 'https://www.sec.gov/files/company_tickers.json'
+FORM_TYPES = {'4': '4', '8k': '8-K', '10k': '10-K', '10q': '10-Q', '11k': '11-K', 'ars': 'ARS'} # in SecSearch.formType choices order
+BATCH_WORKERS = 8 # concurrent requests of a batch, their rate is bounded by sec_limiter
+SEC_RATE = 10 # SEC fair access: at most 10 requests per second, all sec.gov hosts together
+SUBMISSION_COLUMNS = ('form', 'accessionNumber', 'reportDate', 'filingDate', 'primaryDocument') # read by parse_sec_data
+logger = logging.getLogger('myapp')
+sec_limiter = RateLimiter.for_key('sec.gov', rate=SEC_RATE) # shared by every thread and event loop of the process
 
 class SECDataError(Exception):
     pass
 
+
+class CikMap():
+    '''
+    Local ticker -> CIK map, in the format of SEC's bulk `company_tickers.json` ({"0": {"cik_str", "ticker", "title"}, ...}).
+
+    Loaded from `path` when given (a local copy or fixture, no network needed), otherwise downloaded once and refreshed
+    after `ttl` seconds. A failed load is retried after `retry_after` seconds. Tickers missing from the map fall back to the
+    full-text search, and are remembered.
+    The map is fetched outside the lock of the lookups and swapped in: during a refresh, other lookups use the previous map.
+    '''
+    def __init__(self, path: Optional[Union[str, Path]] = None, ttl: float = 24 * 3600, retry_after: float = 60):
+        self.path = Path(path) if path else None
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self._ciks: Dict[str, str] = {}
+        self._reload_at: Optional[float] = None # monotonic time of the next load, None before the first one
+        self._lock = threading.Lock()
+        self._loading = threading.Lock()
+
+    def get(self, ticker: str) -> Optional[str]:
+        '''CIK of the ticker from the map, None when unknown'''
+        if self._reload_at is None or time.monotonic() >= self._reload_at:
+            self._load()
+        with self._lock:
+            return self._ciks.get(ticker.upper())
+
+    def add(self, ticker: str, cik: str):
+        with self._lock:
+            self._ciks[ticker.upper()] = cik
+
+    def _load(self):
+        # only one load at a time. Lookups wait for it while the map is empty, otherwise they keep the current map
+        if not self._loading.acquire(blocking=not self._ciks):
+            return
+        try:
+            if self._reload_at is not None and time.monotonic() < self._reload_at: # loaded by another thread meanwhile
+                return
+            try:
+                if self.path is not None:
+                    data = json.loads(self.path.read_text())
+                else:
+                    response = sec_get(TICKERS_URL, HEADERS, timeout=30)
+                    response.raise_for_status()
+                    data = response.json()
+                ciks = {entry['ticker'].upper(): str(entry['cik_str']) for entry in data.values()}
+            except (OSError, ValueError, KeyError, requests.RequestException) as e:
+                logger.warning(f'CIK map not loaded, falling back to the full-text search for {self.retry_after}s: {e}')
+                self._reload_at = time.monotonic() + self.retry_after
+                return
+            with self._lock:
+                self._ciks = ciks
+            self._reload_at = float('inf') if self.path is not None else time.monotonic() + self.ttl
+            logger.info(f'{len(ciks)} tickers loaded in the CIK map')
+        finally:
+            self._loading.release()
+
+
+class SubmissionsCache():
+    '''
+    Bounded in-process cache of the submissions json of each CIK.
+    Entries are served for `ttl` seconds, then revalidated with their ETag / Last-Modified: a 304 extends them without a download.
+    Only the filing columns read by parse_sec_data are kept (a submissions json of a large filer weighs several MB).
+    '''
+    def __init__(self, ttl: float = 3600, maxsize: int = 256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: 'OrderedDict[str, Tuple[float, Dict[str, str], dict]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cik_full: str) -> Tuple[Optional[dict], Dict[str, str]]:
+        '''(data, revalidation headers): data is None when missing or expired'''
+        with self._lock:
+            entry = self._entries.get(cik_full)
+            if entry is None:
+                return None, {}
+            self._entries.move_to_end(cik_full)
+            fetched_at, validators, data = entry
+            if time.monotonic() - fetched_at <= self.ttl:
+                return data, {}
+            conditional = {}
+            if validators.get('etag'):
+                conditional['If-None-Match'] = validators['etag']
+            if validators.get('last-modified'):
+                conditional['If-Modified-Since'] = validators['last-modified']
+            return None, conditional
+
+    def put(self, cik_full: str, data: dict, headers) -> dict:
+        validators = {key: headers.get(key) for key in ('etag', 'last-modified') if headers.get(key)}
+        data = self._compact(data)
+        with self._lock:
+            self._entries[cik_full] = (time.monotonic(), validators, data)
+            self._entries.move_to_end(cik_full)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return data
+
+    def revalidated(self, cik_full: str) -> dict:
+        '''Entry confirmed unchanged by a 304: served for another `ttl`'''
+        with self._lock:
+            _, validators, data = self._entries[cik_full]
+            self._entries[cik_full] = (time.monotonic(), validators, data)
+            return data
+
+    @staticmethod
+    def _compact(data: dict) -> dict:
+        '''Filing columns of a submissions json (filings.recent and the filings.files pages), or of an archive page'''
+        def columns(block: dict) -> dict:
+            return {column: block[column] for column in SUBMISSION_COLUMNS if column in block} # a missing one fails in parse_sec_data
+        if not isinstance(data, dict):
+            return data
+        if 'filings' not in data:
+            return columns(data)
+        filings = data['filings']
+        return {'filings': {'recent': columns(filings.get('recent') or {}), 'files': filings.get('files', [])}}
+
+
+def _tickers_file() -> Optional[str]:
+    from django.conf import settings
+    from django.core.exceptions import ImproperlyConfigured
+    try:
+        return getattr(settings, 'SEC_TICKERS_FILE', None)
+    except ImproperlyConfigured: # run as a script
+        return None
+
+cik_map = CikMap(_tickers_file())
+submissions_cache = SubmissionsCache()
+
+def sec_get(url: str, headers: dict, timeout: float = 10) -> requests.Response:
+    '''GET a sec.gov url within the SEC_RATE shared by the process'''
+    sec_limiter.acquire('sec.gov')
+    start = time.monotonic()
+    try:
+        response = get_session().get(url, headers=headers, timeout=timeout)
+    except requests.RequestException:
+        sec_limiter.update('sec.gov', {}, time.monotonic() - start, error=True)
+        raise
+    sec_limiter.update('sec.gov', response.headers, time.monotonic() - start,
+                       throttled=response.status_code == 429, error=response.status_code >= 500)
+    return response
+
+async def asec_get(url: str, headers: dict, timeout: float = 10) -> httpx.Response:
+    '''Async sec_get, sharing the same limiter'''
+    await sec_limiter.aacquire('sec.gov')
+    start = time.monotonic()
+    try:
+        response = await get_async_client().get(url, headers=headers, timeout=timeout)
+    except httpx.HTTPError:
+        sec_limiter.update('sec.gov', {}, time.monotonic() - start, error=True)
+        raise
+    sec_limiter.update('sec.gov', response.headers, time.monotonic() - start,
+                       throttled=response.status_code == 429, error=response.status_code >= 500)
+    return response
+
 def get_cik(ticker: str, headers: dict) -> str:
+    cik = cik_map.get(ticker)
+    if cik:
+        return cik
+    cik = search_cik(ticker, headers)
+    cik_map.add(ticker, cik)
+    return cik
+
+def search_cik(ticker: str, headers: dict) -> str:
+    '''Full-text search fallback for the tickers missing from the CIK map'''
     url = f'https://efts.sec.gov/LATEST/search-index?keysTyped={ticker}'
     try:
-        response = requests.get(url, headers=headers, timeout=10)
+        response = sec_get(url, headers)
         response.raise_for_status()
     except requests.RequestException as e:
         raise SECDataError(f"Error getting CIK number for '{ticker}': {e}")
@@ -31,39 +213,107 @@ def format_cik(cik: str) -> str:
     padding = 10 - len(cik)
     return 'CIK' + '0' * padding + cik
 
+def _json_name(name: str) -> str:
+    return name if name.endswith('.json') else f'{name}.json'
+
 def fetch_sec_data(cik_full: str, headers: dict) -> Dict:
-    sec_register_url = f'https://data.sec.gov/submissions/{cik_full}.json'
+    '''Submissions of the CIK, or a page of its filings.files archives when given its name (CIK...-submissions-001.json)'''
+    data, conditional = submissions_cache.get(cik_full)
+    if data is not None:
+        return data
+    sec_register_url = f'https://data.sec.gov/submissions/{_json_name(cik_full)}'
     try:
-        sec_register = requests.get(sec_register_url, headers=headers, timeout=10)
+        sec_register = sec_get(sec_register_url, {**headers, **conditional})
+        if sec_register.status_code == 304:
+            return submissions_cache.revalidated(cik_full)
         sec_register.raise_for_status()
-        return sec_register.json()
+        return submissions_cache.put(cik_full, sec_register.json(), sec_register.headers)
     except requests.RequestException as e:
         raise SECDataError(f"Error fetching SEC data for CIK '{cik_full}': {e}")
     except ValueError as e:
         raise SECDataError(f"Error parsing SEC data for CIK '{cik_full}': {e}")
 
-def parse_sec_data(data: Dict, cik: str) -> Dict:
+def parse_sec_data(data: Dict, cik: str,
+                   fromDate: Optional[Union[str, date]] = None,
+                   toDate: Optional[Union[str, date]] = None,
+                   formType: Optional[Union[str, int]] = None,
+                   archives: List[Dict] = ()) -> Dict:
+    '''
+    {form type: {dd/mm/YYYY: [document urls]}} of the filings of the submissions `data` (plus the `archives` pages of filings.files).
+
+    Each block is read as columns: the form and date masks are applied to whole arrays, and urls and dates are only built for
+    the filings kept. The date is the report date, or the filing date for the forms without one (some 8-K, ARS).
+    '''
     try:
-        recent = data['filings']['recent']
-        result = {form_type: {} for form_type in ['4', '8-K', '10-Q', '10-K', '11-K', 'ARS']}
-        form_types: List[str] = recent['form']
-        id_base: List[str] = recent['accessionNumber']
-        dates: List[str] = recent['reportDate']
-        id_end: List[str] = recent['primaryDocument']
-        base_url = 'https://www.sec.gov/Archives/edgar/data/'
-
-        for index, form_type in enumerate(form_types):
-            if form_type in result:
-                form_url = posixpath.join(base_url, cik, id_base[index].replace('-', ''), id_end[index])
-                date = datetime.strptime(dates[index], '%Y-%m-%d').strftime('%d/%m/%Y')
-                if date not in result[form_type]:
-                    result[form_type][date] = []
-                result[form_type][date].append(form_url)
+        forms = _form_filter(formType)
+        date_from, date_to = _iso(fromDate), _iso(toDate)
+        result = {form_type: {} for form_type in forms}
+        blocks = [data['filings']['recent'], *archives]
+        columns = [_filing_columns(block, forms, date_from, date_to) for block in blocks]
+        form_types = np.concatenate([column[0] for column in columns])
+        accessions = np.concatenate([column[1] for column in columns])
+        documents = np.concatenate([column[2] for column in columns])
+        dates = np.concatenate([column[3] for column in columns])
+        if not len(form_types):
+            return result
 
+        base_url = posixpath.join('https://www.sec.gov/Archives/edgar/data/', cik, '')
+        urls = np.char.add(np.char.add(np.char.add(base_url, np.char.replace(accessions, '-', '')), '/'), documents)
+        # YYYY-MM-DD -> dd/mm/YYYY by moving characters
+        chars = dates.astype('<U10').view('<U1').reshape(-1, 10)[:, [8, 9, 7, 5, 6, 4, 0, 1, 2, 3]]
+        chars[:, [2, 5]] = '/'
+        days = np.ascontiguousarray(chars).view('<U10').ravel()
+
+        for form_type, day, url in zip(form_types.tolist(), days.tolist(), urls.tolist()):
+            result[form_type].setdefault(day, []).append(url)
         return result
-    except (KeyError, ValueError, IndexError) as e:
+    except (KeyError, ValueError, IndexError, TypeError) as e:
         raise SECDataError(f"Error parsing SEC filings data: {e}")
 
+def _filing_columns(block: Dict, forms: List[str], date_from: Optional[str], date_to: Optional[str]) -> Tuple[np.ndarray, ...]:
+    '''(form, accessionNumber, primaryDocument, date) arrays of the filings matching the filters'''
+    form_types = np.asarray(block['form'], dtype=str)
+    dates = np.asarray(block['reportDate'], dtype=str)
+    dates = np.where(dates == '', np.asarray(block['filingDate'], dtype=str), dates)
+    mask = np.isin(form_types, forms) & (dates != '')
+    if date_from:
+        mask &= dates >= date_from # ISO dates compare as strings
+    if date_to:
+        mask &= dates <= date_to
+    index = np.flatnonzero(mask)
+    return (form_types[index],
+            np.asarray(block['accessionNumber'], dtype=str)[index],
+            np.asarray(block['primaryDocument'], dtype=str)[index],
+            dates[index])
+
+def _form_filter(formType: Optional[Union[str, int]]) -> List[str]:
+    if formType is None or formType == '':
+        return list(FORM_TYPES.values())
+    if isinstance(formType, int) or str(formType).isdigit() and str(formType) not in FORM_TYPES:
+        formType = list(FORM_TYPES)[int(formType)] # SecSearch.formType choice index
+    try:
+        return [FORM_TYPES[str(formType).lower()]]
+    except KeyError:
+        raise SECDataError(f"Unknown form type '{formType}'")
+
+def _iso(value: Optional[Union[str, date]]) -> Optional[str]:
+    if not value:
+        return None
+    if isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    return datetime.strptime(value[:10], '%Y-%m-%d').strftime('%Y-%m-%d')
+
+def archive_names(data: Dict, fromDate: Optional[Union[str, date]]) -> List[str]:
+    '''
+    Pages of filings.files needed for the window: only when it starts before the oldest filing of `recent`,
+    and only the pages filed after its start (a report is filed after its date).
+    '''
+    date_from = _iso(fromDate)
+    filing_dates = data['filings']['recent'].get('filingDate') or []
+    if not date_from or (filing_dates and min(filing_dates) <= date_from):
+        return []
+    return [page['name'] for page in data['filings'].get('files', []) if page.get('filingTo', '9999') >= date_from]
+
 def get_sec_urls(ticker: str, 
                  fromDate: Optional[str] = None, 
                  toDate: Optional[str] = None, 
@@ -72,9 +322,88 @@ def get_sec_urls(ticker: str,
     cik = get_cik(ticker, HEADERS)
     cik_full = format_cik(cik)
     sec_data = fetch_sec_data(cik_full, HEADERS)
-    parsed_data = parse_sec_data(sec_data, cik)
+    archives = [fetch_sec_data(name, HEADERS) for name in archive_names(sec_data, fromDate)]
+    parsed_data = parse_sec_data(sec_data, cik, fromDate, toDate, formType, archives)
     return parsed_data
 
+def get_sec_urls_batch(tickers: List[str], **filters) -> Dict[str, dict]:
+    '''get_sec_urls for many tickers at once, on a few concurrent requests: {ticker: result or {'error': message}}'''
+    def one(ticker: str) -> dict:
+        try:
+            return get_sec_urls(ticker, **filters)
+        except SECDataError as e:
+            return {'error': str(e)}
+
+    tickers = list(dict.fromkeys(tickers))
+    with ThreadPoolExecutor(max_workers=min(BATCH_WORKERS, len(tickers) or 1)) as executor:
+        return dict(zip(tickers, executor.map(one, tickers)))
+
+async def aget_cik(ticker: str, headers: dict) -> str:
+    cik = await asyncio.to_thread(cik_map.get, ticker) # may (re)load the map
+    if cik:
+        return cik
+    cik = await asearch_cik(ticker, headers)
+    cik_map.add(ticker, cik)
+    return cik
+
+async def asearch_cik(ticker: str, headers: dict) -> str:
+    url = f'https://efts.sec.gov/LATEST/search-index?keysTyped={ticker}'
+    try:
+        response = await asec_get(url, headers)
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        raise SECDataError(f"Error getting CIK number for '{ticker}': {e}")
+
+    try:
+        data = response.json()
+        if data['hits']['total']['value'] == 0:
+            raise SECDataError(f"No CIK number associated with ticker '{ticker}'")
+        return data['hits']['hits'][0]['_id']
+    except (ValueError, KeyError) as e:
+        raise SECDataError(f"Error parsing CIK response for '{ticker}': {e}")
+
+async def afetch_sec_data(cik_full: str, headers: dict) -> Dict:
+    data, conditional = submissions_cache.get(cik_full)
+    if data is not None:
+        return data
+    sec_register_url = f'https://data.sec.gov/submissions/{_json_name(cik_full)}'
+    try:
+        sec_register = await asec_get(sec_register_url, {**headers, **conditional})
+        if sec_register.status_code == 304:
+            return submissions_cache.revalidated(cik_full)
+        sec_register.raise_for_status()
+        return submissions_cache.put(cik_full, sec_register.json(), sec_register.headers)
+    except httpx.HTTPError as e:
+        raise SECDataError(f"Error fetching SEC data for CIK '{cik_full}': {e}")
+    except ValueError as e:
+        raise SECDataError(f"Error parsing SEC data for CIK '{cik_full}': {e}")
+
+async def aget_sec_urls(ticker: str, 
+                        fromDate: Optional[str] = None, 
+                        toDate: Optional[str] = None, 
+                        formType: Optional[Literal['4', '8k', '10q', '10k', '11k','ars']] = None) -> dict:
+    '''Async version of get_sec_urls, for the ASGI views'''
+    cik = await aget_cik(ticker, HEADERS)
+    cik_full = format_cik(cik)
+    sec_data = await afetch_sec_data(cik_full, HEADERS)
+    archives = await asyncio.gather(*(afetch_sec_data(name, HEADERS) for name in archive_names(sec_data, fromDate)))
+    parsed_data = parse_sec_data(sec_data, cik, fromDate, toDate, formType, archives)
+    return parsed_data
+
+async def aget_sec_urls_batch(tickers: List[str], **filters) -> Dict[str, dict]:
+    '''Async get_sec_urls_batch: at most BATCH_WORKERS requests in flight'''
+    semaphore = asyncio.Semaphore(BATCH_WORKERS)
+
+    async def one(ticker: str) -> dict:
+        async with semaphore:
+            try:
+                return await aget_sec_urls(ticker, **filters)
+            except SECDataError as e:
+                return {'error': str(e)}
+
+    tickers = list(dict.fromkeys(tickers))
+    return dict(zip(tickers, await asyncio.gather(*(one(ticker) for ticker in tickers))))
+
 
 if __name__=='__main__':
     from pprint import pprint
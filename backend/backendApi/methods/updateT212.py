@@ -1,24 +1,29 @@
 import logging
-from datetime import datetime, timezone
+from datetime import datetime
 from time import time
 from bson import ObjectId
-from typing import Union, List
+from typing import Union, List, Dict, Optional, Callable, Iterator, Tuple
 import pandas as pd
 
 import ipdb
 
-from mylibs.t212 import Trading212
+from mylibs.t212 import Trading212, Trading212Error, Trading212AuthError, Trading212RateLimitError, OrderPage
 from mylibs.exchangeRate import ExchangeRate
 from mylibs.decorators import timing
+from mylibs.jobQueue import JobQueue
 from pymongo import MongoClient
 from classes.securities import Order, Stock, Fee
 from classes.portfolio import Portfolio
+from classes.snapshots import SnapshotStore
 from classes.users import User
 from master.Secrets import ApiKeys
 
 
 mongo_client=MongoClient(ApiKeys.mongo)
 logger = logging.getLogger('myapp')
+# failed syncs are polled as 401 (api key refused), 429 (still rate limited) or 502 (other T212 errors)
+t212_sync_jobs = JobQueue(mongo_client, 'T212', error_statuses={
+    Trading212AuthError: 401, Trading212RateLimitError: 429, Trading212Error: 502})
 
 
 @timing()
@@ -28,7 +33,7 @@ def init_client(client_id, ptf_index: int = 0):
     ptf = Portfolio(mongo_client, user.ptf_ids[ptf_index] if user.ptf_ids else None) # ptf[0] is always the 'basket ptf'
     if not user.ptf_ids:
         user.add_ptf_id(ptf._id)
-    ptf.load()
+    ptf.load(lazy=True) # the sync appends to the stock headers, known order ids are read apart (stored_order_ids)
     return ptf, user
 
 @timing()
@@ -42,8 +47,13 @@ def init_format(orders: list, t212: Trading212, base_currency: str):
     return instruments_dict, rates
 
 @timing()
-def format_orders(orders: list, ptf: Portfolio, rates: pd.DataFrame, instruments_dict: dict, base_currency: str):
-    existing_stocks = {}
+def format_orders(orders: list, ptf: Portfolio, rates: pd.DataFrame, instruments_dict: dict, base_currency: str) -> Dict[str, List[Order]]:
+    '''
+    Build the Order objects, add them to their stock in the portfolio and return the new orders grouped by t212_id
+    (an isin listed on several venues is several T212 instruments)
+    '''
+    existing_stocks = {stock.t212_id: stock for stock in ptf.stocks}
+    new_orders = {}
     for order in orders:
         # variables initialization
         t212_id = order['t212_id']
@@ -98,22 +108,106 @@ def format_orders(orders: list, ptf: Portfolio, rates: pd.DataFrame, instruments
             stock_obj.add_order(order_obj)
             added_stock = ptf.add_security(stock_obj)
             existing_stocks[t212_id] = added_stock
+        new_orders.setdefault(t212_id, []).append(order_obj)
+    return new_orders
 
-def updateT212(client_id: Union[str, ObjectId], base_currency: str = 'EUR'):
+def format_pages(pages: Iterator[OrderPage], ptf: Portfolio, t212: Trading212, base_currency: str) -> Iterator[Tuple[OrderPage, Dict[str, List[Order]]]]:
+    '''Resolve the instruments and exchange rates of each page and build its Order objects, one page at a time'''
+    for page in pages:
+        new_orders = {}
+        if page.orders:
+            instruments_dict, rates = init_format(page.orders, t212, base_currency)
+            new_orders = format_orders(page.orders, ptf, rates, instruments_dict, base_currency)
+        yield page, new_orders
+
+def by_isin(ptf: Portfolio, new_orders: Dict[str, List[Order]]) -> Dict[str, List[Order]]:
+    '''Regroup orders keyed by t212_id by isin, the key of the stored stocks (PortfolioWriter.upsert_orders)'''
+    isins = {stock.t212_id: stock.isin for stock in ptf.stocks}
+    grouped = {}
+    for t212_id, orders in new_orders.items():
+        grouped.setdefault(isins[t212_id], []).extend(orders)
+    return grouped
+
+def release_orders(ptf: Portfolio, new_orders: Dict[str, List[Order]]):
+    '''Drop written orders from the in-memory stocks (format_orders appended them last), so memory does not grow with the history'''
+    stocks = {stock.t212_id: stock for stock in ptf.stocks}
+    for t212_id, orders in new_orders.items():
+        del stocks[t212_id].orders[-len(orders):]
+
+def updateT212(client_id: Union[str, ObjectId], base_currency: str = 'EUR', full: bool = False, max_pages: Optional[int] = None,
+               progress: Optional[Callable[..., None]] = None) -> dict:
+    '''
+    Incremental sync of the T212 orders, streamed page by page from the api to mongo.
+
+    Each page is normalized, its instruments and exchange rates resolved, its orders built and written with the sync checkpoint
+    through a PortfolioWriter before the next page is fetched: memory holds one page, and an interrupted sync resumes from
+    the cursor of the last page written. Orders are upserted by `order_id`, so a replayed page never duplicates them.
+
+    Paging stops at the first order already stored. The checkpoint keeps two resume cursors:
+    `head_cursor` while new orders are being paged (an interruption would otherwise leave a gap below the first page written),
+    and `cursor` for a long history backfilled over several calls with `max_pages`. Both are resumed before paging new orders.
+    `full` ignores the checkpoint and refetches the whole history.
+    `progress(**fields)` is called after each page written, e.g. by the sync job queue.
+    '''
+    report = progress or (lambda **fields: None)
     ptf, user = init_client(client_id)
     t212 = Trading212(user.oaths['T212'], mongo_client)
+    filter_func = lambda o : o['status'] == 'FILLED'
 
-    last_date = user.brokersLastUpdate.get('T212')
-    # last_date = datetime.strptime('01/05/2024', '%d/%m/%Y')
-    orders = t212.get_orders(last_date, filter_func=lambda o : o['status'] == 'FILLED')
-
-    instruments_dict, rates = init_format(orders, t212, base_currency)
-    orders = format_orders(orders, ptf, rates, instruments_dict, base_currency)
-    ptf.push_securities('stocks')
+    # the portfolio checkpoint is written with the orders, the user one is a mirror kept for older portfolios
+    checkpoint = {} if full else dict(ptf.brokersSync.get('T212') or user.brokersSync.get('T212', {}))
+    checkpoint.pop('last_update', None)
+    known_ids = ptf.stored_order_ids() if not full else None
+    streams = [] # (checkpoint key, start cursor, max pages)
+    if known_ids and checkpoint.get('head_cursor'): # new orders left unfinished by an interrupted call
+        streams.append(('head_cursor', checkpoint['head_cursor'], None))
+    if known_ids and checkpoint.get('cursor'): # unfinished backfill from a previous call
+        streams.append(('cursor', checkpoint['cursor'], max_pages))
+    streams.append(('head_cursor', None, None) if known_ids else ('cursor', None, max_pages))
 
+    result = {'orders_fetched': 0, 'orders_added': 0, 'pages_written': 0}
+    newest = None
     t = time()
-    user._users_db.users.update_one(
-        {'_id': user._id},
-        {'$set': {'brokersLastUpdate.T212': datetime.now(timezone.utc)}})
-    logger.info(f'T212 update date added to mongo in: {time() -t}')
-    return orders
\ No newline at end of file
+    for key, start, limit in streams:
+        pages = t212.iter_orders(known_ids=known_ids, filter_func=filter_func, cursor=start, max_pages=limit)
+        checkpoint[key] = start
+        stream_pages = 0
+        for page, new_orders in format_pages(pages, ptf, t212, base_currency):
+            stream_pages += 1
+            if start is None and newest is None and page.orders:
+                newest = page.orders[0]
+                checkpoint['high_water_mark'] = datetime.strptime(newest['dateModified'], '%Y-%m-%dT%H:%M:%S.%fZ')
+                checkpoint['last_order_id'] = newest['id']
+            checkpoint[key] = page.cursor
+            dates = [order.date for security_orders in new_orders.values() for order in security_orders]
+            if dates: # oldest day whose month-end snapshots are to rebuild, kept until they are
+                pending = checkpoint.get('snapshots_from')
+                checkpoint['snapshots_from'] = min(dates) if pending is None else min(pending, min(dates))
+
+            # a page of orders and its checkpoint in one ordered bulk write: a failure never leaves the checkpoint ahead of the orders
+            writer = ptf.writer()
+            writer.upsert_orders('stocks', by_isin(ptf, new_orders))
+            writer.set_sync('T212', dict(checkpoint)) # mirrored to the user once, in the final flush
+            writer.flush()
+            release_orders(ptf, new_orders)
+
+            result['orders_fetched'] += len(page.orders)
+            result['orders_added'] += sum(len(o) for o in new_orders.values())
+            result['pages_written'] += 1
+            report(stage='fetching', pages_fetched=result['pages_written'], orders_formatted=result['orders_added'], push_status='pending')
+        if limit is None or stream_pages < limit:
+            checkpoint[key] = None # paging reached the end of the history, not max_pages
+    logger.info(f"T212 orders streamed in {time() - t:.2f}s ({result['pages_written']} pages)")
+
+    if checkpoint.get('snapshots_from'):
+        report(stage='snapshots')
+        SnapshotStore(mongo_client).update(ptf, changed_from=checkpoint['snapshots_from'])
+        checkpoint['snapshots_from'] = None
+    writer = ptf.writer()
+    writer.set_sync('T212', checkpoint, user_id=user._id)
+    writer.flush()
+
+    result['backfill_complete'] = checkpoint.get('cursor') is None
+    logger.info(f'T212 api stats: {t212.api_stats()}')
+    report(stage='done', push_status='done')
+    return result
@@ -30,4 +30,23 @@ class SecSearchSerializer(serializers.ModelSerializer):
             'fromDate': {'required': False},
             'toDate': {'required': False},
             'formType': {'required': False}
-        }
\ No newline at end of file
+        }
+
+class SecBatchSearchSerializer(serializers.ModelSerializer):
+    tickers = serializers.CharField() # comma separated, e.g. MMM,AAPL,MSFT
+    max_tickers = 100
+
+    class Meta():
+        model = SecSearch
+        fields = ['tickers', 'fromDate', 'toDate', 'formType']
+        extra_kwargs = SecSearchSerializer.Meta.extra_kwargs
+
+    def validate_tickers(self, value: str):
+        tickers = list(dict.fromkeys(ticker.strip().upper() for ticker in value.split(',') if ticker.strip()))
+        if not tickers:
+            raise serializers.ValidationError('At least one ticker is required.')
+        if len(tickers) > self.max_tickers:
+            raise serializers.ValidationError(f'At most {self.max_tickers} tickers per request.')
+        if any(len(ticker) > 8 for ticker in tickers):
+            raise serializers.ValidationError('Tickers are at most 8 characters long.')
+        return tickers
@@ -1,3 +1,901 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import types
+import unittest
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from unittest import mock
+
+import mongomock
+import numpy as np
+import pandas as pd
+from bson import ObjectId
+from django.test import SimpleTestCase
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import PyMongoError
+from rest_framework.test import APIRequestFactory
+
+import backendApi.methods.get_ptf_value as get_ptf_value
+import backendApi.methods.get_sec_urls as sec
+import backendApi.methods.updateT212 as update_t212
+import backendApi.views as views
+from classes.codec import Codec
+from classes.finance import EfficientFrontier, Fmaths
+from classes.orders import OrderStore, OrdersMigrationError
+from classes.portfolio import Portfolio
+from classes.securities import Fee, Order, Stock
+from classes.snapshots import SnapshotStore
+from classes.writer import PortfolioWriter
+from mylibs import transport
+from mylibs.exchangeRate import ExchangeRate, RateStore
+from mylibs.jobQueue import JobQueue, job_http_status, job_status
+from mylibs.priceStore import PriceStore, PriceStoreError
+from mylibs.rateLimiter import RateLimiter
+from mylibs.t212 import Trading212, Trading212AuthError, Trading212Error
 
 # Create your tests here.
+
+T212_DATE = '%Y-%m-%dT%H:%M:%S.%fZ'
+INSTRUMENTS = [
+    {'t212_id': 'AAPL_US_EQ', 'ticker': 'AAPL', 'isin': 'US0378331005', 'currencyCode': 'EUR'},
+    {'t212_id': 'VODl_EQ', 'ticker': 'VOD', 'isin': 'GB00BH4HKS39', 'currencyCode': 'EUR'},
+]
+
+
+class FakeT212Api():
+    '''Order history of the T212 api, newest first, paged by date cursor. `fail_at` makes that request number fail'''
+    def __init__(self):
+        self.orders = []
+        self.calls = 0
+        self.fail_at = None
+
+    def add_orders(self, count: int, newest: datetime, first_id: int):
+        orders = [{
+            'id': first_id + i, 'dateModified': (newest - timedelta(days=i)).strftime(T212_DATE),
+            'dateCreated': (newest - timedelta(days=i)).strftime(T212_DATE), 'status': 'FILLED',
+            'ticker': INSTRUMENTS[i % 2]['t212_id'], 'shortName': 'x', 'type': 'MARKET', 'taxes': [],
+            'filledQuantity': 1.0, 'fillPrice': 10.0, 'filledValue': 10.0} for i in range(count)]
+        self.orders = orders + self.orders
+
+    def handle_request(self, url, api_key, params=None, **kwargs):
+        self.calls += 1
+        if self.calls == self.fail_at:
+            raise ConnectionError('network down')
+        cursor = params['cursor']
+        items = [dict(order) for order in self.orders
+                 if cursor is None or datetime.strptime(order['dateModified'], T212_DATE).timestamp() * 1000 < cursor]
+        return {'items': items[:params['limit']]}
+
+
+class UpdateT212ResumeTests(SimpleTestCase):
+    '''updateT212 streamed against a fake api: interrupted syncs resume from their checkpoint without gaps nor duplicates'''
+    def setUp(self):
+        self.mongo_client = mongomock.MongoClient()
+        self.user = types.SimpleNamespace(_id=ObjectId(), oaths={'T212': 'key'}, brokersSync={})
+        self.mongo_client.users.users.insert_one({'_id': self.user._id})
+        self.ptf_id = None
+        self.api = FakeT212Api()
+        self.api.add_orders(230, datetime(2022, 6, 1), first_id=1000)
+        for patch in [
+            mock.patch.object(update_t212, 'mongo_client', self.mongo_client),
+            mock.patch.object(update_t212, 'init_client', self.init_client),
+            mock.patch.object(update_t212, 'SnapshotStore', lambda mongo_client: mock.Mock()),
+            mock.patch.object(update_t212.ExchangeRate, 'convert', lambda *args, **kwargs: pd.DataFrame()),
+            mock.patch.object(Trading212, '_handle_request', staticmethod(self.api.handle_request)),
+            mock.patch.object(Trading212, 'get_instruments', lambda t212, filters, update=False: INSTRUMENTS),
+            mock.patch.object(Trading212, 'api_stats', lambda t212: {}),
+        ]:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def init_client(self, client_id, ptf_index=0):
+        ptf = Portfolio(self.mongo_client, self.ptf_id, name='test', orders_storage='collection')
+        if self.ptf_id:
+            ptf.load(lazy=True)
+        self.ptf_id = ptf._id
+        return ptf, self.user
+
+    def stored_ids(self) -> list:
+        return [doc['order_id'] for doc in self.mongo_client.investments.orders.find({}, {'order_id': 1})]
+
+    def checkpoint(self) -> dict:
+        return self.mongo_client.investments.portfolios.find_one({'_id': self.ptf_id})['brokersSync']['T212']
+
+    def assertSynced(self):
+        ids = self.stored_ids()
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(set(ids), {order['id'] for order in self.api.orders})
+
+    def test_interrupted_backfill_resumes_from_cursor(self):
+        result = update_t212.updateT212('client', max_pages=2)
+        self.assertFalse(result['backfill_complete'])
+        self.assertEqual(len(self.stored_ids()), 100)
+        cursor = self.checkpoint()['cursor']
+        self.assertIsNotNone(cursor)
+
+        self.api.calls, self.api.fail_at = 0, 2
+        with self.assertRaises(ConnectionError):
+            update_t212.updateT212('client')
+        self.assertEqual(len(self.stored_ids()), 150) # the page written before the failure is kept with its cursor
+        self.assertLess(self.checkpoint()['cursor'], cursor)
+
+        self.api.fail_at = None
+        result = update_t212.updateT212('client')
+        self.assertTrue(result['backfill_complete'])
+        self.assertSynced()
+
+    def test_interrupted_head_pages_resume_without_gap(self):
+        update_t212.updateT212('client')
+        self.api.add_orders(70, datetime(2022, 12, 1), first_id=3000)
+
+        self.api.calls, self.api.fail_at = 0, 2
+        with self.assertRaises(ConnectionError):
+            update_t212.updateT212('client')
+        checkpoint = self.checkpoint()
+        self.assertIsNotNone(checkpoint['head_cursor'])
+        self.assertEqual(checkpoint['last_order_id'], 3000)
+
+        self.api.fail_at = None
+        update_t212.updateT212('client')
+        self.assertIsNone(self.checkpoint()['head_cursor'])
+        self.assertSynced()
+
+        result = update_t212.updateT212('client') # nothing new: paging stops at the first known order
+        self.assertEqual(result['orders_added'], 0)
+
+    def test_user_mirror_written_once(self):
+        set_sync = PortfolioWriter.set_sync
+        with mock.patch.object(PortfolioWriter, 'set_sync', autospec=True, side_effect=set_sync) as spy:
+            result = update_t212.updateT212('client', max_pages=3)
+        user_ids = [call.kwargs.get('user_id') for call in spy.call_args_list]
+        self.assertEqual(len(user_ids), result['pages_written'] + 1)
+        self.assertEqual(user_ids, [None] * result['pages_written'] + [self.user._id]) # pages only write the portfolio
+        user = self.mongo_client.users.users.find_one({'_id': self.user._id})
+        self.assertEqual(user['brokersSync']['T212']['cursor'], self.checkpoint()['cursor'])
+
+    def test_release_orders_by_instrument(self):
+        ptf = Portfolio(self.mongo_client, name='test')
+        listings = [Stock(isin='IE00B4L5Y983', ticker='IWDA', t212_id='IWDAa_EQ'), Stock(isin='IE00B4L5Y983', ticker='SWDA', t212_id='SWDAl_EQ')]
+        for stock in listings:
+            stock.add_order(Order(order_id=1 if stock.ticker == 'IWDA' else 2))
+            ptf.add_security(stock)
+        new_orders = {'SWDAl_EQ': [Order(order_id=3)]} # a second listing of the same isin
+        listings[1].add_order(new_orders['SWDAl_EQ'][0])
+
+        self.assertEqual([order.order_id for order in update_t212.by_isin(ptf, new_orders)['IE00B4L5Y983']], [3])
+        update_t212.release_orders(ptf, new_orders)
+        self.assertEqual([[order.order_id for order in stock.orders] for stock in listings], [[1], [2]])
+
+    def test_known_ids_read_apart_from_the_stocks(self):
+        update_t212.updateT212('client')
+        ptf, _ = self.init_client('client')
+        self.assertTrue(all(not stock.orders for stock in ptf.stocks)) # no skeleton order mixed with the new ones
+        self.assertEqual(ptf.stored_order_ids(), {order['id'] for order in self.api.orders})
+
+        embedded = Portfolio(self.mongo_client, name='embedded')
+        stock = Stock(isin='US0378331005', ticker='AAPL', t212_id='AAPL_US_EQ')
+        stock.add_order(Order(broker='T212', order_id=7))
+        embedded.add_security(stock)
+        embedded.push_securities('stocks')
+        self.assertEqual(embedded.stored_order_ids(), {7})
+
+
+class CodecTests(SimpleTestCase):
+    def test_orders_with_fees_round_trip(self):
+        order = Order('T212', 'MARKET', 1.5, False, 100.0, datetime(2021, 1, 4, 10), 42, 'GBX',
+                      [Fee('stampDuty', 0.5), Fee('currencyConversionFee', 0.15)])
+        doc = Codec.encode(order)
+        self.assertEqual(doc['fees'], [{'type': 'stampDuty', 'value': 0.5}, {'type': 'currencyConversionFee', 'value': 0.15}])
+        decoded = Codec.decode(Order, doc)
+        self.assertEqual(decoded.fees, order.fees)
+        self.assertEqual(Codec.encode(decoded), doc)
+
+    def test_from_dict_builds_fee_instances(self):
+        stock = Stock(isin='GB00BH4HKS39', ticker='VOD', t212_id='VODl_EQ')
+        stock.add_order(Order('T212', order_id=1, fees=[Fee('stampDuty', 0.5)]))
+        doc = {'name': 'test', 'stocks': Codec.encode_many([stock]), 'bonds': []}
+        ptf = Portfolio.from_dict(Portfolio(), doc, classes=[Portfolio, Stock, Order, Fee])
+        self.assertEqual(ptf.stocks[0].orders[0].fees, [Fee('stampDuty', 0.5)])
+        self.assertNotIsInstance(Fee.type, str) # values set on the instance, not on the class
+
+    def test_portfolio_documents_round_trip(self):
+        ptf = Portfolio(name='test')
+        stock = ptf.add_security(Stock(isin='US0378331005', ticker='AAPL', sector='Technology'))
+        stock.add_order(Order('T212', 'MARKET', 1, False, 10.0, datetime(2021, 1, 4), 1, 'USD'))
+        doc = Codec.encode(ptf)
+        self.assertEqual(doc['stocks'][0]['orders'][0]['order_id'], 1)
+        loaded = Codec.decode_into(Portfolio(), {**doc, 'unknown': 1}) # keys missing from the schema are ignored
+        self.assertEqual(Codec.encode(loaded), doc)
+        self.assertEqual(loaded.stocks[0].ticker, 'AAPL')
+        self.assertEqual(Codec.decode(Stock, {'isin': 'US0378331005'}).orders, [])
+
+    def test_decoded_securities_keep_their_instance_attributes(self):
+        stock = Codec.decode(Stock, {'isin': 'US0378331005', 'ticker': 'AAPL'})
+        self.assertEqual((stock.ticker, stock._mongo_client, stock._ptf_id), ('AAPL', None, None))
+        self.assertEqual(Codec.decode(Fee, {'type': 'stampDuty'}), Fee('stampDuty'))
+
+        mongo_client = mongomock.MongoClient()
+        ptf = Portfolio(mongo_client, name='test')
+        ptf.hydrate({'name': 'test', 'stocks': [{'isin': 'US0378331005', 'orders': []}], 'bonds': []})
+        self.assertIs(ptf.stocks[0]._mongo_client, mongo_client)
+        self.assertEqual(ptf.stocks[0]._ptf_id, ptf._id)
+
+
+class GetOrdersTests(SimpleTestCase):
+    def test_stops_at_the_first_known_order(self):
+        api = FakeT212Api()
+        api.add_orders(120, datetime(2022, 6, 1), first_id=1000)
+        with mock.patch.object(Trading212, '_handle_request', staticmethod(api.handle_request)):
+            orders = Trading212('key').get_orders(known_ids={1030})
+        self.assertEqual([order['id'] for order in orders], list(range(1000, 1030)))
+        self.assertEqual(api.calls, 1)
+
+
+class RateLimiterTests(SimpleTestCase):
+    def test_waits_for_the_window_of_the_headers(self):
+        limiter = RateLimiter()
+        limiter.update('/orders', {'x-ratelimit-remaining': '0', 'x-ratelimit-reset': str(time.time() + 0.3)}, latency=0.01)
+        start = time.monotonic()
+        limiter.acquire('/orders')
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        limiter.acquire('/cash') # other endpoints keep their own budget
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_throttled_response_blocks_the_endpoint(self):
+        limiter = RateLimiter(base_delay=0.2)
+        limiter.update('/orders', {}, latency=0.01, throttled=True)
+        start = time.monotonic()
+        limiter.acquire('/orders')
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        self.assertEqual(limiter.stats()['/orders']['throttled'], 1)
+
+    def test_shared_per_key_and_stats_per_route(self):
+        self.assertIs(RateLimiter.for_key('test-key'), RateLimiter.for_key('test-key'))
+        response = mock.Mock(status_code=200, headers={}, json=lambda: {'id': 1})
+        with mock.patch('mylibs.t212.get_session', lambda: mock.Mock(get=lambda *args, **kwargs: response)):
+            t212 = Trading212('test-route-key')
+            for order_id in ('1', '2', '3'):
+                t212.get_open_orders(order_id)
+        stats = t212.api_stats()
+        self.assertEqual(list(stats), ['/api/v0/equity/orders/{id}'])
+        self.assertEqual(stats['/api/v0/equity/orders/{id}']['calls'], 3)
+
+
+class TransportTests(SimpleTestCase):
+    def test_one_session_per_thread(self):
+        session = transport.get_session()
+        self.assertIs(transport.get_session(), session)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(transport.get_session()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], session)
+
+    def test_default_timeout(self):
+        adapter = transport.get_session().get_adapter('https://www.sec.gov')
+        with mock.patch('requests.adapters.HTTPAdapter.send', return_value=mock.Mock()) as send:
+            adapter.send(mock.Mock())
+            adapter.send(mock.Mock(), timeout=3)
+        self.assertEqual([call.kwargs['timeout'] for call in send.call_args_list], [transport.DEFAULT_TIMEOUT, 3])
+
+    def test_one_async_client_per_loop(self):
+        async def client_twice():
+            client = transport.get_async_client()
+            return client, transport.get_async_client()
+        first, again = asyncio.run(client_twice())
+        second, _ = asyncio.run(client_twice())
+        self.assertIs(first, again)
+        self.assertIsNot(first, second)
+
+
+class JobQueueTests(SimpleTestCase):
+    def setUp(self):
+        self.queue = JobQueue(mongomock.MongoClient(), 'test', max_workers=1)
+        self.user_id = ObjectId()
+
+    def wait(self, job_id, status: str) -> dict:
+        for _ in range(200):
+            job = self.queue.get(job_id)
+            if job['status'] == status:
+                return job
+            time.sleep(0.01)
+        self.fail(f'job still {job["status"]}')
+
+    def test_runs_and_reports_progress(self):
+        def job(x, progress):
+            progress(stage='half')
+            return {'double': 2 * x}
+        job_id, created = self.queue.submit(self.user_id, job, 21)
+        self.assertTrue(created)
+        done = self.wait(job_id, 'done')
+        self.assertEqual(done['result'], {'double': 42})
+        self.assertEqual(done['progress'], {'stage': 'half'})
+        self.assertFalse(done['active'])
+
+    def test_one_active_job_per_user(self):
+        release = threading.Event()
+        job_id, _ = self.queue.submit(self.user_id, lambda progress: release.wait(5))
+        again, created = self.queue.submit(self.user_id, lambda progress: None)
+        self.assertEqual((again, created), (job_id, False))
+        release.set()
+        self.wait(job_id, 'done')
+        self.assertTrue(self.queue.submit(self.user_id, lambda progress: None)[1])
+
+    def test_failure_and_stalled_job(self):
+        with self.assertLogs('myapp', 'ERROR'):
+            job_id, _ = self.queue.submit(self.user_id, mock.Mock(side_effect=RuntimeError('boom')))
+            self.assertEqual(self.wait(job_id, 'failed')['error'], 'boom')
+
+        stalled = datetime.now() - timedelta(hours=1)
+        self.queue._jobs.insert_one({'kind': 'test', 'user_id': self.user_id, 'status': 'running', 'active': True, 'updated': stalled})
+        job_id, created = self.queue.submit(self.user_id, lambda progress: None)
+        self.assertTrue(created)
+        self.assertEqual(self.queue._jobs.count_documents({'user_id': self.user_id, 'error': 'Job stalled'}), 1)
+        self.wait(job_id, 'done')
+
+    def test_failed_job_records_the_error_type_and_status(self):
+        self.queue.error_statuses = {Trading212Error: 502, Trading212AuthError: 401}
+        with self.assertLogs('myapp', 'ERROR'):
+            for error, expected in ((Trading212AuthError('check the api key', 401), 401), (Trading212Error('down', 503), 502), (RuntimeError(), 500)):
+                job_id, _ = self.queue.submit(self.user_id, mock.Mock(side_effect=error))
+                job = self.wait(job_id, 'failed')
+                self.assertEqual((job_status(job)['error_type'], job_http_status(job)), (type(error).__name__, expected))
+        job_id, _ = self.queue.submit(self.user_id, lambda progress: None)
+        self.assertEqual(job_http_status(self.wait(job_id, 'done')), 200)
+
+
+class UpdateT212StatusTests(SimpleTestCase):
+    def test_failed_sync_polled_with_its_status(self):
+        user_id = ObjectId()
+        job = {'_id': ObjectId(), 'status': 'failed', 'error': 'check the api key', 'error_type': 'Trading212AuthError',
+               'http_status': 401, 'created': datetime(2024, 1, 1), 'updated': datetime(2024, 1, 1)}
+        request = APIRequestFactory().get(f'/api/update-t212/{job["_id"]}/')
+        request.COOKIES['client_id'] = str(user_id)
+        with mock.patch.object(update_t212.t212_sync_jobs, 'get', return_value=job) as get:
+            response = views.update_t212_status(request, str(job['_id']))
+        get.assert_called_once_with(str(job['_id']), user_id=str(user_id))
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.data['error_type'], 'Trading212AuthError')
+
+
+def stored_orders_ptf(mongo_client, orders: dict, storage: str = 'collection') -> Portfolio:
+    '''Portfolio stored with the given {isin: [(quantity, price, datetime), ...]} stock orders, in USD'''
+    ptf = Portfolio(mongo_client, name='test', orders_storage=storage)
+    order_id = 0
+    for isin, rows in orders.items():
+        stock = ptf.add_security(Stock(isin=isin, ticker=isin[-3:]))
+        for quantity, price, day in rows:
+            order_id += 1
+            stock.add_order(Order('T212', 'MARKET', quantity, False, price, day, order_id, 'USD'))
+    if storage == 'collection':
+        ptf.upsert_orders('stocks', {stock.isin: stock.orders for stock in ptf.stocks})
+    else:
+        mongo_client.investments.portfolios.insert_one({'_id': ptf._id, 'name': 'test', 'stocks': Codec.encode_many(ptf.stocks), 'bonds': []})
+    return ptf
+
+
+class LazyLoadTests(SimpleTestCase):
+    def setUp(self):
+        self.mongo_client = mongomock.MongoClient()
+        stored = stored_orders_ptf(self.mongo_client, {'US0378331005': [(1, 10, datetime(2021, 1, 4)), (2, 11, datetime(2021, 2, 4))]})
+        self.ptf = Portfolio(self.mongo_client, stored._id)
+        self.ptf.load(lazy=True)
+
+    def test_headers_first_then_orders_in_a_window(self):
+        stock = self.ptf.stocks[0]
+        self.assertEqual((stock.ticker, stock.orders, stock._orders_loaded), ('005', [], False))
+        self.ptf.load_orders(date_from=datetime(2021, 2, 1))
+        self.assertEqual([order.order_id for order in stock.orders], [2])
+        self.assertTrue(stock._orders_loaded)
+
+    def test_projected_orders(self):
+        self.ptf.load_orders(order_fields=['order_id'])
+        self.assertEqual([(order.order_id, order.price) for order in self.ptf.stocks[0].orders], [(1, None), (2, None)])
+
+
+class MongoTestCase(SimpleTestCase):
+    '''
+    Tests run against the mongod of the MONGO_TEST_URL environment variable, for the update operators mongomock lacks
+    ($[], array filters). Skipped when it is not set or not reachable; only the documents of the portfolios created are removed.
+    '''
+    @classmethod
+    def setUpClass(cls):
+        url = os.environ.get('MONGO_TEST_URL')
+        if not url:
+            raise unittest.SkipTest('MONGO_TEST_URL not set')
+        cls.mongo_client = MongoClient(url, serverSelectionTimeoutMS=2000)
+        try:
+            cls.mongo_client.admin.command('ping')
+        except PyMongoError as e:
+            cls.mongo_client.close()
+            raise unittest.SkipTest(f'mongod not reachable: {e}')
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mongo_client.close()
+        super().tearDownClass()
+
+    def stored_orders_ptf(self, orders: dict, storage: str = 'collection') -> Portfolio:
+        ptf = stored_orders_ptf(self.mongo_client, orders, storage)
+        self.addCleanup(self.remove_ptf, ptf._id)
+        return ptf
+
+    def remove_ptf(self, ptf_id: ObjectId):
+        investments = self.mongo_client.investments
+        investments.portfolios.delete_one({'_id': ptf_id})
+        for collection in (investments.orders, investments.valuations, investments.snapshots):
+            collection.delete_many({'ptf_id': ptf_id})
+
+
+class OrderStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.mongo_client = mongomock.MongoClient()
+        self.store = OrderStore(self.mongo_client)
+        self.ptf_id = ObjectId()
+
+    def test_upsert_is_keyed_by_order_id(self):
+        orders = {'US0378331005': [Order('T212', 'MARKET', 1, False, 10, datetime(2021, 1, day), day, 'USD') for day in (4, 5, 6)]}
+        self.store.upsert(self.ptf_id, 'stocks', orders)
+        orders['US0378331005'][0].price = 11
+        self.store.upsert(self.ptf_id, 'stocks', orders) # a replayed page
+        self.assertEqual(self.store.order_ids(self.ptf_id), {4, 5, 6})
+
+        found = self.store.find(self.ptf_id, date_from=datetime(2021, 1, 5), order_fields=['order_id', 'price'])
+        self.assertEqual([order.order_id for order in found[('stocks', 'US0378331005')]], [5, 6])
+        self.assertEqual(self.store.find(self.ptf_id)[('stocks', 'US0378331005')][0].price, 11)
+
+    def test_migration_copies_again_after_a_concurrent_write(self):
+        ptf = stored_orders_ptf(self.mongo_client, {'US0378331005': [(1, 10, datetime(2021, 1, 4))]}, storage='embedded')
+        portfolios = self.mongo_client.investments.portfolios
+        update_one = portfolios.update_one
+
+        def switch_storage(filter, update):
+            if switch.call_count == 1: # a sync writes an order during the first copy
+                order = Codec.encode(Order('T212', 'MARKET', 2, False, 11, datetime(2021, 1, 5), 99, 'USD'))
+                update_one({'_id': ptf._id}, {'$push': {'stocks.0.orders': order}, '$inc': {'orders_version': 1}})
+                return mock.Mock(matched_count=0)
+            return mock.Mock(matched_count=1)
+
+        with mock.patch.object(portfolios, 'update_one', side_effect=switch_storage) as switch:
+            self.assertEqual(ptf.migrate_orders(), 2)
+        self.assertEqual(switch.call_args_list, [mock.call(
+            {'_id': ptf._id, 'orders_storage': {'$ne': 'collection'}, 'orders_version': version},
+            {'$set': {'orders_storage': 'collection', 'stocks.$[].orders': []}}) for version in (None, 1)])
+        self.assertEqual(ptf.orders_storage, 'collection')
+        self.assertEqual(ptf.stored_order_ids(), {1, 99})
+
+    def test_migration_gives_up_on_a_portfolio_always_written(self):
+        ptf = stored_orders_ptf(self.mongo_client, {'US0378331005': [(1, 10, datetime(2021, 1, 4))]}, storage='embedded')
+        with mock.patch.object(self.mongo_client.investments.portfolios, 'update_one', return_value=mock.Mock(matched_count=0)):
+            with self.assertRaises(OrdersMigrationError):
+                ptf.migrate_orders(max_attempts=2)
+
+
+class OrderStoreMongoTests(MongoTestCase):
+    def test_migration_empties_the_embedded_orders(self):
+        ptf = self.stored_orders_ptf({'US0378331005': [(1, 10, datetime(2021, 1, 4))], 'GB00BH4HKS39': [(2, 1, datetime(2021, 1, 5))]}, 'embedded')
+        self.assertEqual(ptf.migrate_orders(), 2)
+        doc = self.mongo_client.investments.portfolios.find_one({'_id': ptf._id})
+        self.assertEqual(doc['orders_storage'], 'collection')
+        self.assertEqual([stock['orders'] for stock in doc['stocks']], [[], []])
+        self.assertEqual(ptf.stored_order_ids(), {1, 2})
+
+
+class RateStoreTests(SimpleTestCase):
+    def test_rates_copied_from_the_fallback_database(self):
+        mongo_client = mongomock.MongoClient()
+        mongo_client.fx.rates.insert_many([{'base': 'EUR', 'quote': 'USD', 'date': f'2021-01-0{day}', 'rate': 1.2} for day in range(1, 8)])
+        mongo_client.fx.coverage.insert_one({'_id': 'EUR/USD', 'base': 'EUR', 'quote': 'USD', 'from': '2021-01-01', 'to': '2021-01-07'})
+        store = RateStore(mongo_client, database='investments', fallback='fx')
+        store.lookback = 0
+        rates = store.get_rates('EUR', ['USD'], '2021-01-02', '2021-01-06')
+        self.assertEqual(rates['USD'].tolist(), [1.2] * 5)
+        self.assertEqual(mongo_client.investments.rates.count_documents({}), 7)
+        self.assertIsNotNone(mongo_client.investments.coverage.find_one({'_id': 'EUR/USD'}))
+
+
+class PortfolioWriterTests(SimpleTestCase):
+    def test_orders_and_checkpoint_in_one_flush(self):
+        mongo_client = mongomock.MongoClient()
+        ptf = Portfolio(mongo_client, name='test', orders_storage='collection')
+        stock = ptf.add_security(Stock(isin='US0378331005', ticker='AAPL', t212_id='AAPL_US_EQ'))
+        stock.add_order(Order('T212', 'MARKET', 1, False, 10, datetime(2021, 1, 4), 1, 'USD'))
+        user_id = ObjectId()
+        mongo_client.users.users.insert_one({'_id': user_id})
+
+        writer = ptf.writer()
+        writer.upsert_orders('stocks', {stock.isin: stock.orders})
+        writer.set_sync('T212', {'cursor': 123}, user_id=user_id)
+        report = writer.flush()
+        self.assertTrue(all(op['status'] == 'ok' for op in report))
+
+        doc = mongo_client.investments.portfolios.find_one({'_id': ptf._id})
+        self.assertEqual([s['isin'] for s in doc['stocks']], ['US0378331005'])
+        self.assertEqual(doc['brokersSync']['T212']['cursor'], 123)
+        self.assertEqual(mongo_client.users.users.find_one({'_id': user_id})['brokersSync']['T212'], {'cursor': 123})
+        self.assertEqual(ptf.stored_order_ids(), {1})
+
+        writer = ptf.writer()
+        writer.upsert_orders('stocks', {stock.isin: stock.orders}) # the security header is only added once
+        writer.flush()
+        self.assertEqual(len(mongo_client.investments.portfolios.find_one({'_id': ptf._id})['stocks']), 1)
+
+    def test_order_dates_mark_the_valuations_stale(self):
+        ptf = Portfolio(mongomock.MongoClient(), name='test')
+        stock = ptf.add_security(Stock(isin='US0378331005', ticker='AAPL'))
+        writer = ptf.writer()
+        writer.upsert_orders('stocks', {stock.isin: [
+            Order('T212', 'MARKET', 1, False, 10, datetime(2021, 1, day, 15), day, 'USD') for day in (5, 4)]})
+        self.assertEqual(dict(writer._operations)['mark valuations stale'], UpdateOne(
+            {'_id': ptf._id, 'valuations.0': {'$exists': True}},
+            {'$min': {'valuations.$[].dirty_from': datetime(2021, 1, 4)}, '$inc': {'valuations.$[].version': 1}}))
+        self.assertEqual(dict(writer._operations)['mark snapshots stale'], UpdateOne(
+            {'_id': ptf._id}, {'$min': {'snapshots_stale_from': datetime(2021, 1, 4)}, '$inc': {'snapshots_version': 1}}))
+
+    def test_pushed_securities_mark_the_snapshots_stale(self):
+        ptf = Portfolio(mongomock.MongoClient(), name='test')
+        stock = Stock(isin='US0378331005', ticker='AAPL')
+        stock.add_order(Order('T212', 'MARKET', 1, False, 10, datetime(2021, 1, 5, 15), 1, 'USD'))
+        writer = ptf.writer()
+        writer.push_securities('stocks', [stock])
+        self.assertEqual([label for label, _ in writer._operations], ['push 1 stocks', 'mark valuations stale', 'mark snapshots stale'])
+        writer.flush()
+        self.assertEqual(ptf._mongo_client.investments.portfolios.find_one({'_id': ptf._id})['snapshots_stale_from'], datetime(2021, 1, 5))
+
+
+class SamplerTests(SimpleTestCase):
+    probas_req = {'tickers': ['AAPL', 'AMZN', 'MSFT'], 'min': [0.05, 0.1, 0.1], 'max': [0.5, 0.6, 0.3]}
+
+    def test_rows_sum_to_one_within_the_bounds(self):
+        for method in ('uniform', 'redistribute'):
+            weights = np.concatenate(list(Fmaths.iter_randoms_proba(self.probas_req, 1000, chunk_size=300, seed=1, dtype=np.float64, method=method)))
+            self.assertEqual(weights.shape, (1000, 3))
+            np.testing.assert_allclose(weights.sum(axis=1), 1)
+            self.assertTrue((weights >= np.array(self.probas_req['min']) - 1e-9).all())
+            self.assertTrue((weights <= np.array(self.probas_req['max']) + 1e-9).all())
+
+    def test_empty_batch(self):
+        frame = Fmaths.generate_randoms_proba(self.probas_req, 0)
+        self.assertEqual(frame.shape, (0, 3))
+        self.assertEqual(list(frame.columns), self.probas_req['tickers'])
+
+    def test_tight_bounds(self):
+        tight = {'tickers': [f'T{i}' for i in range(30)], 'max': [0.0345] * 30}
+        self.assertEqual(Fmaths.sampling_method(tight, seed=0), 'redistribute')
+        with self.assertRaises(ValueError): # uniform sampling stops instead of drawing forever
+            next(Fmaths.iter_randoms_proba(tight, 10, seed=0, method='uniform'))
+        with self.assertRaises(ValueError):
+            Fmaths.generate_randoms_proba({'tickers': ['A', 'B'], 'max': [0.4, 0.4]}, 10)
+
+
+class FrontierTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.frontier = EfficientFrontier(pd.DataFrame(rng.normal(0.0005, 0.01, (250, 3)), columns=['AAPL', 'AMZN', 'MSFT']))
+
+    def test_top_and_pareto(self):
+        result = self.frontier.search(size=5000, chunk_size=1000, top_k=10, seed=1)
+        self.assertEqual(result.evaluated, 5000)
+        self.assertEqual(len(result.top), 10)
+        self.assertTrue(result.top['sharpe'].is_monotonic_decreasing)
+        np.testing.assert_allclose(result.top[['AAPL', 'AMZN', 'MSFT']].sum(axis=1), 1)
+        self.assertTrue(result.pareto['volatility'].is_monotonic_increasing)
+        self.assertTrue(result.pareto['return'].is_monotonic_increasing)
+
+    def test_memory_budget_cuts_the_chunks(self):
+        budget = EfficientFrontier.CHUNK_ARRAYS * 3 * 8 * 100 # 100 rows of 3 float64 tickers
+        with mock.patch.object(Fmaths, 'iter_randoms_proba', wraps=Fmaths.iter_randoms_proba) as draws:
+            result = self.frontier.search(size=1000, chunk_size=1000, top_k=5, seed=1, memory_budget=budget)
+        self.assertEqual(result.evaluated, 1000)
+        self.assertEqual({call.args[1] for call in draws.call_args_list}, {100})
+
+
+class PriceStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = PriceStore(self.root)
+
+    def closes(self, values: dict) -> pd.Series:
+        return pd.Series(values.values(), index=pd.to_datetime(list(values)), dtype=float)
+
+    def test_append_only_after_the_last_date(self):
+        self.assertEqual(self.store.append('IE00B4L5Y983', self.closes({'2021-01-05': 2.0, '2021-01-04': 1.0}), 'USD'), 2)
+        self.assertEqual(self.store.append('IE00B4L5Y983', self.closes({'2021-01-05': 9.0, '2021-01-06': 3.0}), 'USD'), 1)
+        read = self.store.read('IE00B4L5Y983', '2021-01-05')
+        self.assertEqual(read.tolist(), [2.0, 3.0])
+        self.assertEqual(self.store.last_date('IE00B4L5Y983'), date(2021, 1, 6))
+        with self.assertRaises(PriceStoreError):
+            self.store.append('IE00B4L5Y983', self.closes({'2021-01-07': 4.0}), 'EUR')
+        self.assertTrue(self.store.read('UNKNOWN').empty)
+
+    def test_interrupted_append_is_cut(self):
+        self.store.append('IE00B4L5Y983', self.closes({'2021-01-04': 1.0}), 'USD')
+        with open(Path(self.root) / 'IE00B4L5Y983' / 'close.f8', 'ab') as file:
+            file.write(np.array([5.0], dtype='<f8').tobytes()[:5]) # a partial close without its date
+        self.assertEqual(self.store.read('IE00B4L5Y983').tolist(), [1.0])
+        self.store.append('IE00B4L5Y983', self.closes({'2021-01-05': 2.0}), 'USD')
+        self.assertEqual(self.store.read('IE00B4L5Y983').tolist(), [1.0, 2.0])
+
+    def test_refresh_skips_recent_fetches_and_survives_errors(self):
+        source = mock.Mock(side_effect=[(self.closes({'2021-01-04': 1.0}), 'USD'), RuntimeError('down')])
+        store = PriceStore(self.root, source=source)
+        securities = {'IE00B4L5Y983': 'IWDA.AS', 'US0378331005': 'AAPL'}
+        self.assertEqual(store.refresh(securities, '2021-01-01', '2021-01-08'), {'IE00B4L5Y983': 1})
+        self.assertEqual(store.refresh(securities, '2021-01-01', '2021-01-08'), {}) # both fetched less than refresh_ttl ago
+        self.assertEqual(source.call_count, 2)
+
+
+def patch_eur_usd(test: SimpleTestCase, rate: float = 1.25):
+    '''Constant EUR/USD rate for the test, without the rate store database'''
+    rates = RateStore(None)
+    days = pd.date_range('2020-12-01', '2021-06-30', freq='D')
+    rates._rates[('EUR', 'USD')] = pd.Series(rate, index=days)
+    rates._coverage[('EUR', 'USD')] = (days[0].date(), days[-1].date())
+    patch = mock.patch.object(ExchangeRate, 'store', rates)
+    patch.start()
+    test.addCleanup(patch.stop)
+
+
+class PtfValueTests(SimpleTestCase):
+    def setUp(self):
+        self.mongo_client = mongomock.MongoClient()
+        patch_eur_usd(self)
+        self.prices = PriceStore(tempfile.mkdtemp())
+        self.ptf = stored_orders_ptf(self.mongo_client, {'US0378331005': [
+            (10, 5, datetime(2021, 1, 5)), (5, 8, datetime(2021, 2, 3)), (-6, 9, datetime(2021, 3, 10))]})
+
+        # mongomock has no array filters: the valuation state updates using them are recorded instead (see PtfValueMongoTests)
+        portfolios = self.mongo_client.investments.portfolios
+        update_one = portfolios.update_one
+        self.state_updates = mock.Mock()
+        def record_array_filters(filter, update, array_filters=None, **kwargs):
+            if array_filters:
+                return self.state_updates(filter, update, array_filters=array_filters)
+            return update_one(filter, update, **kwargs)
+        patch = mock.patch.object(portfolios, 'update_one', record_array_filters)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def value(self, date_to: str) -> dict:
+        ptf = Portfolio(self.mongo_client, self.ptf._id)
+        ptf.load(lazy=True)
+        return get_ptf_value.get_ptf_value(ptf, date_to=date_to, store=self.prices)
+
+    def test_values_from_order_prices_then_closes(self):
+        values = self.value('2021-03-10')
+        self.assertEqual(values['2021-01-05'], 10 * 5 / 1.25)
+        self.assertEqual(values['2021-03-10'], 9 * 9 / 1.25)
+        self.prices.append('US0378331005', pd.Series([10.0], index=pd.to_datetime(['2021-03-01'])), 'USD')
+        values = self.value('2021-03-10') # the new close marks the days from it as stale
+        self.assertEqual(values['2021-03-01'], 15 * 10 / 1.25)
+        self.assertEqual(values['2021-02-28'], 15 * 8 / 1.25)
+
+    def test_partial_recompute_keeps_the_later_days_stale(self):
+        self.value('2021-03-10')
+        self.mongo_client.investments.portfolios.update_one({'_id': self.ptf._id}, {'$set': {'valuations.0.dirty_from': datetime(2021, 2, 1)}})
+        self.value('2021-02-15')
+        self.assertEqual(self.state_updates.call_args_list[-1], mock.call(
+            {'_id': self.ptf._id}, {'$set': {'valuations.$[v].dirty_from': datetime(2021, 2, 16)}},
+            array_filters=[{'v.currency': 'EUR', 'v.version': 0}]))
+
+    def test_stale_closes_fall_back_to_the_order_prices(self):
+        self.prices.append('US0378331005', pd.Series([20.0], index=pd.to_datetime(['2020-12-01'])), 'USD')
+        with self.assertLogs('myapp', 'WARNING') as logs:
+            values = self.value('2021-01-10')
+        self.assertEqual(values['2021-01-10'], 10 * 5 / 1.25)
+        self.assertIn('US0378331005: last close on 2020-12-01', logs.output[0])
+
+    def test_pence_quoted_closes_valued_in_pounds(self):
+        ptf = stored_orders_ptf(self.mongo_client, {'GB00BH4HKS39': [(10, 5, datetime(2021, 1, 5))]})
+        self.prices.append('GB00BH4HKS39', pd.Series([150.0], index=pd.to_datetime(['2021-01-04'])), 'GBX')
+        values = get_ptf_value.get_ptf_value(ptf, currency='GBP', date_to='2021-01-06', store=self.prices)
+        self.assertEqual(values['2021-01-06'], 10 * 150 / 100)
+
+    def test_default_store_created_on_first_use(self):
+        root = Path(tempfile.mkdtemp()) / 'prices'
+        get_ptf_value.get_price_store.cache_clear()
+        self.addCleanup(get_ptf_value.get_price_store.cache_clear)
+        with self.settings(PRICE_STORE_DIR=root):
+            store = get_ptf_value.get_price_store()
+            self.assertIs(get_ptf_value.get_price_store(), store)
+        self.assertEqual(store.root, root)
+
+
+class PtfValueMongoTests(MongoTestCase):
+    def setUp(self):
+        patch_eur_usd(self)
+        self.prices = PriceStore(tempfile.mkdtemp())
+        self.ptf = self.stored_orders_ptf({'US0378331005': [
+            (10, 5, datetime(2021, 1, 5)), (5, 8, datetime(2021, 2, 3)), (-6, 9, datetime(2021, 3, 10))]})
+
+    def value(self, date_to: str) -> dict:
+        ptf = Portfolio(self.mongo_client, self.ptf._id)
+        ptf.load(lazy=True)
+        return get_ptf_value.get_ptf_value(ptf, date_to=date_to, store=self.prices)
+
+    def state(self) -> dict:
+        return self.mongo_client.investments.portfolios.find_one({'_id': self.ptf._id})['valuations'][0]
+
+    def test_partial_recompute_keeps_the_later_days_stale(self):
+        self.value('2021-03-10')
+        self.mongo_client.investments.portfolios.update_one({'_id': self.ptf._id}, {'$set': {'valuations.0.dirty_from': datetime(2021, 2, 1)}})
+        self.value('2021-02-15')
+        self.assertEqual(self.state()['dirty_from'], datetime(2021, 2, 16))
+        self.assertEqual(self.value('2021-03-10')['2021-03-10'], 9 * 9 / 1.25)
+        self.assertNotIn('dirty_from', self.state())
+
+    def test_orders_written_mark_the_valuations_stale(self):
+        self.value('2021-03-10')
+        ptf = Portfolio(self.mongo_client, self.ptf._id)
+        ptf.load()
+        ptf.upsert_orders('stocks', {'US0378331005': [Order('T212', 'MARKET', 1, False, 6, datetime(2021, 2, 10, 15), 10, 'USD')]})
+        self.assertEqual(self.state()['dirty_from'], datetime(2021, 2, 10))
+        self.assertEqual(self.value('2021-03-10')['2021-03-10'], 10 * 9 / 1.25)
+
+
+class SnapshotStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.mongo_client = mongomock.MongoClient()
+        self.ptf = stored_orders_ptf(self.mongo_client, {'US0378331005': [
+            (10, 5, datetime(2021, 1, 5)), (5, 8, datetime(2021, 2, 3)), (-6, 9, datetime(2021, 3, 10)), (2, 10, datetime(2021, 4, 2))]})
+        self.store = SnapshotStore(self.mongo_client)
+
+    def test_month_end_snapshots_keep_the_average_cost(self):
+        self.assertEqual(self.store.update(self.ptf, datetime(2021, 1, 5), until=datetime(2021, 4, 15)), 3)
+        day, positions = self.store.nearest(self.ptf._id, datetime(2021, 3, 31))
+        self.assertEqual(day, datetime(2021, 3, 31))
+        self.assertAlmostEqual(positions['US0378331005']['quantity'], 9)
+        self.assertAlmostEqual(positions['US0378331005']['cost'], 90 * 9 / 15)
+
+    def test_positions_replay_the_orders_after_the_snapshot(self):
+        self.store.update(self.ptf, datetime(2021, 1, 5), until=datetime(2021, 4, 15))
+        self.assertAlmostEqual(self.store.positions(self.ptf, datetime(2021, 4, 2))['US0378331005']['quantity'], 11)
+        snapshot_day, opening, orders = self.store.window(self.ptf, datetime(2021, 3, 15), datetime(2021, 4, 30))
+        self.assertEqual(snapshot_day, datetime(2021, 2, 28))
+        self.assertEqual(orders['quantity'].tolist(), [-6, 2])
+
+    def test_backdated_order_rebuilds_the_later_snapshots(self):
+        portfolios = self.mongo_client.investments.portfolios
+        self.store.update(self.ptf, datetime(2021, 1, 5))
+        self.assertNotIn('snapshots_stale_from', portfolios.find_one({'_id': self.ptf._id}))
+        self.ptf.upsert_orders('stocks', {'US0378331005': [Order('T212', 'MARKET', 3, False, 6, datetime(2021, 1, 20, 15), 10, 'USD')]})
+        self.assertEqual(portfolios.find_one({'_id': self.ptf._id})['snapshots_stale_from'], datetime(2021, 1, 20))
+        self.assertAlmostEqual(self.store.positions(self.ptf, datetime(2021, 4, 2))['US0378331005']['quantity'], 14)
+        self.assertAlmostEqual(self.store.nearest(self.ptf._id, datetime(2021, 3, 31))[1]['US0378331005']['quantity'], 12)
+        self.assertNotIn('snapshots_stale_from', portfolios.find_one({'_id': self.ptf._id}))
+
+    def test_mark_kept_when_orders_are_written_during_the_rebuild(self):
+        portfolios = self.mongo_client.investments.portfolios
+        rebuild = SnapshotStore._rebuild
+        def write_during_the_rebuild(store, ptf, *month_ends):
+            portfolios.update_one({'_id': ptf._id}, {'$inc': {'snapshots_version': 1}})
+            return rebuild(store, ptf, *month_ends)
+        with mock.patch.object(SnapshotStore, '_rebuild', write_during_the_rebuild):
+            self.store.update(self.ptf, datetime(2021, 1, 5))
+        self.assertEqual(portfolios.find_one({'_id': self.ptf._id})['snapshots_stale_from'], datetime(2021, 1, 5))
+
+
+SEC_SUBMISSIONS = {'cik': '66740', 'name': '3M CO', 'filings': {
+    'recent': {
+        'form': ['10-K', '4', '8-K', '10-Q'],
+        'accessionNumber': ['0000066740-24-000016', '0000066740-24-000020', '0000066740-24-000030', '0000066740-23-000090'],
+        'reportDate': ['2023-12-31', '2024-02-08', '', '2023-09-30'],
+        'filingDate': ['2024-02-07', '2024-02-09', '2024-03-01', '2023-10-24'],
+        'primaryDocument': ['mmm-20231231.htm', 'xslF345X05/wf-form4.xml', 'mmm-8k.htm', 'mmm-20230930.htm'],
+        'items': ['', '', '2.02', ''],
+    },
+    'files': [{'name': 'CIK0000066740-submissions-001.json', 'filingFrom': '1994-01-01', 'filingTo': '2015-06-01'}]}}
+
+
+class SecCacheTests(SimpleTestCase):
+    def test_cik_map_from_a_local_file(self):
+        path = Path(tempfile.mkdtemp()) / 'company_tickers.json'
+        path.write_text(json.dumps({'0': {'cik_str': 66740, 'ticker': 'MMM', 'title': '3M CO'}}))
+        cik_map = sec.CikMap(path)
+        self.assertEqual(cik_map.get('mmm'), '66740')
+        self.assertIsNone(cik_map.get('XXXX'))
+        cik_map.add('XXXX', '1')
+        self.assertEqual(cik_map.get('XXXX'), '1')
+
+    def test_failed_load_retried_after_a_short_delay(self):
+        path = Path(tempfile.mkdtemp()) / 'company_tickers.json'
+        cik_map = sec.CikMap(path, retry_after=0.05)
+        with self.assertLogs('myapp', 'WARNING'):
+            self.assertIsNone(cik_map.get('MMM'))
+        path.write_text(json.dumps({'0': {'cik_str': 66740, 'ticker': 'MMM', 'title': '3M CO'}}))
+        self.assertIsNone(cik_map.get('MMM')) # not retried before retry_after
+        time.sleep(0.06)
+        self.assertEqual(cik_map.get('MMM'), '66740')
+
+    def test_lookups_not_blocked_by_a_refresh(self):
+        release = threading.Event()
+        downloads = []
+        def download(url, headers, timeout):
+            downloads.append(url)
+            if len(downloads) > 1: # the refresh hangs until released
+                release.wait(5)
+            return mock.Mock(json=lambda: {'0': {'cik_str': 66740, 'ticker': 'MMM', 'title': '3M CO'}})
+        cik_map = sec.CikMap(ttl=0)
+        with mock.patch.object(sec, 'sec_get', download):
+            self.assertEqual(cik_map.get('MMM'), '66740')
+            refresh = threading.Thread(target=cik_map.get, args=('MMM',))
+            refresh.start()
+            time.sleep(0.05)
+            start = time.monotonic()
+            self.assertEqual(cik_map.get('MMM'), '66740') # served from the previous map
+            self.assertLess(time.monotonic() - start, 1)
+            release.set()
+            refresh.join()
+        self.assertEqual(len(downloads), 2)
+
+    def test_cache_keeps_the_parsed_columns_and_revalidates(self):
+        cache = sec.SubmissionsCache(ttl=0.05, maxsize=1)
+        data = cache.put('CIK0000066740', SEC_SUBMISSIONS, {'etag': '"abc"'})
+        self.assertNotIn('name', data)
+        self.assertNotIn('items', data['filings']['recent'])
+        self.assertEqual(sec.parse_sec_data(data, '66740'), sec.parse_sec_data(SEC_SUBMISSIONS, '66740'))
+        self.assertIs(cache.get('CIK0000066740')[0], data)
+        time.sleep(0.06)
+        self.assertEqual(cache.get('CIK0000066740'), (None, {'If-None-Match': '"abc"'}))
+        self.assertIs(cache.revalidated('CIK0000066740'), data)
+        cache.put('CIK0000000001', SEC_SUBMISSIONS, {})
+        self.assertEqual(cache.get('CIK0000066740'), (None, {})) # evicted by maxsize
+
+    def test_requests_paced_at_the_sec_rate(self):
+        response = mock.Mock(status_code=200, headers={})
+        limiter = RateLimiter(rate=20)
+        session = mock.Mock(get=mock.Mock(return_value=response))
+        client = mock.Mock(get=mock.AsyncMock(return_value=response))
+        with mock.patch.object(sec, 'sec_limiter', limiter), mock.patch.object(sec, 'get_session', return_value=session), \
+             mock.patch.object(sec, 'get_async_client', return_value=client):
+            start = time.monotonic()
+            for _ in range(5):
+                sec.sec_get(sec.TICKERS_URL, sec.HEADERS)
+            self.assertGreaterEqual(time.monotonic() - start, 4 / 20 * 0.9)
+
+            async def calls():
+                for _ in range(5):
+                    await sec.asec_get(sec.TICKERS_URL, sec.HEADERS)
+            start = time.monotonic()
+            asyncio.run(calls())
+            self.assertGreaterEqual(time.monotonic() - start, 4 / 20 * 0.9)
+
+
+class SecParserTests(SimpleTestCase):
+    def test_parse_filters_forms_and_dates(self):
+        result = sec.parse_sec_data(SEC_SUBMISSIONS, '66740', fromDate='2023-10-01')
+        self.assertEqual(result['10-K'], {'31/12/2023': ['https://www.sec.gov/Archives/edgar/data/66740/000006674024000016/mmm-20231231.htm']})
+        self.assertEqual(list(result['8-K']), ['01/03/2024']) # no report date: filing date
+        self.assertEqual(result['10-Q'], {})
+        only_4 = sec.parse_sec_data(SEC_SUBMISSIONS, '66740', formType='4', toDate=date(2024, 12, 31))
+        self.assertEqual(list(only_4), ['4'])
+        self.assertEqual(list(only_4['4']), ['08/02/2024'])
+        with self.assertRaises(sec.SECDataError):
+            sec.parse_sec_data(SEC_SUBMISSIONS, '66740', formType='13f')
+
+    def test_archives_only_when_the_window_starts_before_recent(self):
+        self.assertEqual(sec.archive_names(SEC_SUBMISSIONS, '2023-01-01'), [])
+        self.assertEqual(sec.archive_names(SEC_SUBMISSIONS, '2010-01-01'), ['CIK0000066740-submissions-001.json'])
+        self.assertEqual(sec.archive_names(SEC_SUBMISSIONS, '2020-01-01'), [])
+
+
+class IterOrdersTests(SimpleTestCase):
+    def setUp(self):
+        self.api = FakeT212Api()
+        self.api.add_orders(120, datetime(2022, 6, 1), first_id=1000)
+        patch = mock.patch.object(Trading212, '_handle_request', staticmethod(self.api.handle_request))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_pages_and_resume_cursor(self):
+        pages = list(Trading212('key').iter_orders(max_pages=2))
+        self.assertEqual([len(page.orders) for page in pages], [50, 50])
+        self.assertEqual(pages[0].orders[0]['t212_id'], 'AAPL_US_EQ') # renamed like the instruments
+        rest = list(Trading212('key').iter_orders(cursor=pages[-1].cursor))
+        self.assertEqual(sum(len(page.orders) for page in rest), 20)
+        self.assertIsNone(rest[-1].cursor)
@@ -1,10 +1,20 @@
 from django.urls import path
-from . import views
+from . import views, async_views
 
 app_name = 'api'
 
 urlpatterns =[
     path('sec-urls/', views.get_sec_files, name='securls'),
+    path('sec-urls/batch/', views.get_sec_files_batch, name='securls_batch'),
     path('update-t212/', views.update_t212, name='upt212'),
-    path('stock-history/', views.stock_history, name='stock_history')
+    path('update-t212/<str:job_id>/', views.update_t212_status, name='upt212_status'),
+    path('stock-history/', views.stock_history, name='stock_history'),
+    path('ptf-value/', views.ptf_value, name='ptf_value'),
+
+    # async endpoints, served under ASGI
+    path('async/sec-urls/', async_views.get_sec_files, name='securls_async'),
+    path('async/sec-urls/batch/', async_views.get_sec_files_batch, name='securls_batch_async'),
+    path('async/update-t212/', async_views.update_t212, name='upt212_async'),
+    path('async/update-t212/<str:job_id>/', async_views.update_t212_status, name='upt212_status_async'),
+    path('async/stock-history/', async_views.stock_history, name='stock_history_async'),
     ]
\ No newline at end of file
@@ -1,14 +1,17 @@
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
-from .serializers import SecSearchSerializer
+from .serializers import SecSearchSerializer, SecBatchSearchSerializer
 from typing import TYPE_CHECKING
 import logging
 
 import ipdb
 
-from .methods.get_sec_urls import get_sec_urls, SECDataError
-from .methods.updateT212 import updateT212
+from .methods.get_sec_urls import get_sec_urls, get_sec_urls_batch, SECDataError
+from .methods.updateT212 import updateT212, t212_sync_jobs
+from .methods.get_ptf_value import get_ptf_value
+from mylibs.jobQueue import job_status, job_http_status
+from bson import ObjectId
 
 from classes.users import User
 from classes.portfolio import Portfolio
@@ -34,12 +37,33 @@ def get_sec_files(request: 'HttpRequest'):
             return Response({'error': 'An unexpected error occurred.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+@api_view(['GET'])
+def get_sec_files_batch(request: 'HttpRequest'):
+    serializer = SecBatchSearchSerializer(data=request.GET)
+    if serializer.is_valid():
+        data = dict(serializer.validated_data)
+        try:
+            result = get_sec_urls_batch(data.pop('tickers'), **data)
+            return Response(result, status=status.HTTP_200_OK)
+        except Exception as e:
+            logger.error(e)
+            return Response({'error': 'An unexpected error occurred.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
 @api_view(['GET'])
 def update_t212(request: 'HttpRequest'):
     client_id = request.COOKIES['client_id']
     logger.info(f'Update_t212 request from {client_id}')
-    result = updateT212(client_id)
-    return Response(result, status=status.HTTP_200_OK)
+    job_id, created = t212_sync_jobs.submit(client_id, updateT212, client_id)
+    return Response({'job_id': str(job_id), 'created': created}, status=status.HTTP_202_ACCEPTED)
+
+@api_view(['GET'])
+def update_t212_status(request: 'HttpRequest', job_id: str):
+    client_id = request.COOKIES['client_id']
+    job = t212_sync_jobs.get(job_id, user_id=client_id) if ObjectId.is_valid(job_id) else None
+    if not job:
+        return Response({'error': 'Job not found'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(job_status(job), status=job_http_status(job))
 
 @api_view(['GET'])
 def stock_history(request: 'HttpRequest'):
@@ -48,8 +72,18 @@ def stock_history(request: 'HttpRequest'):
     user.connect_user(fast_connect=True)
     # ipdb.set_trace()
     ptf = Portfolio(mongo_client, user.ptf_ids[0])
-    ptf.load()
-    result = ptf.stock_history()
+    ptf.load(lazy=True) # orders are aggregated server side
+    result = ptf.stock_history(server_side=True)
     print(result)
     return Response(result, status=status.HTTP_200_OK)
 
+@api_view(['GET'])
+def ptf_value(request: 'HttpRequest'):
+    client_id = request.COOKIES['client_id']
+    user = User(client_id, mongo_client=mongo_client)
+    user.connect_user(fast_connect=True)
+    ptf = Portfolio(mongo_client, user.ptf_ids[0])
+    ptf.load(lazy=True) # orders are read from the nearest snapshot on
+    result = get_ptf_value(ptf, currency=request.GET.get('currency', 'EUR'),
+                           date_from=request.GET.get('date_from'), date_to=request.GET.get('date_to'))
+    return Response(result, status=status.HTTP_200_OK)
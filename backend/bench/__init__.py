@@ -0,0 +1 @@
+'''Benchmarks, run from the backend folder: python -m bench.<module>'''
@@ -0,0 +1,43 @@
+# benchmark of the codec against GeneralMethods: python -m bench.codec
+import gc
+from time import perf_counter
+from datetime import datetime, timedelta
+
+from classes.codec import Codec
+from classes.portfolio import Portfolio
+from classes.securities import Stock, Order, Fee
+
+
+def bench(label: str, func, repeat: int = 3) -> float:
+    best = min(_time(func) for _ in range(repeat))
+    print(f'{label:<40} {best * 1000:8.1f} ms')
+    return best
+
+def _time(func) -> float:
+    gc.collect()
+    gc.disable() # collections triggered by the allocations would dominate both sides
+    start = perf_counter()
+    func()
+    elapsed = perf_counter() - start
+    gc.enable()
+    return elapsed
+
+
+if __name__ == '__main__':
+    ptf = Portfolio(name='benchmark')
+    for i in range(200):
+        stock = Stock(ticker=f'T{i}', isin=f'ISIN{i:08}', t212_id=f'T{i}_US_EQ')
+        for j in range(250):
+            fees = [Fee('currencyConversionFee', 0.15)] + ([Fee('stampDuty', 0.5)] if j % 4 == 0 else [])
+            stock.orders.append(Order('T212', 'MARKET', 1.5, False, 100.0, datetime(2020, 1, 1) + timedelta(hours=j), i * 1000 + j, 'USD', fees))
+        ptf.stocks.append(stock)
+    nb_orders = sum(len(stock.orders) for stock in ptf.stocks)
+
+    doc = {'_id': ptf._id, 'name': ptf.name, 'stocks': Codec.encode_many(ptf.stocks), 'bonds': []}
+    print(f'{nb_orders} orders with fees in {len(ptf.stocks)} stocks')
+    old_encode = bench('GeneralMethods.to_dict', lambda: ptf.to_dict(ptf.stocks))
+    new_encode = bench('Codec.encode_many', lambda: Codec.encode_many(ptf.stocks))
+    old_decode = bench('GeneralMethods.from_dict', lambda: Portfolio.from_dict(Portfolio(), doc, classes=[Portfolio, Stock, Order, Fee]))
+    new_decode = bench('Codec.decode_into', lambda: Codec.decode_into(Portfolio(), doc))
+    assert Codec.encode_many(Codec.decode_into(Portfolio(), doc).stocks) == doc['stocks']
+    print(f'encode speedup x{old_encode / new_encode:.1f} - decode speedup x{old_decode / new_decode:.1f}')
@@ -0,0 +1,25 @@
+# efficient frontier benchmark: python -m bench.finance [portfolios] [tickers]
+import sys
+import tracemalloc
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from classes.finance import EfficientFrontier
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    rng = np.random.default_rng(0)
+    daily_returns = pd.DataFrame(rng.normal(0.0004, 0.015, size=(1000, n)), columns=[f'T{i}' for i in range(n)])
+    frontier = EfficientFrontier(daily_returns, risk_free=0.02)
+
+    tracemalloc.start()
+    start = perf_counter()
+    result = frontier.search({'tickers': frontier.tickers, 'max': [0.25] * n}, size=size, seed=1)
+    elapsed = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    print(f'{size} portfolios of {n} tickers in {elapsed:.2f}s ({size / elapsed:,.0f}/s), peak memory {peak / 2**20:.0f} MB')
+    print(f'best sharpe {result.top["sharpe"].iloc[0]:.3f}, {len(result.pareto)} portfolios on the frontier')
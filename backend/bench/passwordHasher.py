@@ -0,0 +1,30 @@
+# login throughput benchmark: python -m bench.passwordHasher [rounds] [concurrent logins]
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from typing import Callable
+
+import bcrypt
+
+from mylibs.passwordHasher import PasswordHasher
+
+
+def bench(label: str, login: Callable[[], bool], logins: int, request_workers: int = 32):
+    with ThreadPoolExecutor(max_workers=request_workers) as requests_pool: # the web server workers
+        start = perf_counter()
+        assert all(requests_pool.map(lambda _: login(), range(logins)))
+        elapsed = perf_counter() - start
+    print(f'{label:<32} {elapsed:7.2f}s  {logins / elapsed:7.1f} logins/s')
+
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    logins = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    stored = bcrypt.hashpw(b'password', bcrypt.gensalt(rounds=rounds))
+    print(f'{logins} concurrent logins, bcrypt rounds {rounds}, {os.cpu_count()} cpus')
+
+    bench('inline in request threads', lambda: bcrypt.checkpw(b'password', stored), logins)
+    for workers in sorted({1, 2, os.cpu_count() or 1}):
+        hasher = PasswordHasher(rounds=rounds, max_workers=workers)
+        bench(f'pool of {workers} thread(s)', lambda: hasher.verify('password', stored), logins)
@@ -0,0 +1,83 @@
+from operator import attrgetter
+from typing import Type, Dict, Any, List, Tuple, Iterable
+
+
+class Plan():
+    '''Field plan of a class, compiled once from its `_schema`'''
+    __slots__ = ('cls', 'new', 'names', 'defaults', 'getter', 'nested', 'setters')
+
+    def __init__(self, cls: Type):
+        self.cls = cls
+        self.defaults: Tuple[Tuple[str, Any], ...] = tuple(
+            (name, default) for name, default in cls._schema.items() if not isinstance(default, list))
+        self.nested: Tuple[Tuple[str, 'Plan'], ...] = ()
+        self.names = names = tuple(name for name, _ in self.defaults)
+        getter = attrgetter(*names) if names else (lambda obj: ())
+        # attrgetter returns a bare value instead of a tuple for a single name
+        self.getter = (lambda obj: (getter(obj),)) if len(names) == 1 else getter
+        # slots based classes have no __dict__ to update: their slot descriptors are called directly
+        slotted = '__dict__' not in dir(cls) and hasattr(cls, '__slots__')
+        self.setters = {name: getattr(cls, name).__set__ for name in cls._schema} if slotted else None
+        # slots hold only the schema fields: instances skip __init__. Others are built by their constructor,
+        # which sets the instance attributes missing from the schema (e.g. the mongo client of a Security)
+        self.new = (lambda: cls.__new__(cls)) if slotted else cls
+
+    def encode(self, obj) -> dict:
+        doc = dict(zip(self.names, self.getter(obj)))
+        for name, plan in self.nested:
+            doc[name] = [plan.encode(item) for item in getattr(obj, name)]
+        return doc
+
+    def decode(self, doc: dict, obj=None):
+        if obj is None:
+            obj = self.new()
+        get = doc.get
+        setters = self.setters
+        if setters is not None:
+            for name, default in self.defaults:
+                setters[name](obj, get(name, default))
+            for name, plan in self.nested:
+                setters[name](obj, [plan.decode(item) for item in get(name) or ()])
+        else:
+            values = {name: get(name, default) for name, default in self.defaults}
+            for name, plan in self.nested:
+                values[name] = [plan.decode(item) for item in get(name) or ()]
+            obj.__dict__.update(values)
+        return obj
+
+
+class Codec():
+    '''
+    Schema driven BSON codec for the persisted classes (Portfolio, Stock, Bond, Order, Fee).
+
+    Each class declares its persisted fields in `_schema`: a `[Cls]` value is a list of nested `Cls`,
+    any other value is the default of a plain field. Field plans are compiled once per class, then
+    documents are encoded and decoded in a single pass, without the introspection of GeneralMethods.to_dict/from_dict.
+    Keys missing from `_schema` are ignored.
+    '''
+    _plans: Dict[Type, Plan] = {}
+
+    @classmethod
+    def plan(cls, klass: Type) -> Plan:
+        plan = cls._plans.get(klass)
+        if plan is None:
+            plan = cls._plans[klass] = Plan(klass)
+            plan.nested = tuple((name, cls.plan(default[0])) for name, default in klass._schema.items() if isinstance(default, list))
+        return plan
+
+    @classmethod
+    def encode(cls, obj) -> dict:
+        return cls.plan(type(obj)).encode(obj)
+
+    @classmethod
+    def encode_many(cls, objs: Iterable) -> List[dict]:
+        return [cls.plan(type(obj)).encode(obj) for obj in objs]
+
+    @classmethod
+    def decode(cls, klass: Type, doc: dict):
+        return cls.plan(klass).decode(doc)
+
+    @classmethod
+    def decode_into(cls, obj, doc: dict):
+        '''Fill an existing instance, e.g. a Portfolio loading its own document'''
+        return cls.plan(type(obj)).decode(doc, obj)
@@ -1,11 +1,17 @@
+import os
 import pandas as pd
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator, Literal, Tuple, Optional, List
 
 class Fmaths():
     @staticmethod
-    def generate_randoms_proba(probas_req: dict, arraysize=1, seed: int | None = None) -> pd.DataFrame:
+    def generate_randoms_proba(probas_req: dict, arraysize=1, seed: int | None = None, dtype=np.float32) -> pd.DataFrame:
         """
         Generate random probability distributions given specified minimum and maximum bounds for each ticker.
+        Every row sums to 1 and respects the bounds (see `iter_randoms_proba` for large batches).
 
         **Example usage:**
         >>> probas_req = {
@@ -16,22 +22,230 @@ class Fmaths():
         >>> result = generate_randoms_proba(probas_req, 300)
         >>> print(result)
         """
-        def _weights_calc(min_probs, max_probs, n, seed: int | None = None):
-            random_values = np.random.default_rng(seed).random(size=(arraysize, n), dtype=np.float32)
-            weights = min_probs + max_probs * random_values
-            weights /= weights.sum(axis=1, keepdims=True)
-            return weights
-        
+        chunks = list(Fmaths.iter_randoms_proba(probas_req, arraysize, chunk_size=max(arraysize, 1), seed=seed, dtype=dtype))
+        weights = np.concatenate(chunks) if chunks else np.empty((0, len(probas_req['tickers'])), dtype=dtype)
+        return pd.DataFrame(weights, columns=probas_req['tickers'])
+
+    @staticmethod
+    def iter_randoms_proba(probas_req: dict, size: int, chunk_size: int = 100_000, seed: int | None = None, dtype=np.float32,
+                           method: Literal['auto', 'uniform', 'redistribute'] = 'auto') -> Iterator[np.ndarray]:
+        """
+        Stream `size` random weight vectors, by arrays of at most `chunk_size` rows, so memory stays bounded whatever `size`.
+
+        Weights are drawn as `min + (1 - sum(min)) * y`, with `y` uniform on the simplex (normalized exponentials).
+        - 'uniform': rows of `y` exceeding the rescaled max bounds are rejected, so weights are uniform on the constrained simplex.
+        - 'redistribute': the excess above the bounds is spread over the other tickers in proportion to their room left.
+          Always valid in one pass, but no longer exactly uniform.
+        - 'auto': 'uniform' unless less than 5% of the draws would be accepted.
+
+        **Example usage:**
+        >>> for weights in Fmaths.iter_randoms_proba(probas_req, 10_000_000, chunk_size=500_000):
+        >>>     evaluate(weights)
+        """
+        min_probs, caps, spread = Fmaths._bounds(probas_req, dtype)
+        rng = np.random.default_rng(seed)
+        n = len(min_probs)
+        if method == 'auto':
+            method = Fmaths.sampling_method(probas_req, rng, dtype)
+
+        produced = 0
+        while produced < size:
+            rows = min(chunk_size, size - produced)
+            if spread <= 0:
+                y = np.zeros((rows, n), dtype=dtype)
+            elif method == 'uniform':
+                y = Fmaths._uniform_simplex(rng, rows, caps, dtype)
+            else:
+                y = Fmaths._redistributed_simplex(rng, rows, caps, dtype)
+            y *= spread
+            y += min_probs
+            produced += rows
+            yield y
+
+    @staticmethod
+    def sampling_method(probas_req: dict, seed: int | np.random.Generator | None = None, dtype=np.float32) -> Literal['uniform', 'redistribute']:
+        '''The method picked by `iter_randoms_proba(method='auto')`: 'uniform' unless less than 5% of the draws would be accepted'''
+        caps = Fmaths._bounds(probas_req, dtype)[1]
+        return 'uniform' if Fmaths._acceptance(np.random.default_rng(seed), caps, dtype) >= 0.05 else 'redistribute'
+
+    @staticmethod
+    def _bounds(probas_req: dict, dtype) -> Tuple[np.ndarray, np.ndarray, float]:
+        '''min bounds, max bounds rescaled on the simplex of `y`, and the share of weight left above the min bounds'''
         n = len(probas_req['tickers'])
         min_probs = probas_req.get('min', None)
         max_probs = probas_req.get('max', None)
-        if not min_probs:
-            min_probs = np.zeros(n)
-        if not max_probs:
-            max_probs = np.ones(n)
-        if sum(min_probs) > 1:
+        min_probs = np.asarray(min_probs if min_probs is not None and len(min_probs) else np.zeros(n), dtype=np.float64)
+        max_probs = np.asarray(max_probs if max_probs is not None and len(max_probs) else np.ones(n), dtype=np.float64)
+        if min_probs.shape != (n,) or max_probs.shape != (n,):
+            raise ValueError("min and max probabilities must have one value per ticker")
+        if (min_probs < 0).any() or (min_probs > max_probs).any():
+            raise ValueError("Min probabilities must be positive and inferior to max probabilities")
+        if min_probs.sum() > 1:
             raise ValueError("Sum of min probabilities must be inferior to 1")
-        elif sum(max_probs) < 1:
-            raise ValueError("Sum of max probabilities must be superior to 1")  
-        weights = _weights_calc(min_probs=min_probs, max_probs=max_probs, n=n, seed=seed)
-        return pd.DataFrame(weights, columns=probas_req['tickers'])
\ No newline at end of file
+        elif max_probs.sum() < 1:
+            raise ValueError("Sum of max probabilities must be superior to 1")
+        spread = 1 - min_probs.sum()
+        caps = np.minimum((max_probs - min_probs) / spread, 1) if spread > 0 else np.ones(n)
+        return min_probs.astype(dtype), caps.astype(dtype), float(spread)
+
+    @staticmethod
+    def _simplex(rng: np.random.Generator, rows: int, n: int, dtype) -> np.ndarray:
+        y = rng.standard_exponential(size=(rows, n), dtype=dtype)
+        y /= y.sum(axis=1, keepdims=True)
+        return y
+
+    @staticmethod
+    def _acceptance(rng: np.random.Generator, caps: np.ndarray, dtype, sample: int = 10_000) -> float:
+        if (caps >= 1).all():
+            return 1.0
+        return float((Fmaths._simplex(rng, sample, len(caps), dtype) <= caps).all(axis=1).mean())
+
+    @staticmethod
+    def _uniform_simplex(rng: np.random.Generator, rows: int, caps: np.ndarray, dtype) -> np.ndarray:
+        if (caps >= 1).all():
+            return Fmaths._simplex(rng, rows, len(caps), dtype)
+        out = np.empty((rows, len(caps)), dtype=dtype)
+        filled = 0
+        acceptance = 1.0
+        total_draws = 0
+        while filled < rows:
+            # draws sized on the observed acceptance, capped so one draw never exceeds a few chunks in memory
+            draws = min(int((rows - filled) / acceptance * 1.1) + 16, 4 * rows + 16)
+            y = Fmaths._simplex(rng, draws, len(caps), dtype)
+            valid = (y <= caps).all(axis=1)
+            total_draws += draws
+            # counted over every draw of the chunk, as small chunks draw little at a time
+            if total_draws >= 100_000 and filled + valid.sum() < total_draws * 1e-4:
+                raise ValueError("Bounds too tight for uniform sampling, use method='redistribute'")
+            acceptance = max(valid.mean(), 1e-4)
+            accepted = y[valid][:rows - filled]
+            out[filled:filled + len(accepted)] = accepted
+            filled += len(accepted)
+        return out
+
+    @staticmethod
+    def _redistributed_simplex(rng: np.random.Generator, rows: int, caps: np.ndarray, dtype) -> np.ndarray:
+        y = Fmaths._simplex(rng, rows, len(caps), dtype)
+        excess = np.maximum(y - caps, 0).sum(axis=1, keepdims=True)
+        np.minimum(y, caps, out=y)
+        room = caps - y
+        # sum(room) >= excess because sum(caps) >= 1, so nobody is pushed above its cap
+        y += room * (excess / np.maximum(room.sum(axis=1, keepdims=True), np.finfo(dtype).tiny))
+        return y
+
+
+@dataclass
+class FrontierResult():
+    top: pd.DataFrame # best `top_k` portfolios on the search key: one weight column per ticker, then return, volatility, sharpe
+    pareto: pd.DataFrame # portfolios not dominated in (higher return, lower volatility), by increasing volatility
+    evaluated: int
+
+
+class EfficientFrontier():
+    """
+    Monte-Carlo efficient frontier over the tickers of a return matrix (one column per ticker, one row per period).
+
+    Mean returns and the covariance matrix are computed once; each batch of weights W is then scored with matrix products:
+    returns W @ mu, volatilities sqrt(rowsum((W @ cov) * W)). Batches are generated and scored on a thread pool
+    (numpy releases the GIL in both), and only the running top-k and Pareto set are kept, so memory depends on `chunk_size`, not `size`.
+
+    **Example usage:**
+    >>> frontier = EfficientFrontier(daily_returns, risk_free=0.02)
+    >>> result = frontier.search({'tickers': ['AAPL', 'AMZN', 'MSFT'], 'max': [0.5, 0.5, 0.5]}, size=10_000_000)
+    >>> print(result.top.head(), result.pareto)
+    """
+    CHUNK_ARRAYS = 6 # chunk x tickers arrays alive while a chunk is scored: draws, weights, weights @ cov, temporaries
+
+    def __init__(self, returns: pd.DataFrame, risk_free: float = 0.0, periods: int = 252):
+        returns = returns.dropna(how='all')
+        self.tickers = list(returns.columns)
+        self.risk_free = risk_free
+        self.mean = returns.mean().to_numpy() * periods
+        self.cov = returns.cov().to_numpy() * periods
+
+    def evaluate(self, weights: np.ndarray, tickers: Optional[List[str]] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''Annualized returns, volatilities and Sharpe ratios of each row of `weights` (columns in `tickers` order)'''
+        mean, cov = self._moments(tickers or self.tickers, weights.dtype)
+        returns = weights @ mean
+        variances = np.einsum('ij,ij->i', weights @ cov, weights)
+        volatilities = np.sqrt(np.maximum(variances, 0))
+        sharpes = np.divide(returns - self.risk_free, volatilities, out=np.full_like(returns, np.nan), where=volatilities > 0)
+        return returns, volatilities, sharpes
+
+    def search(self, probas_req: Optional[dict] = None, size: int = 1_000_000, chunk_size: int = 200_000, top_k: int = 100,
+               key: Literal['sharpe', 'return', 'volatility'] = 'sharpe', pareto: bool = True, seed: int | None = None,
+               max_workers: Optional[int] = None, memory_budget: int = 256 * 2**20, dtype=np.float64) -> FrontierResult:
+        """
+        Score `size` random portfolios drawn within the bounds of `probas_req` (see Fmaths.iter_randoms_proba, all tickers unbounded by default).
+        Keep the `top_k` best on `key` (lowest for 'volatility', highest otherwise) and, with `pareto`, the efficient set.
+
+        At most one chunk per worker is in flight, and the chunk size and number of workers are cut so that the chunks in flight
+        stay within `memory_budget` bytes (about CHUNK_ARRAYS arrays of chunk x tickers each).
+        """
+        probas_req = probas_req or {'tickers': self.tickers}
+        tickers = probas_req['tickers']
+        method = Fmaths.sampling_method(probas_req, seed, dtype)
+        chunk_bytes = self.CHUNK_ARRAYS * len(tickers) * np.dtype(dtype).itemsize # per row
+        chunk_size = max(1, min(chunk_size, memory_budget // chunk_bytes))
+        workers = max(1, min(max_workers or os.cpu_count() or 1, memory_budget // (chunk_size * chunk_bytes)))
+        chunks = [min(chunk_size, size - start) for start in range(0, size, chunk_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(chunks)) # independent streams, whatever the thread running the chunk
+
+        def score(rows: int, chunk_seed: np.random.SeedSequence):
+            weights = next(Fmaths.iter_randoms_proba(probas_req, rows, chunk_size=rows, seed=chunk_seed, dtype=dtype, method=method))
+            stats = np.column_stack(self.evaluate(weights, tickers))
+            top = self._top(weights, stats, top_k, key)
+            front = self._pareto(weights, stats) if pareto else None
+            return top, front
+
+        best = front = None
+        def merge(future):
+            nonlocal best, front
+            chunk_top, chunk_front = future.result()
+            best = chunk_top if best is None else self._top(*map(np.concatenate, zip(best, chunk_top)), top_k, key)
+            if pareto:
+                front = chunk_front if front is None else self._pareto(*map(np.concatenate, zip(front, chunk_front)))
+
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for rows, chunk_seed in zip(chunks, seeds):
+                if len(pending) >= workers: # wait for the oldest chunk before generating another one
+                    merge(pending.popleft())
+                pending.append(executor.submit(score, rows, chunk_seed))
+            while pending:
+                merge(pending.popleft())
+        return FrontierResult(self._frame(best, tickers), self._frame(front, tickers), size)
+
+    def _moments(self, tickers: List[str], dtype) -> Tuple[np.ndarray, np.ndarray]:
+        if tickers == self.tickers:
+            return self.mean.astype(dtype, copy=False), self.cov.astype(dtype, copy=False)
+        index = [self.tickers.index(ticker) for ticker in tickers]
+        return self.mean[index].astype(dtype), self.cov[np.ix_(index, index)].astype(dtype)
+
+    @staticmethod
+    def _top(weights: np.ndarray, stats: np.ndarray, k: int, key: str) -> Tuple[np.ndarray, np.ndarray]:
+        column = {'return': 0, 'volatility': 1, 'sharpe': 2}[key]
+        scores = stats[:, column] if key == 'volatility' else -stats[:, column]
+        scores = np.where(np.isnan(scores), np.inf, scores)
+        if len(scores) > k:
+            keep = np.argpartition(scores, k)[:k]
+            weights, stats, scores = weights[keep], stats[keep], scores[keep]
+        order = np.argsort(scores, kind='stable')
+        return weights[order], stats[order]
+
+    @staticmethod
+    def _pareto(weights: np.ndarray, stats: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        '''Rows whose return is above every row of lower volatility'''
+        order = np.lexsort((-stats[:, 0], stats[:, 1]))
+        returns = stats[order, 0]
+        best_before = np.concatenate(([-np.inf], np.maximum.accumulate(returns)[:-1]))
+        keep = order[returns > best_before]
+        return weights[keep], stats[keep]
+
+    @staticmethod
+    def _frame(found: Optional[Tuple[np.ndarray, np.ndarray]], tickers: List[str]) -> pd.DataFrame:
+        columns = list(tickers) + ['return', 'volatility', 'sharpe']
+        if found is None:
+            return pd.DataFrame(columns=columns)
+        weights, stats = found
+        return pd.DataFrame(np.column_stack([weights, stats.astype(weights.dtype)]), columns=columns)
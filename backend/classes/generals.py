@@ -2,11 +2,16 @@ import logging
 from typing import Type, Dict, Any, List
 import ipdb
 
+from .codec import Codec
 
 class GeneralMethods():
+    __slots__ = () # lets subclasses such as Order drop their instance __dict__
+
     def to_dict(self, obj = None):
             # https://stackoverflow.com/questions/7963762/what-is-the-most-economical-way-to-convert-nested-python-objects-to-dictionaries
         def my_dict(obj):
+            if hasattr(obj, '_schema'): # slots based classes have no __dict__ to walk
+                return Codec.encode(obj)
             if not hasattr(obj, "__dict__"):
                 if isinstance(obj, dict):
                     result = {}
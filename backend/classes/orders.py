@@ -0,0 +1,96 @@
+import logging
+from datetime import datetime
+from typing import TYPE_CHECKING, Optional, List, Dict, Set, Tuple, Literal
+from bson import ObjectId
+from pymongo import UpdateOne, ASCENDING
+
+from .securities import Order
+from .codec import Codec
+
+if TYPE_CHECKING:
+    from pymongo import MongoClient
+    from pymongo.results import BulkWriteResult
+
+
+class OrdersMigrationError(Exception):
+    pass
+
+
+class OrderStore():
+    '''
+    Normalized order storage: one document per order in `investments.orders`, instead of the arrays embedded in the portfolio document.
+
+    Documents hold the order fields plus `ptf_id`, `security_type` and `isin`. They are unique per (ptf_id, broker, order_id),
+    and indexed on (ptf_id, isin, date) so date range queries only read the matching orders.
+    '''
+    batch_size = 1000
+
+    def __init__(self, mongo_client: 'MongoClient'):
+        self._orders = mongo_client.investments.orders
+        self._indexed = False
+
+    def upsert(self, ptf_id: ObjectId, security_type: Literal['bonds', 'stocks'], orders: Dict[str, List[Order]]) -> List['BulkWriteResult']:
+        '''Upsert orders grouped by isin, keyed by (ptf_id, broker, order_id), in unordered bulk writes'''
+        self._ensure_indexes()
+        operations = []
+        for isin, security_orders in orders.items():
+            for order in security_orders:
+                doc = Codec.encode(order)
+                doc.update({'ptf_id': ptf_id, 'security_type': security_type, 'isin': isin})
+                operations.append(UpdateOne(
+                    {'ptf_id': ptf_id, 'broker': order.broker, 'order_id': order.order_id},
+                    {'$set': doc}, upsert=True))
+        return self._bulk_write(operations)
+
+    def find(self, ptf_id: ObjectId, isins: Optional[List[str]] = None, date_from: Optional[datetime] = None,
+             date_to: Optional[datetime] = None, order_fields: Optional[List[str]] = None) -> Dict[Tuple[str, str], List[Order]]:
+        '''Orders of the portfolio grouped by (security_type, isin), in date order'''
+        query = {'ptf_id': ptf_id}
+        if isins is not None:
+            query['isin'] = {'$in': isins}
+        if date_from or date_to:
+            query['date'] = {}
+            if date_from:
+                query['date']['$gte'] = date_from
+            if date_to:
+                query['date']['$lte'] = date_to
+        projection = {'_id': 0}
+        if order_fields:
+            projection = {field: 1 for field in ['security_type', 'isin'] + order_fields}
+            projection['_id'] = 0
+
+        order_plan = Codec.plan(Order)
+        result = {}
+        for doc in self._orders.find(query, projection).sort([('isin', ASCENDING), ('date', ASCENDING)]):
+            result.setdefault((doc['security_type'], doc['isin']), []).append(order_plan.decode(doc))
+        return result
+
+    def order_ids(self, ptf_id: ObjectId, security_type: Literal['bonds', 'stocks'] = 'stocks') -> Set[int]:
+        '''Ids of the stored orders of the portfolio, read from the index without building any Order'''
+        return set(self._orders.distinct('order_id', {'ptf_id': ptf_id, 'security_type': security_type}))
+
+    def migrate(self, ptf_doc: dict) -> int:
+        '''Copy the orders embedded in a portfolio document into the collection. Idempotent: orders are upserted'''
+        order_plan = Codec.plan(Order)
+        nb_orders = 0
+        for security_type in ('stocks', 'bonds'):
+            orders = {}
+            for security in ptf_doc.get(security_type) or ():
+                orders[security['isin']] = [order_plan.decode(order) for order in security.get('orders') or ()]
+                nb_orders += len(orders[security['isin']])
+            self.upsert(ptf_doc['_id'], security_type, orders)
+        logging.info(f"{nb_orders} orders of portfolio '{ptf_doc['_id']}' migrated to the orders collection")
+        return nb_orders
+
+    def _bulk_write(self, operations: list) -> List['BulkWriteResult']:
+        results = []
+        for start in range(0, len(operations), self.batch_size):
+            results.append(self._orders.bulk_write(operations[start:start + self.batch_size], ordered=False))
+        return results
+
+    def _ensure_indexes(self):
+        if self._indexed:
+            return
+        self._orders.create_index([('ptf_id', ASCENDING), ('isin', ASCENDING), ('date', ASCENDING)])
+        self._orders.create_index([('ptf_id', ASCENDING), ('broker', ASCENDING), ('order_id', ASCENDING)], unique=True)
+        self._indexed = True
@@ -1,10 +1,15 @@
 import logging
+import pandas as pd
 from bson.objectid import ObjectId
-from typing import Union, TYPE_CHECKING, Optional, List, Literal
+from typing import Union, TYPE_CHECKING, Optional, List, Literal, Dict, Set
 from datetime import datetime
 
 from .securities import Stock, Bond, Order, Fee
 from .generals import GeneralMethods
+from .codec import Codec
+from .orders import OrderStore, OrdersMigrationError
+from .writer import PortfolioWriter
+from .snapshots import SnapshotStore
 from mylibs.exchangeRate import ExchangeRate
 
 if TYPE_CHECKING:
@@ -12,19 +17,113 @@ if TYPE_CHECKING:
 
 
 class Portfolio(GeneralMethods):
-    def __init__(self, mongo_client: Optional['MongoClient'] = None, ptf_id: Optional[str] = None, name: Optional[str] = None ):
+    # orders_storage: 'embedded' keeps the orders in the portfolio document, 'collection' in the orders collection (see OrderStore)
+    _schema = {'name': None, 'orders_storage': 'embedded', 'brokersSync': None, 'stocks': [Stock], 'bonds': [Bond]}
+
+    def __init__(self, mongo_client: Optional['MongoClient'] = None, ptf_id: Optional[str] = None, name: Optional[str] = None,
+                 orders_storage: Literal['embedded', 'collection'] = 'embedded'):
         self._mongo_client = mongo_client
         self._id = ObjectId(ptf_id)
         self.stocks = []
         self.bonds = []
         self.name = name
+        self.orders_storage = orders_storage
+        self.brokersSync: Dict[str, dict] = {} # per broker sync checkpoint, written with the orders (see PortfolioWriter.set_sync)
+
+    @property
+    def _order_store(self) -> OrderStore:
+        store = self.__dict__.get('_order_store_instance')
+        if store is None:
+            store = self._order_store_instance = OrderStore(self._mongo_client)
+        return store
    
-    def load(self, ptf_id: str | ObjectId | None = None):
+    def load(self, ptf_id: str | ObjectId | None = None, lazy: bool = False, date_from: Optional[datetime] = None, 
+             date_to: Optional[datetime] = None, order_fields: Optional[List[str]] = None):
+        '''
+        Load the portfolio document.
+
+        Args:
+            lazy (bool): Only fetch the security headers; orders are fetched later with `load_orders`.
+            date_from, date_to (datetime): Only fetch the orders within this window, filtered server side.
+            order_fields (list): Only fetch these order fields, e.g. ['order_id'] when only the known ids are needed.
+
+        With the 'collection' storage, the orders are then read from the orders collection with the same filters.
+        '''
         if ptf_id:
             self._id = ObjectId(ptf_id)
-        ptf = self._mongo_client.investments.portfolios.find_one({'_id': self._id})
+        portfolios = self._mongo_client.investments.portfolios
+        if lazy:
+            ptf = portfolios.find_one({'_id': self._id}, {'stocks.orders': 0, 'bonds.orders': 0})
+        elif date_from or date_to or order_fields:
+            ptf = next(portfolios.aggregate(self._orders_pipeline(date_from, date_to, order_fields)), None)
+        else:
+            ptf = portfolios.find_one({'_id': self._id})
+        self.hydrate(ptf)
+        if lazy:
+            for security in self.stocks + self.bonds:
+                security._orders_loaded = False
+        elif ptf and self.orders_storage == 'collection':
+            self.load_orders(date_from=date_from, date_to=date_to, order_fields=order_fields)
+
+    def load_orders(self, isins: Optional[List[str]] = None, date_from: Optional[datetime] = None, 
+                    date_to: Optional[datetime] = None, order_fields: Optional[List[str]] = None):
+        '''Fetch the orders of the given securities (all by default) after a lazy load, optionally within a date window'''
+        if self.orders_storage == 'collection':
+            orders = self._order_store.find(self._id, isins, date_from, date_to, order_fields)
+            for security_type in ('stocks', 'bonds'):
+                for security in getattr(self, security_type):
+                    if isins is None or security.isin in isins:
+                        security.orders = orders.get((security_type, security.isin), [])
+                        security._orders_loaded = True
+            return
+        pipeline = self._orders_pipeline(date_from, date_to, order_fields, isins)
+        ptf = next(self._mongo_client.investments.portfolios.aggregate(pipeline), None)
+        if not ptf:
+            return
+        order_plan = Codec.plan(Order)
+        for security_type in ('stocks', 'bonds'):
+            securities = {security.isin: security for security in getattr(self, security_type)}
+            for security_doc in ptf.get(security_type) or ():
+                security = securities.get(security_doc['isin'])
+                if security is not None:
+                    security.orders = [order_plan.decode(order) for order in security_doc.get('orders') or ()]
+                    security._orders_loaded = True
+
+    def _orders_pipeline(self, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None, 
+                         order_fields: Optional[List[str]] = None, isins: Optional[List[str]] = None) -> list:
+        '''Aggregation returning the portfolio with its orders filtered by date ($filter) and reduced to `order_fields` ($map)'''
+        def orders_expr():
+            expr = '$$security.orders'
+            conditions = []
+            if date_from:
+                conditions.append({'$gte': ['$$order.date', date_from]})
+            if date_to:
+                conditions.append({'$lte': ['$$order.date', date_to]})
+            if conditions:
+                expr = {'$filter': {'input': expr, 'as': 'order', 'cond': {'$and': conditions}}}
+            if order_fields:
+                expr = {'$map': {'input': expr, 'as': 'order', 'in': {field: f'$$order.{field}' for field in order_fields}}}
+            return expr
+
+        def securities_expr(security_type: str):
+            securities = {'$ifNull': [f'${security_type}', []]}
+            if isins is not None:
+                securities = {'$filter': {'input': securities, 'as': 'security', 'cond': {'$in': ['$$security.isin', isins]}}}
+            return {'$map': {'input': securities, 'as': 'security', 'in': {'$mergeObjects': ['$$security', {'orders': orders_expr()}]}}}
+
+        return [
+            {'$match': {'_id': self._id}},
+            {'$project': {'name': 1, 'orders_storage': 1, 'brokersSync': 1, 'stocks': securities_expr('stocks'), 'bonds': securities_expr('bonds')}},
+        ]
+
+    def hydrate(self, ptf: Optional[dict]):
+        '''Fill the portfolio from its mongo document, e.g. one fetched with the async client'''
         if ptf:
-            self.from_dict(self, ptf, classes=[Portfolio, Stock, Bond, Order, Fee])
+            Codec.decode_into(self, ptf)
+            self.brokersSync = self.brokersSync or {}
+            for security in self.stocks + self.bonds: # like add_security
+                security._mongo_client = self._mongo_client
+                security._ptf_id = self._id
         else:
             logging.info(f"No portfolio found with id '{self._id}'")
 
@@ -36,30 +135,228 @@ class Portfolio(GeneralMethods):
         getattr(self, security_type).append(security)
         return getattr(self, security_type)[-1]
 
+    def writer(self) -> PortfolioWriter:
+        '''Unit of work batching several writes of this portfolio in one bulk write, see PortfolioWriter'''
+        return PortfolioWriter(self)
+
     def push_securities(self, security_type: Literal['bonds', 'stocks']):
-        securities_list = self.to_dict(getattr(self, security_type))
-        self._mongo_client.investments.portfolios.find_one_and_update(
-                filter = {'_id': self._id},
-                update = {'$push': {security_type: {'$each': securities_list}}},
-                upsert=True)
+        writer = self.writer()
+        writer.push_securities(security_type, getattr(self, security_type))
+        return writer.flush()
     
-    def stock_history(self, currency: str = 'EUR'):
-        result = {}
-        for stock in self.stocks.items():
-            for order in stock.orders:
-                value = getattr(order, 'quantity') * getattr(order, 'price')
-                order_currency = getattr(order, 'currency')
-                if order_currency == 'GBX': # temp
-                    continue
-                if order_currency != currency:
-                    rate = ExchangeRate.convert(target_codes=order_currency, base_code=currency, amount=value)
-                    value = list(rate['rates'].values())[0]
-                date = datetime.strftime(getattr(order, 'date'), '%Y-%m-%d') 
-                try:
-                    result[date] += value
-                except KeyError:
-                    result[date] = value
-        return {key: result[key] for key in sorted(result.keys())}
+    def positions_at(self, day: datetime) -> Dict[str, dict]:
+        '''Stock positions {isin: {quantity, cost, currency}} at the end of `day`, from the nearest month-end snapshot (see SnapshotStore)'''
+        return SnapshotStore(self._mongo_client).positions(self, day)
+
+    def orders_frame(self, security_type: Literal['bonds', 'stocks'] = 'stocks') -> pd.DataFrame:
+        '''Flatten the orders of every security into one frame (isin, date, quantity, price, currency)'''
+        columns = ['isin', 'date', 'quantity', 'price', 'currency']
+        records = [(security.isin, order.date, order.quantity, order.price, order.currency)
+                   for security in getattr(self, security_type) for order in security.orders]
+        return pd.DataFrame.from_records(records, columns=columns)
+
+    def order_ids(self, security_type: Literal['bonds', 'stocks'] = 'stocks') -> Set[int]:
+        return {order.order_id for security in getattr(self, security_type) for order in security.orders}
+
+    def stored_order_ids(self, security_type: Literal['bonds', 'stocks'] = 'stocks') -> Set[int]:
+        '''Ids of the orders stored in mongo, whatever is loaded in memory (e.g. the known orders of a sync after a lazy load)'''
+        if self.orders_storage == 'collection':
+            return self._order_store.order_ids(self._id, security_type)
+        doc = self._mongo_client.investments.portfolios.find_one({'_id': self._id}, {f'{security_type}.orders.order_id': 1}) or {}
+        return {order['order_id'] for security in doc.get(security_type) or () for order in security.get('orders') or () if 'order_id' in order}
+
+    def upsert_orders(self, security_type: Literal['bonds', 'stocks'], orders: Dict[str, List[Order]]) -> List[dict]:
+        '''
+        Write new orders keyed by `order_id`, grouped by security isin, in one ordered bulk write.
+        Missing securities are created, and orders already stored with the same id are replaced, so replaying a sync never duplicates them.
+        With the 'collection' storage only the security headers go to the portfolio document, the orders to the orders collection.
+        '''
+        writer = self.writer()
+        writer.upsert_orders(security_type, orders)
+        report = writer.flush()
+        logging.info(f'{sum(len(o) for o in orders.values())} orders upserted in {len(orders)} {security_type}')
+        return report
+
+    def migrate_orders(self, max_attempts: int = 5) -> int:
+        '''
+        Move the embedded orders to the orders collection and switch the portfolio to the 'collection' storage.
+        Orders are copied before the arrays are emptied, so an interrupted migration can simply be run again.
+
+        Embedded order writes bump `orders_version`: the switch only applies if it did not change since the copy,
+        otherwise the orders are copied again (a sync ran meanwhile). Once switched, embedded writes are rerouted by PortfolioWriter.
+        '''
+        portfolios = self._mongo_client.investments.portfolios
+        for _ in range(max_attempts):
+            ptf = portfolios.find_one({'_id': self._id})
+            if not ptf:
+                logging.info(f"No portfolio found with id '{self._id}'")
+                return 0
+            if ptf.get('orders_storage') == 'collection':
+                self.orders_storage = 'collection'
+                return 0
+            nb_orders = self._order_store.migrate(ptf)
+            unset_orders = {f'{security_type}.$[].orders': [] for security_type in ('stocks', 'bonds') if ptf.get(security_type)}
+            result = portfolios.update_one(
+                {'_id': self._id, 'orders_storage': {'$ne': 'collection'}, 'orders_version': ptf.get('orders_version')},
+                {'$set': {'orders_storage': 'collection', **unset_orders}})
+            if result.matched_count:
+                self.orders_storage = 'collection'
+                return nb_orders
+            logging.info(f"Orders of portfolio '{self._id}' written during the migration, copying them again")
+        raise OrdersMigrationError(f"Orders of portfolio '{self._id}' kept changing, migration given up after {max_attempts} attempts")
+
+    def stock_history(self, currency: str = 'EUR', cumulative: bool = True, server_side: bool = False, by_security: bool = False) -> dict:
+        '''
+        Daily invested capital in `currency`, computed in one pass over the flattened orders.
+
+        Rates for every currency and date are fetched in one batched lookup. Order values are
+        converted at the rate of their day (GBX through GBP). With `cumulative=False` the daily flows are returned instead.
+        With `server_side=True` the computation runs as a mongo aggregation (see `_history_pipeline`) and the portfolio
+        does not need to be loaded. With `by_security=True` the result is {isin: {day: value}}.
+        '''
+        if server_side:
+            if self._rates_lookup_available():
+                return self._stock_history_aggregate(currency, cumulative, by_security)
+            logging.warning('Exchange rates are not stored with the portfolios, stock history computed locally')
+            self.load()
+
+        df = self.orders_frame('stocks')
+        if df.empty:
+            return {}
+        df['day'] = pd.to_datetime(df['date']).dt.normalize()
+        df['value'] = df['quantity'].astype(float) * df['price'].astype(float)
+
+        foreign = (df['currency'] != currency).to_numpy()
+        if foreign.any():
+            first_day, last_day = df['day'].min(), df['day'].max()
+            codes = sorted(df.loc[foreign, 'currency'].dropna().unique())
+            rates = ExchangeRate.convert(codes, currency, date_from=first_day.strftime('%Y-%m-%d'), date_to=last_day.strftime('%Y-%m-%d'))
+            rates.index = pd.to_datetime(rates.index)
+            rates = rates.reindex(pd.date_range(first_day, last_day, freq='D')).ffill().bfill()
+            rows = (df.loc[foreign, 'day'] - first_day).dt.days.to_numpy()
+            cols = rates.columns.get_indexer(df.loc[foreign, 'currency'])
+            converted = df.loc[foreign, 'value'].to_numpy() / rates.to_numpy()[rows, cols]
+            converted[cols < 0] = float('nan')
+            df.loc[foreign, 'value'] = converted
+
+        missing = df['value'].isna()
+        if missing.any():
+            logging.warning(f'{int(missing.sum())} orders without value or exchange rate ignored in stock history')
+        if by_security:
+            history = df.groupby(['isin', 'day'])['value'].sum()
+            if cumulative:
+                history = history.groupby(level='isin').cumsum()
+            return {isin: dict(zip(series.index.get_level_values('day').strftime('%Y-%m-%d'), series.tolist()))
+                    for isin, series in history.groupby(level='isin')}
+        history = df.groupby('day')['value'].sum()
+        if cumulative:
+            history = history.cumsum()
+        return dict(zip(history.index.strftime('%Y-%m-%d'), history.tolist()))
+
+    def _rates_lookup_available(self) -> bool:
+        store = ExchangeRate.store
+        return store is not None and store.collection is not None \
+            and store.collection.database.name == self._mongo_client.investments.name
+
+    def _stock_history_aggregate(self, currency: str, cumulative: bool, by_security: bool) -> dict:
+        '''Server side `stock_history`: only the currencies and date range, then the finished series, cross the wire'''
+        collection, source = self._orders_source('stocks')
+        ranges = list(collection.aggregate(source + [
+            {'$group': {'_id': '$currency', 'first': {'$min': '$date'}, 'last': {'$max': '$date'}}}]))
+        if not ranges:
+            return {}
+        quotes = sorted({self._rate_quote(r['_id']) for r in ranges if r['_id'] and r['_id'] != currency})
+        if quotes:
+            # make sure every rate of the range is stored before the $lookup reads them
+            first = min(r['first'] for r in ranges if r['first'])
+            last = max(r['last'] for r in ranges if r['last'])
+            ExchangeRate.store.get_rates(currency, quotes, first, last)
+
+        docs = collection.aggregate(source + self._history_pipeline(currency, cumulative, by_security))
+        history = {}
+        missing = 0
+        for doc in docs:
+            missing += doc['missing']
+            if by_security:
+                history.setdefault(doc['_id']['isin'], {})[doc['_id']['day']] = doc['value']
+            else:
+                history[doc['_id']['day']] = doc['value']
+        if missing:
+            logging.warning(f'{missing} orders without value or exchange rate ignored in stock history')
+        return history
+
+    def _orders_source(self, security_type: Literal['bonds', 'stocks']) -> tuple:
+        '''Collection and first stages yielding one {isin, date, quantity, price, currency} document per order'''
+        fields = {'_id': 0, 'isin': 1, 'date': 1, 'quantity': 1, 'price': 1, 'currency': 1}
+        if self.orders_storage == 'collection':
+            return self._mongo_client.investments.orders, [
+                {'$match': {'ptf_id': self._id, 'security_type': security_type}},
+                {'$project': fields}]
+        return self._mongo_client.investments.portfolios, [
+            {'$match': {'_id': self._id}},
+            {'$unwind': f'${security_type}'},
+            {'$unwind': f'${security_type}.orders'},
+            {'$replaceWith': {'$mergeObjects': [f'${security_type}.orders', {'isin': f'${security_type}.isin'}]}},
+            {'$project': fields}]
+
+    @staticmethod
+    def _rate_quote(code: str) -> str:
+        return 'GBP' if code == 'GBX' else code
+
+    def _history_pipeline(self, currency: str, cumulative: bool, by_security: bool) -> list:
+        '''
+        Stages turning order documents into the daily invested value:
+        orders are summed per (day, currency[, isin]) first, so the rate $lookup runs once per group instead of once per order.
+        The rate of a day is the last stored one at or before it (weekends and holidays), or the earliest one for days before any,
+        GBX being converted through GBP.
+        '''
+        key = {'day': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$date'}}, 'currency': '$currency'}
+        if by_security:
+            key['isin'] = '$isin'
+        value = {'$multiply': ['$quantity', '$price']}
+        def rate_lookup(compare: str, order: int, field: str) -> dict:
+            return {'$lookup': {
+                'from': ExchangeRate.store.collection.name,
+                'let': {'quote': {'$cond': [{'$eq': ['$_id.currency', 'GBX']}, 'GBP', '$_id.currency']}, 'day': '$_id.day'},
+                'pipeline': [
+                    {'$match': {'base': currency, '$expr': {'$and': [{'$eq': ['$quote', '$$quote']}, {compare: ['$date', '$$day']}]}}},
+                    {'$sort': {'date': order}},
+                    {'$limit': 1},
+                    {'$project': {'_id': 0, 'rate': 1}}],
+                'as': field}}
+        branches = [{'case': {'$eq': ['$_id.currency', currency]}, 'then': 1}]
+        if currency == 'GBP':
+            branches.append({'case': {'$eq': ['$_id.currency', 'GBX']}, 'then': 100})
+        rate = {'$switch': {'branches': branches, 'default': {'$multiply': [
+            {'$first': {'$concatArrays': ['$rate.rate', '$rate_after.rate']}},
+            {'$cond': [{'$eq': ['$_id.currency', 'GBX']}, 100, 1]}]}}}
+        group_key = {'day': '$_id.day', 'isin': '$_id.isin'} if by_security else {'day': '$_id.day'}
+
+        pipeline = [
+            {'$group': {
+                '_id': key,
+                'value': {'$sum': value},
+                'count': {'$sum': 1},
+                'missing': {'$sum': {'$cond': [{'$eq': [{'$ifNull': [value, None]}, None]}, 1, 0]}}}},
+            rate_lookup('$lte', -1, 'rate'),
+            # days before the first stored rate take the earliest one, as the local path does (bfill)
+            rate_lookup('$gt', 1, 'rate_after'),
+            {'$set': {'rate': rate}},
+            {'$unset': 'rate_after'},
+            {'$set': {
+                'value': {'$cond': [{'$eq': [{'$ifNull': ['$rate', None]}, None]}, 0, {'$divide': ['$value', '$rate']}]},
+                'missing': {'$cond': [{'$eq': [{'$ifNull': ['$rate', None]}, None]}, '$count', '$missing']}}},
+            {'$group': {'_id': group_key, 'value': {'$sum': '$value'}, 'missing': {'$sum': '$missing'}}},
+            {'$sort': {'_id.isin': 1, '_id.day': 1} if by_security else {'_id.day': 1}},
+        ]
+        if cumulative:
+            window = {
+                'sortBy': {'_id.day': 1},
+                'output': {'value': {'$sum': '$value', 'window': {'documents': ['unbounded', 'current']}}}}
+            if by_security:
+                window['partitionBy'] = '$_id.isin'
+            pipeline.append({'$setWindowFields': window})
+        return pipeline
 
     def import_json(self, path: str): # WIP
         pass
@@ -9,16 +9,24 @@ if TYPE_CHECKING:
     from pymongo import MongoClient
     from bson import ObjectId
 
-@dataclass
+@dataclass(slots=True)
 class Fee():
-    type: str
-    value: int
+    # defaults let GeneralMethods.from_dict instantiate it before setting the fields
+    type: Optional[str] = None
+    value: float = 0.0
+
+    _schema = {'type': None, 'value': 0.0}
 
 
 class Order(GeneralMethods):
+    # no instance __dict__: heavy portfolios hold tens of thousands of orders in memory
+    __slots__ = ('broker', 'type', 'quantity', 'quantity_estimated', 'price', 'date', 'order_id', 'currency', 'fees')
+    _schema = {'broker': None, 'type': None, 'quantity': None, 'quantity_estimated': False, 'price': None,
+               'date': None, 'order_id': None, 'currency': None, 'fees': [Fee]}
+
     def __init__(self, broker: Optional[Literal['T212', 'IBKR', 'TR']] = None, type: Optional[Literal['LIMIT', 'MARKET']] = None, 
                  quantity: Optional[float] = None, quantity_estimated: bool = False, price: Optional[float] = None, date: Optional[datetime] = None, 
-                 order_id: Optional[int] = None, currency: Optional[str] = None, fees: List[Fee] = [], **kwargs):
+                 order_id: Optional[int] = None, currency: Optional[str] = None, fees: Optional[List[Fee]] = None, **kwargs):
         self.broker = broker
         self.type = type
         self.quantity = quantity
@@ -27,18 +35,21 @@ class Order(GeneralMethods):
         self.date = date
         self.order_id = order_id
         self.currency = currency
-        self.fees = fees
+        self.fees = fees if fees is not None else []
 
         if kwargs: 
             logging.debug(f'Received unexpected args: {kwargs}')
 
 
 class Security(GeneralMethods):
+    _schema = {'isin': None, 'orders': [Order]}
+    _orders_loaded = True # False after a lazy Portfolio.load, until Portfolio.load_orders
+
     def __init__(self, isin: Optional[str] = None, _mongo_client: Optional['MongoClient'] = None, _ptf_id: Optional['ObjectId'] = None, **kwargs):
         self.isin = isin
         self.orders = []
-        self._mongo_client: _mongo_client
-        self._ptf_id: _ptf_id
+        self._mongo_client = _mongo_client
+        self._ptf_id = _ptf_id
 
         if kwargs:
             logging.debug(f'Received unexpected args for {self.ticker}: {kwargs}')
@@ -48,7 +59,7 @@ class Security(GeneralMethods):
         logging.debug(f"Order {order.order_id} added to '{self.ticker}' ({self.isin})")
 
     def push(self):
-        security_dict = self.to_dict()
+        security_dict = self.to_dict() # encoded by the Codec (see GeneralMethods.to_dict)
         category = self.class_to_cat(self)
         self._mongo_client.investments.portfolios.find_one_and_update(
                 filter={'_id':self._ptf_id}, 
@@ -59,6 +70,8 @@ class Security(GeneralMethods):
 
 
 class Stock(Security):
+    _schema = {**Security._schema, 'ticker': None, 't212_id': None, 'sector': None, 'country': None}
+
     def __init__(self, ticker: Optional[str] = None, t212_id: Optional[str] = None, 
                  sector:Optional[str] = None, country: Optional[str] = None, **kwargs):
         self.ticker = ticker
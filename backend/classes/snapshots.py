@@ -0,0 +1,136 @@
+import logging
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+import pandas as pd
+from bson import ObjectId
+from pymongo import UpdateOne, ASCENDING, DESCENDING
+
+if TYPE_CHECKING:
+    from pymongo import MongoClient
+    from .portfolio import Portfolio
+
+
+class SnapshotStore():
+    '''
+    Month-end positions of each portfolio in `investments.snapshots`: {ptf_id, day (last day of the month), positions}.
+    Positions are {isin, quantity, cost, currency} after every order of that day, `cost` being the average cost basis
+    (buys add quantity * price, sells remove their share of the cost).
+
+    A holdings question at some date starts from the nearest snapshot and only replays the orders after it.
+
+    Order writes (PortfolioWriter) set `snapshots_stale_from` on the portfolio, in the same bulk write, and bump `snapshots_version`.
+    `positions` and `window` rebuild the snapshots from that day first; the mark is only cleared if no write came in meanwhile.
+    '''
+    def __init__(self, mongo_client: 'MongoClient'):
+        self._mongo_client = mongo_client
+        self._snapshots = mongo_client.investments.snapshots
+        self._portfolios = mongo_client.investments.portfolios
+        self._indexed = False
+
+    def positions(self, ptf: 'Portfolio', day: datetime) -> Dict[str, dict]:
+        '''Positions at the end of `day`: nearest snapshot, then the orders after it'''
+        self._rebuild_stale(ptf)
+        snapshot_day, positions = self.nearest(ptf._id, day)
+        date_from = snapshot_day + timedelta(days=1) if snapshot_day else None
+        return self.replay(positions, self._orders(ptf, date_from, self._end_of(day)))
+
+    def window(self, ptf: 'Portfolio', start: Optional[datetime], end: datetime) -> Tuple[Optional[datetime], Dict[str, dict], pd.DataFrame]:
+        '''
+        What a computation of the days `start`..`end` needs: the nearest snapshot before `start` (day and positions)
+        and the orders after it until `end`. Without `start` or snapshot, every order until `end`.
+        '''
+        self._rebuild_stale(ptf)
+        snapshot_day, positions = self.nearest(ptf._id, start - timedelta(days=1)) if start is not None else (None, {})
+        date_from = snapshot_day + timedelta(days=1) if snapshot_day else None
+        return snapshot_day, positions, self._orders(ptf, date_from, self._end_of(end))
+
+    def nearest(self, ptf_id: ObjectId, day: datetime) -> Tuple[Optional[datetime], Dict[str, dict]]:
+        doc = self._snapshots.find_one({'ptf_id': ptf_id, 'day': {'$lte': day}}, sort=[('day', DESCENDING)])
+        if not doc:
+            return None, {}
+        return doc['day'], {position['isin']: position for position in doc['positions']}
+
+    def update(self, ptf: 'Portfolio', changed_from: datetime, until: Optional[datetime] = None) -> int:
+        '''
+        Rebuild the snapshots of the months from `changed_from` (e.g. the oldest order added by a sync), or from the stale mark
+        of the portfolio when older, to the last complete month. Only the orders after the previous snapshot are read.
+        Return the number of snapshots written.
+        '''
+        mark = self._portfolios.find_one({'_id': ptf._id}, {'snapshots_stale_from': 1, 'snapshots_version': 1}) or {}
+        if mark.get('snapshots_stale_from') and mark['snapshots_stale_from'] < changed_from:
+            changed_from = mark['snapshots_stale_from']
+        last_month_end = (until or datetime.now()).replace(day=1, hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+        first_month_end = self._month_end(changed_from)
+        written = self._rebuild(ptf, first_month_end, last_month_end) if first_month_end <= last_month_end else 0
+        if mark.get('snapshots_stale_from') and until is None:
+            # only once rebuilt to the last month. Orders written meanwhile bumped the version: their mark is kept for the next read
+            self._portfolios.update_one({'_id': ptf._id, 'snapshots_version': mark.get('snapshots_version')},
+                                        {'$unset': {'snapshots_stale_from': ''}})
+        return written
+
+    def _rebuild(self, ptf: 'Portfolio', first_month_end: datetime, last_month_end: datetime) -> int:
+        self._ensure_indexes()
+        previous_day, positions = self.nearest(ptf._id, first_month_end.replace(day=1) - timedelta(days=1))
+        orders = self._orders(ptf, previous_day + timedelta(days=1) if previous_day else None, self._end_of(last_month_end))
+
+        operations = []
+        month_ends = pd.date_range(first_month_end, last_month_end, freq='ME')
+        months = orders['date'].searchsorted([self._end_of(month_end) for month_end in month_ends], side='right')
+        start = 0
+        for month_end, stop in zip(month_ends, months):
+            positions = self.replay(positions, orders.iloc[start:stop])
+            start = stop
+            operations.append(UpdateOne(
+                {'ptf_id': ptf._id, 'day': month_end.to_pydatetime()},
+                {'$set': {'positions': [position for position in positions.values() if position['quantity']]}},
+                upsert=True))
+        if operations:
+            self._snapshots.bulk_write(operations, ordered=False)
+        logging.info(f'{len(operations)} month-end snapshots updated for portfolio {ptf._id}')
+        return len(operations)
+
+    def _rebuild_stale(self, ptf: 'Portfolio'):
+        mark = self._portfolios.find_one({'_id': ptf._id}, {'snapshots_stale_from': 1}) or {}
+        if mark.get('snapshots_stale_from'):
+            self.update(ptf, mark['snapshots_stale_from'])
+
+    @staticmethod
+    def replay(positions: Dict[str, dict], orders: pd.DataFrame) -> Dict[str, dict]:
+        '''Apply orders (sorted by date) to positions, keeping an average cost basis. Return new positions'''
+        positions = {isin: dict(position) for isin, position in positions.items()}
+        for isin, quantity, price, currency in orders[['isin', 'quantity', 'price', 'currency']].itertuples(index=False):
+            position = positions.setdefault(isin, {'isin': isin, 'quantity': 0.0, 'cost': 0.0, 'currency': currency})
+            held = position['quantity']
+            if quantity >= 0 or held <= 0:
+                position['cost'] += quantity * price
+            else:
+                position['cost'] -= position['cost'] * min(-quantity / held, 1)
+            position['quantity'] = held + quantity
+            if abs(position['quantity']) < 1e-9:
+                position['quantity'], position['cost'] = 0.0, 0.0
+        return positions
+
+    def _orders(self, ptf: 'Portfolio', date_from: Optional[datetime], date_to: datetime) -> pd.DataFrame:
+        '''Orders of the stocks within the dates, sorted by date, fetched without touching the orders held by `ptf`'''
+        from .portfolio import Portfolio
+        window = Portfolio(self._mongo_client, ptf._id)
+        window.load(lazy=True)
+        window.load_orders(date_from=date_from, date_to=date_to, order_fields=['date', 'quantity', 'price', 'currency'])
+        orders = window.orders_frame('stocks').dropna(subset=['date', 'quantity'])
+        orders['price'] = orders['price'].fillna(0)
+        return orders.sort_values('date', kind='stable').reset_index(drop=True)
+
+    @staticmethod
+    def _month_end(day: datetime) -> datetime:
+        next_month = (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+        return (next_month - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+    @staticmethod
+    def _end_of(day: datetime) -> datetime:
+        return day.replace(hour=23, minute=59, second=59, microsecond=999999)
+
+    def _ensure_indexes(self):
+        if self._indexed:
+            return
+        self._snapshots.create_index([('ptf_id', ASCENDING), ('day', ASCENDING)], unique=True)
+        self._indexed = True
@@ -1,12 +1,12 @@
 import logging
-import bcrypt
 import secrets
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional, Union, TYPE_CHECKING
+from typing import List, Dict, Optional, Union, ClassVar, TYPE_CHECKING
 from bson import ObjectId
-from pymongo.errors import DuplicateKeyError
+from pymongo.errors import DuplicateKeyError, PyMongoError
 
 from .generals import GeneralMethods
+from mylibs.passwordHasher import PasswordHasher, PasswordHasherBusyError
 
 if TYPE_CHECKING:
     from pymongo import MongoClient
@@ -17,6 +17,8 @@ class UserError(Exception):
 
 
 class User(GeneralMethods):
+    hasher: ClassVar[PasswordHasher] = PasswordHasher() # replaced at startup with the PASSWORD_HASH_* settings (see user.apps)
+
     def __init__(self, id: Optional[Union[str, ObjectId]] = None, email: Optional[str] = None, 
                  password: Optional[str] = None, mongo_client: Optional['MongoClient'] = None):
         self._id = ObjectId(id)
@@ -24,6 +26,7 @@ class User(GeneralMethods):
         self.ptf_ids : List[ObjectId] = []
         self.oaths: Dict[str, str] = {}
         self.brokersLastUpdate = {}
+        self.brokersSync: Dict[str, dict] = {} # per broker sync checkpoint: high_water_mark, last_order_id, cursor
         self._password = password
         self._users_db = mongo_client.users
         self._isAuthentificated: bool = False
@@ -78,11 +81,26 @@ class User(GeneralMethods):
     def _verify_user(self, user: Optional[dict] = None) -> bool:
         if not user:
             user = self._users_db.users.find_one({'email': self.email})
-        if bcrypt.checkpw(self._password.encode('utf-8'), user['password_hash']):
-            return True
-        return False
+        try:
+            if not self.hasher.verify(self._password, user['password_hash']):
+                return False
+        except PasswordHasherBusyError:
+            raise UserError('Too many connections in progress, please retry in a moment')
+        if self.hasher.needs_rehash(user['password_hash']):
+            # work factor changed: the password is known right now, so the stored hash is upgraded transparently.
+            # Best effort: the login succeeds anyway, and the next one retries
+            try:
+                self._users_db.users.update_one(
+                    {'_id': user['_id'], 'password_hash': user['password_hash']},
+                    {'$set': {'password_hash': self.hasher.hash(self._password)}})
+                logging.info(f"Password hash of user {user['_id']} rehashed with {self.hasher.rounds} rounds")
+            except (PasswordHasherBusyError, PyMongoError) as e:
+                logging.warning(f"Password hash of user {user['_id']} not rehashed: {e}")
+        return True
     
     @staticmethod
     def hash(password):
-        salt = bcrypt.gensalt()
-        return bcrypt.hashpw(password.encode('utf-8'), salt)
\ No newline at end of file
+        try:
+            return User.hasher.hash(password)
+        except PasswordHasherBusyError:
+            raise UserError('Too many connections in progress, please retry in a moment')
@@ -0,0 +1,170 @@
+import logging
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Optional, List, Literal, Dict, Tuple, Union
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from .securities import Security, Order
+from .codec import Codec
+
+if TYPE_CHECKING:
+    from .portfolio import Portfolio
+
+
+class PortfolioWriteError(Exception):
+    def __init__(self, message: str, report: List[dict]):
+        super().__init__(message)
+        self.report = report
+
+
+class PortfolioWriter():
+    '''
+    Unit of work collecting the writes of a portfolio (new securities, orders, broker sync metadata),
+    flushed as one ordered bulk write on the portfolio document.
+
+    The broker sync metadata is written last, in the same ordered bulk write: if any order write fails the
+    following operations are skipped, so the checkpoint never gets ahead of the stored orders.
+    With the 'collection' storage, orders are upserted in the orders collection first; they are keyed by order id,
+    so replaying them after a failed flush is harmless.
+    The user document only mirrors the sync metadata, after the portfolio write succeeded.
+    '''
+    def __init__(self, ptf: 'Portfolio'):
+        self.ptf = ptf
+        self._operations: List[Tuple[str, UpdateOne]] = []
+        self._orders: List[Tuple[str, Dict[str, List[Order]]]] = []
+        self._embedded: List[Tuple[str, Dict[str, List[Order]]]] = [] # orders queued for the embedded storage
+        self._sync: List[Tuple[str, UpdateOne]] = []
+        self._user_update: Optional[Tuple[ObjectId, dict]] = None
+
+    def __len__(self) -> int:
+        return len(self._operations) + len(self._sync) + sum(len(o) for _, orders in self._orders for o in orders.values())
+
+    def push_securities(self, security_type: Literal['bonds', 'stocks'], securities: List[Security]):
+        '''Append whole securities, orders included, like Portfolio.push_securities'''
+        if securities:
+            self._operations.append((f'push {len(securities)} {security_type}', UpdateOne(
+                {'_id': self.ptf._id}, {'$push': {security_type: {'$each': Codec.encode_many(securities)}}})))
+            self._mark_stale([order.date for security in securities for order in security.orders if order.date])
+
+    def upsert_orders(self, security_type: Literal['bonds', 'stocks'], orders: Dict[str, List[Order]]):
+        '''Queue orders grouped by isin: missing securities are created and orders already stored with the same id replaced'''
+        securities = {security.isin: security for security in getattr(self.ptf, security_type)}
+        for isin, security_orders in orders.items():
+            if not security_orders:
+                continue
+            header = Codec.encode(securities[isin])
+            header['orders'] = []
+            self._operations.append((f'add {security_type} {isin}', UpdateOne(
+                {'_id': self.ptf._id, f'{security_type}.isin': {'$ne': isin}},
+                {'$push': {security_type: header}})))
+            if self.ptf.orders_storage == 'collection':
+                continue
+            # no longer applied once migrated to the collection storage (see flush); the version makes a running migration copy again
+            self._operations.append((f'pull {len(security_orders)} orders {isin}', UpdateOne(
+                {'_id': self.ptf._id, 'orders_storage': {'$ne': 'collection'}},
+                {'$pull': {f'{security_type}.$[elem].orders': {'order_id': {'$in': [order.order_id for order in security_orders]}}},
+                 '$inc': {'orders_version': 1}},
+                array_filters=[{'elem.isin': isin}])))
+            self._operations.append((f'push {len(security_orders)} orders {isin}', UpdateOne(
+                {'_id': self.ptf._id, 'orders_storage': {'$ne': 'collection'}},
+                {'$push': {f'{security_type}.$[elem].orders': {'$each': Codec.encode_many(security_orders)}},
+                 '$inc': {'orders_version': 1}},
+                array_filters=[{'elem.isin': isin}])))
+        if self.ptf.orders_storage == 'collection':
+            self._orders.append((security_type, orders))
+        else:
+            self._embedded.append((security_type, orders))
+        self._mark_stale([order.date for security_orders in orders.values() for order in security_orders if order.date])
+
+    def _mark_stale(self, dates: List[datetime]):
+        '''Materialized valuations (get_ptf_value) and month-end snapshots (SnapshotStore) are stale from the first day changed'''
+        if not dates:
+            return
+        first_day = min(dates).replace(hour=0, minute=0, second=0, microsecond=0)
+        self._operations.append(('mark valuations stale', UpdateOne(
+            {'_id': self.ptf._id, 'valuations.0': {'$exists': True}},
+            {'$min': {'valuations.$[].dirty_from': first_day}, '$inc': {'valuations.$[].version': 1}})))
+        self._operations.append(('mark snapshots stale', UpdateOne(
+            {'_id': self.ptf._id}, {'$min': {'snapshots_stale_from': first_day}, '$inc': {'snapshots_version': 1}})))
+
+    def set_sync(self, broker: str, checkpoint: dict, user_id: Optional[Union[str, ObjectId]] = None):
+        '''Queue the broker sync checkpoint and update date, stored in the portfolio and mirrored in the user document'''
+        now = datetime.now(timezone.utc)
+        self.ptf.brokersSync[broker] = {**checkpoint, 'last_update': now}
+        self._sync.append((f'sync {broker}', UpdateOne(
+            {'_id': self.ptf._id}, {'$set': {f'brokersSync.{broker}': self.ptf.brokersSync[broker]}})))
+        if user_id is not None:
+            self._user_update = (ObjectId(user_id), {f'brokersLastUpdate.{broker}': now, f'brokersSync.{broker}': checkpoint})
+
+    def flush(self) -> List[dict]:
+        '''
+        Write everything queued and return one result per operation: {'op', 'status' ('ok', 'failed' or 'skipped'), 'error'}.
+        Raise PortfolioWriteError, carrying that report, when an operation failed.
+        '''
+        ptf = self.ptf
+        report = []
+        try:
+            for security_type, orders in self._orders:
+                for result in ptf._order_store.upsert(ptf._id, security_type, orders):
+                    report.append({'op': f'upsert {security_type} orders', 'status': 'ok', 'error': None,
+                                   'upserted': result.upserted_count, 'modified': result.modified_count})
+        except PyMongoError as e:
+            report.append({'op': 'upsert orders', 'status': 'failed', 'error': str(e)})
+            report += [{'op': label, 'status': 'skipped', 'error': None} for label, _ in self._operations + self._sync]
+            raise PortfolioWriteError(f'Orders write failed for portfolio {ptf._id}: {e}', report)
+
+        labels, operations = [], []
+        if self._operations or self._sync:
+            labels.append('create portfolio')
+            operations.append(UpdateOne(
+                {'_id': ptf._id},
+                {'$setOnInsert': {'name': ptf.name, 'orders_storage': ptf.orders_storage, 'stocks': [], 'bonds': []}},
+                upsert=True))
+        for label, operation in self._operations + self._sync:
+            labels.append(label)
+            operations.append(operation)
+
+        if operations:
+            try:
+                ptf._mongo_client.investments.portfolios.bulk_write(operations, ordered=True)
+            except BulkWriteError as e:
+                errors = {error['index']: error['errmsg'] for error in e.details.get('writeErrors', [])}
+                failed_at = min(errors) if errors else len(operations)
+                for index, label in enumerate(labels):
+                    status = 'ok' if index < failed_at else 'failed' if index in errors else 'skipped'
+                    report.append({'op': label, 'status': status, 'error': errors.get(index)})
+                failed_op = labels[failed_at] if failed_at < len(labels) else 'write concern'
+                raise PortfolioWriteError(f'Portfolio {ptf._id} write failed at "{failed_op}": {errors.get(failed_at, e)}', report)
+            report += [{'op': label, 'status': 'ok', 'error': None} for label in labels]
+            if self._embedded:
+                self._reroute(report)
+
+        if self._user_update:
+            user_id, update = self._user_update
+            try:
+                ptf._mongo_client.users.users.update_one({'_id': user_id}, {'$set': update})
+                report.append({'op': 'user sync metadata', 'status': 'ok', 'error': None})
+            except PyMongoError as e:
+                # the portfolio holds the checkpoint: the user document is only a mirror
+                logging.warning(f'User {user_id} sync metadata not updated: {e}')
+                report.append({'op': 'user sync metadata', 'status': 'failed', 'error': str(e)})
+
+        self._operations, self._orders, self._embedded, self._sync, self._user_update = [], [], [], [], None
+        return report
+
+    def _reroute(self, report: List[dict]):
+        '''Orders queued as embedded while the portfolio was migrated to the orders collection were skipped: write them there'''
+        ptf = self.ptf
+        doc = ptf._mongo_client.investments.portfolios.find_one({'_id': ptf._id}, {'orders_storage': 1}) or {}
+        if doc.get('orders_storage') != 'collection':
+            return
+        ptf.orders_storage = 'collection'
+        try:
+            for security_type, orders in self._embedded:
+                ptf._order_store.upsert(ptf._id, security_type, orders)
+        except PyMongoError as e:
+            report.append({'op': 'reroute orders to the collection', 'status': 'failed', 'error': str(e)})
+            raise PortfolioWriteError(f'Portfolio {ptf._id} was migrated during the write, orders not rerouted: {e}', report)
+        logging.info(f'Portfolio {ptf._id} migrated during the write: orders rerouted to the orders collection')
+        report.append({'op': 'reroute orders to the collection', 'status': 'ok', 'error': None})
@@ -2,14 +2,18 @@ import logging
 from django.shortcuts import redirect
 from django.urls import reverse
 from master.mongoDB import mongo_client
-from datetime import datetime
-from typing import TYPE_CHECKING
+from datetime import datetime, timedelta
+import re
+from typing import TYPE_CHECKING, Dict, List, Optional, Pattern, Set, Tuple
+from django.conf import settings
 from django.utils.deprecation import MiddlewareMixin
 from classes.users import User
 from django.contrib import messages
 from bson import ObjectId
 from urllib.parse import urlencode
-from django.urls import get_resolver
+from django.urls import get_resolver, URLResolver
+from django.urls.resolvers import RoutePattern
+from mylibs.tokenCache import TokenCache
 
 import ipdb
 
@@ -19,6 +23,10 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger('myapp')
 
+TOKEN_DURATION = getattr(settings, 'AUTH_TOKEN_DURATION', 20)
+TOKEN_REFRESH = timedelta(minutes=getattr(settings, 'AUTH_TOKEN_REFRESH', 10))
+token_cache = TokenCache(maxsize=getattr(settings, 'AUTH_TOKEN_CACHE_SIZE', 10000), ttl=getattr(settings, 'AUTH_TOKEN_CACHE_TTL', 60))
+
 
 def save_request(request: 'HttpRequest') -> None:
     if request.method == 'GET':
@@ -29,36 +37,102 @@ def save_request(request: 'HttpRequest') -> None:
         logger.warning(f"Method '{request.method}' not supported in redirection")
     request.session['original_request'] = original_request
 
-def endpoints(urllist, depth=0) ->list:
-    '''https://gist.github.com/ashishtajane/6531000f8c830717fe62
+class RouteIndex():
+    '''
+    Route table compiled once from the url conf, for the decisions taken on unauthenticated requests.
 
-    usage:
-    endpoints_list = endpoints(get_resolver().url_patterns)
-    
+    Paths without converters are kept in a set, the others as full regexes bucketed by their first path segment,
+    and the public prefixes (e.g. /login) in a segment trie: both lookups cost the same whatever the size of the url conf.
     '''
-    paths = []
-    for entry in urllist:
-        paths.append(entry.pattern)
-        if hasattr(entry, 'url_patterns'):
-            endpoints(entry.url_patterns, depth + 1)
-    return paths
+    _end = object() # trie marker of a public prefix
+
+    def __init__(self, url_patterns: list, public_prefixes: Tuple[str, ...] = ('/login',)):
+        self.static: Set[str] = set()
+        self.dynamic: Dict[Optional[str], List[Pattern]] = {}
+        self._public: dict = {}
+        self._add(url_patterns, '', '')
+        for prefix in public_prefixes:
+            node = self._public
+            for segment in self._segments(prefix):
+                node = node.setdefault(segment, {})
+            node[self._end] = True
+
+    def _add(self, url_patterns: list, route: Optional[str], regex: str):
+        '''`route` is the route text of the parents, None below a regex pattern'''
+        for entry in url_patterns:
+            pattern = entry.pattern
+            entry_regex = regex + pattern.regex.pattern.lstrip('^')
+            entry_route = route + str(pattern) if route is not None and isinstance(pattern, RoutePattern) else None
+            if isinstance(entry, URLResolver):
+                self._add(entry.url_patterns, entry_route, entry_regex)
+            elif entry_route is not None and '<' not in entry_route:
+                self.static.add('/' + entry_route)
+            else:
+                # bucketed by the first segment when it is literal, None otherwise
+                first = entry_route.split('/', 1)[0] if entry_route and '/' in entry_route else None
+                if first is not None and '<' in first:
+                    first = None
+                self.dynamic.setdefault(first, []).append(re.compile('^' + entry_regex))
+
+    def resolvable(self, path: str) -> bool:
+        '''Whether the path matches a route'''
+        if path in self.static:
+            return True
+        first = path[1:].split('/', 1)[0]
+        return any(regex.match(path[1:]) for regex in self.dynamic.get(first, []) + self.dynamic.get(None, []))
+
+    def is_public(self, path: str) -> bool:
+        '''Whether the path is under a public prefix'''
+        node = self._public
+        for segment in self._segments(path):
+            if self._end in node:
+                return True
+            node = node.get(segment)
+            if node is None:
+                return False
+        return self._end in node
+
+    @staticmethod
+    def _segments(path: str) -> List[str]:
+        return [segment for segment in path.split('/') if segment]
+
+
+def validate_token(token: str):
+    '''Cached token entry (user id, expiration), read from `users.tokens` on a cache miss. None for an unknown token'''
+    entry = token_cache.get(token)
+    if entry is None:
+        identification = mongo_client.users.tokens.find_one({"token.value": token})
+        if identification:
+            entry = token_cache.put(token, identification['_id'], identification['token']['expiration'])
+    return entry
 
 
 class AuthRequiredMiddleware(MiddlewareMixin):
+    '''
+    Session check of every request outside /login, from the `token` and `client_id` cookies.
+
+    Validated tokens are cached in process (see TokenCache), and a token is only rotated once less than
+    AUTH_TOKEN_REFRESH is left before its expiration, so most requests do not touch the database.
+    '''
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.routes = RouteIndex(get_resolver().url_patterns)
+
     def process_request(self, request: 'HttpRequest'):
         # Skip authentication for login and static pages
-        if request.path.startswith('/login'):
+        if self.routes.is_public(request.path):
             return None  # Return None to continue processing the request
         
         is_authenticated = False
         token = request.COOKIES.get('token', None)
         client_id = request.COOKIES.get('client_id', None)
         if token:
-            identification = mongo_client.users.tokens.find_one({"token.value": token})
+            identification = validate_token(token)
             if identification:
-                expiration = identification['token']['expiration']
-                if expiration >= datetime.now() and identification['_id'] == ObjectId(client_id):
+                expiration = identification.expiration
+                if expiration >= datetime.now() and ObjectId.is_valid(client_id) and identification.user_id == ObjectId(client_id):
                     is_authenticated = True
+                    request.token_expiration = expiration
                 else:
                     logger.warning(f"Token expired for user {client_id}. Redirecting to login.")
                     messages.error(request, "Your session has expired. Please log in again.")
@@ -70,29 +144,30 @@ class AuthRequiredMiddleware(MiddlewareMixin):
             messages.error(request, "You are not logged in. Please log in to continue.")
             
         if not is_authenticated:
-            endpoints_list = endpoints(get_resolver().url_patterns) # WIP: move this verification to the top and redirect to home if not request.path not in endpoints_list
-            # ipdb.set_trace()
-            if request.path in endpoints_list:
+            if self.routes.resolvable(request.path): # only real endpoints are worth coming back to after login
                 save_request(request)
             return redirect(reverse('user:index'))  # Redirect unauthenticated users
 
     def process_response(self, request: 'HttpRequest', response: 'HttpResponse'):
         # Skip token update for login and static pages
-        if request.path.startswith('/login'):
+        if self.routes.is_public(request.path):
             return response
         
-        # Update the token if the response status is 2xx or 3xx
-        if response.status_code // 100 in [2, 3]:
+        # Sliding expiry: rotate the token when the response status is 2xx or 3xx and it is close to expire
+        expiration = getattr(request, 'token_expiration', None)
+        if response.status_code // 100 in [2, 3] and expiration and expiration - datetime.now() < TOKEN_REFRESH:
             old_token_value = request.COOKIES.get('token')
-            if old_token_value:
-                new_token = User.generate_token(duration=20)
-                mongo_client.users.tokens.find_one_and_update(
-                    {'token.value': old_token_value}, 
-                    {'$set': {'token': new_token}}
-                )
+            new_token = User.generate_token(duration=TOKEN_DURATION)
+            identification = mongo_client.users.tokens.find_one_and_update(
+                {'token.value': old_token_value}, 
+                {'$set': {'token': new_token}}
+            )
+            token_cache.invalidate(old_token_value)
+            if identification: # None when a concurrent request already rotated it
+                token_cache.put(new_token['value'], identification['_id'], new_token['expiration'])
                 response.set_cookie(
                     'token', new_token.get('value'), 
                     max_age=int(120*60), # higher number than internal token duration to inform the user of its deconnexion
                     secure=True, httponly=True
                 )
-        return response
\ No newline at end of file
+        return response
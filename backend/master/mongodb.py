@@ -1,5 +1,13 @@
+import asyncio
+import weakref
 from pymongo import MongoClient
 from django.conf import settings
+try:
+    from pymongo import AsyncMongoClient # pymongo >= 4.9
+except ImportError:
+    from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+
+from mylibs.exchangeRate import ExchangeRate, RateStore
 
 mongo_status = getattr(settings, 'MONGO_ONLINE', None)
 if mongo_status:
@@ -7,4 +15,20 @@ if mongo_status:
 else:
     url = None
 
-mongo_client = MongoClient(url)
\ No newline at end of file
+mongo_client = MongoClient(url)
+_async_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncMongoClient]' = weakref.WeakKeyDictionary()
+
+def get_async_mongo_client() -> AsyncMongoClient:
+    '''
+    Return the async client of the running event loop, for the async views.
+    An async client is bound to the loop it first ran on, so each loop (the ASGI one, asyncio.run in scripts) gets its own.
+    PyMongo's async api is used when available, Motor otherwise.
+    '''
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncMongoClient(url)
+    return client
+
+# same database as the portfolios, for $lookup. Rates stored before in `fx` are copied over on first use
+ExchangeRate.store = RateStore(mongo_client, database='investments', fallback='fx')
\ No newline at end of file
@@ -85,6 +85,20 @@ WSGI_APPLICATION = 'master.wsgi.application'
 MONGO_API = ApiKeys.mongo
 MONGO_ONLINE = True
 
+# Session tokens (AuthRequiredMiddleware)
+AUTH_TOKEN_DURATION = 20 # minutes
+AUTH_TOKEN_REFRESH = 10 # minutes: the token is rotated once less than this is left
+AUTH_TOKEN_CACHE_TTL = 60 # seconds a validated token is trusted without reading the database
+AUTH_TOKEN_CACHE_SIZE = 10000
+
+# Daily close history used by the portfolio valuation (mylibs.priceStore)
+PRICE_STORE_DIR = BASE_DIR / 'data' / 'prices'
+PRICE_LOOKBACK_DAYS = 10 # older closes are not forward filled: the order prices are used, with a warning
+
+# Password hashing (mylibs.passwordHasher): stored hashes with another work factor are rehashed at login
+PASSWORD_HASH_ROUNDS = 12
+PASSWORD_HASH_WORKERS = None # defaults to min(4, cpu count)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -158,4 +172,7 @@ LOGGING = {
             'propagate': False,
         },
     },
-}
\ No newline at end of file
+}
+# SEC filings (backendApi.methods.get_sec_urls): local copy of https://www.sec.gov/files/company_tickers.json
+# used as ticker -> CIK map without network; None downloads it once a day
+SEC_TICKERS_FILE = None
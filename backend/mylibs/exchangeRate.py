@@ -1,8 +1,21 @@
-import requests
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Union, List, Optional
+from typing import Union, List, Optional, Dict, Tuple, ClassVar, TYPE_CHECKING
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, date, timedelta
+from pymongo import UpdateOne
+
+from mylibs.transport import get_session
+
+if TYPE_CHECKING:
+    from pymongo import MongoClient
+    from pymongo.collection import Collection
+
+
+logger = logging.getLogger('myapp')
+
 
 class ExchangeRateError(Exception):
     pass
@@ -10,54 +23,81 @@ class ExchangeRateError(Exception):
 @dataclass
 class ExchangeRate():
     base_url = "https://www.frankfurter.app/"
+    store: ClassVar[Optional['RateStore']] = None # when set, rates are served from the local store
+    max_workers: ClassVar[int] = 8 # concurrent requests when a range spans several years
 
     @staticmethod
     def convert(targets_codes: Union[str, List[str]], base_code: str = 'EUR', date_from: Optional[str] = None, date_to: Optional[str] = None, amount: int = 1) -> pd.DataFrame:
         '''Date format must be YYYY-MM-DD'''
         if not date_to:
-            date_to = datetime.now().strftime("%Y-%m-%d")        
-        if date_from: # from date to date/now
-            date_to_year = int(date_to[:4])
-            date_from_year = int(date_from[:4])
-            prefixes = []
-            prefixes.append(date_from+".."+str(date_from_year)+'-12-31')
-            for year in range(date_from_year+1, date_to_year):
-                prefixes.append(str(year)+'-01-01'+'..'+str(year)+'-12-31')
-            prefixes.append(str(date_to_year)+'-01-01'+".."+date_to)
-        elif date_to: # only specified date
-            prefixes = [date_to]
-        else: # only now
-            prefixes = ['latest']
+            date_to = datetime.now().strftime("%Y-%m-%d")
 
         if isinstance(targets_codes, str):
             targets_codes = [targets_codes]
 
         gbx = False
         if "GBX" in targets_codes:
-            targets_codes = list(map(lambda x: x.replace('GBX','GBP'), targets_codes))
+            targets_codes = list(dict.fromkeys(map(lambda x: x.replace('GBX','GBP'), targets_codes)))
             gbx = True
 
-        params = {
-            'from': base_code,
-            'to': ",".join(targets_codes),
-            'amount': amount
-        }
-        dfs = []
-        for prefix in prefixes:
-            df = ExchangeRate._fetch_data(prefix, params)
-            dfs.append(df)
-        full_df = pd.concat(dfs)
+        if ExchangeRate.store is not None:
+            full_df = ExchangeRate.store.get_rates(base_code, targets_codes, date_from or date_to, date_to) * amount
+        else:
+            params = {
+                'from': base_code,
+                'to': ",".join(targets_codes),
+                'amount': amount
+            }
+            if date_from:
+                full_df = ExchangeRate._fetch_prefixes(ExchangeRate._prefixes(date_from, date_to), params)
+                full_df = ExchangeRate._daily(full_df, date_from, date_to)
+            else:
+                full_df = ExchangeRate._fetch_data(date_to, params)
         if gbx:
             full_df['GBX'] = full_df['GBP']*100
         return full_df
 
+    @staticmethod
+    def _prefixes(date_from: str, date_to: str) -> List[str]:
+        '''Split a date range into one url prefix per calendar year'''
+        date_to_year = int(date_to[:4])
+        date_from_year = int(date_from[:4])
+        if date_from_year == date_to_year:
+            return [date_from+".."+date_to]
+        prefixes = []
+        prefixes.append(date_from+".."+str(date_from_year)+'-12-31')
+        for year in range(date_from_year+1, date_to_year):
+            prefixes.append(str(year)+'-01-01'+'..'+str(year)+'-12-31')
+        prefixes.append(str(date_to_year)+'-01-01'+".."+date_to)
+        return prefixes
+
+    @staticmethod
+    def _fetch_prefixes(prefixes: List[str], params: dict) -> pd.DataFrame:
+        '''Fetch the yearly chunks concurrently (at most `max_workers` at once) and merge them on their dates'''
+        if len(prefixes) == 1:
+            dfs = [ExchangeRate._fetch_data(prefixes[0], params)]
+        else:
+            with ThreadPoolExecutor(max_workers=min(ExchangeRate.max_workers, len(prefixes))) as executor:
+                dfs = list(executor.map(lambda prefix: ExchangeRate._fetch_data(prefix, params), prefixes))
+        full_df = pd.concat(dfs)
+        return full_df[~full_df.index.duplicated(keep='last')].sort_index()
+
+    @staticmethod
+    def _daily(df: pd.DataFrame, date_from: str, date_to: str) -> pd.DataFrame:
+        '''Reindex business day rates on every calendar day, weekends and holidays taking the previous rate'''
+        days = pd.date_range(date_from, date_to, freq='D')
+        df.index = pd.to_datetime(df.index)
+        df = df.reindex(df.index.union(days)).ffill().bfill().reindex(days)
+        df.index = df.index.strftime('%Y-%m-%d')
+        return df
+
     @staticmethod
     def _fetch_data(prefix, params):
         try:
-            response = requests.get(url=ExchangeRate.base_url+prefix, params=params)
+            response = get_session().get(url=ExchangeRate.base_url+prefix, params=params)
             data = response.json()
         except Exception as e:
-            raise ExchangeRateError(f"Error accessing exchange rate: {e} with pair {params['from']}/{params['to']} - {response}")
+            raise ExchangeRateError(f"Error accessing exchange rate: {e} with pair {params['from']}/{params['to']}")
 
         error = data.get('message')
         if error:
@@ -70,4 +110,165 @@ class ExchangeRate():
                 df  = pd.DataFrame.from_dict(data['rates'], orient='index')
         except Exception as e:
             raise ExchangeRateError(f"Error parsing rates with pair {params['from']}/{params['to']} on section {prefix} : {e}")
-        return df
\ No newline at end of file
+        return df
+
+
+class RateStore():
+    '''
+    Local exchange rate store keyed by (base, quote, date).
+
+    Rates are persisted in the `rates` collection of `database` (`fx` by default) and the covered date range of each pair in `coverage`.
+    Each pair is loaded once in memory, and only the dates outside its covered range are fetched from the api.
+    Without a mongo client the store only lives in memory.
+    Pairs missing from `database` are copied once from the `fallback` database if it holds them (e.g. after moving the store).
+    '''
+    lookback = 7 # days fetched before a requested range so weekends and holidays can be forward filled
+
+    def __init__(self, mongo_client: Optional['MongoClient'] = None, database: str = 'fx', fallback: Optional[str] = None):
+        self._db = mongo_client[database] if mongo_client is not None else None
+        self._fallback = mongo_client[fallback] if mongo_client is not None and fallback and fallback != database else None
+        self._rates: Dict[Tuple[str, str], pd.Series] = {}
+        self._coverage: Dict[Tuple[str, str], Tuple[date, date]] = {}
+        self._indexed = False
+        self._lock = threading.RLock()
+
+    def get_rates(self, base_code: str, targets_codes: List[str], date_from: Union[str, date], date_to: Union[str, date]) -> pd.DataFrame:
+        '''Return a daily frame (index YYYY-MM-DD, one column per target) of forward filled rates'''
+        start = self._to_date(date_from)
+        end = self._to_date(date_to)
+        with self._lock:
+            missing: Dict[Tuple[date, date], List[str]] = {}
+            for quote in targets_codes:
+                if quote == base_code:
+                    continue
+                for interval in self._missing((base_code, quote), start - timedelta(days=self.lookback), end):
+                    missing.setdefault(interval, []).append(quote)
+            for (fetch_from, fetch_to), quotes in missing.items():
+                self._fetch(base_code, quotes, fetch_from, fetch_to)
+
+            days = pd.date_range(start, end, freq='D')
+            columns = {}
+            for quote in targets_codes:
+                if quote == base_code:
+                    columns[quote] = pd.Series(1.0, index=days)
+                    continue
+                series = self._rates.get((base_code, quote), self._empty())
+                window = series.loc[pd.Timestamp(start - timedelta(days=self.lookback)):pd.Timestamp(end)]
+                columns[quote] = window.reindex(window.index.union(days)).ffill().reindex(days)
+        df = pd.DataFrame(columns, index=days)
+        df.index = df.index.strftime('%Y-%m-%d')
+        return df
+
+    @property
+    def collection(self) -> Optional['Collection']:
+        '''Persisted rates ({base, quote, date: 'YYYY-MM-DD', rate}), e.g. for $lookup stages. None without a mongo client'''
+        return self._db.rates if self._db is not None else None
+
+    def _missing(self, pair: Tuple[str, str], start: date, end: date) -> List[Tuple[date, date]]:
+        self._load(pair)
+        coverage = self._coverage.get(pair)
+        if coverage is None:
+            return [(start, end)]
+        low, high = coverage
+        intervals = []
+        if start < low:
+            intervals.append((start, low - timedelta(days=1)))
+        if end > high:
+            intervals.append((high + timedelta(days=1), end))
+        return intervals
+
+    def _load(self, pair: Tuple[str, str]):
+        if pair in self._rates or self._db is None:
+            return
+        base, quote = pair
+        coverage = self._db.coverage.find_one({'_id': f'{base}/{quote}'})
+        if not coverage:
+            coverage = self._copy_fallback(pair)
+        if not coverage:
+            return
+        docs = list(self._db.rates.find({'base': base, 'quote': quote}, {'_id': 0, 'date': 1, 'rate': 1}))
+        self._rates[pair] = pd.Series({doc['date']: doc['rate'] for doc in docs}, dtype=float).sort_index()
+        self._rates[pair].index = pd.to_datetime(self._rates[pair].index)
+        self._coverage[pair] = (self._to_date(coverage['from']), self._to_date(coverage['to']))
+        logger.debug(f'{len(docs)} rates loaded from store for {base}/{quote}')
+
+    def _copy_fallback(self, pair: Tuple[str, str]) -> Optional[dict]:
+        '''Copy the rates and coverage of `pair` from the fallback database, return the coverage (None if not held there)'''
+        if self._fallback is None:
+            return None
+        base, quote = pair
+        coverage = self._fallback.coverage.find_one({'_id': f'{base}/{quote}'})
+        if not coverage:
+            return None
+        self._ensure_indexes()
+        operations = [
+            UpdateOne({'base': base, 'quote': quote, 'date': doc['date']}, {'$setOnInsert': {'rate': doc['rate']}}, upsert=True)
+            for doc in self._fallback.rates.find({'base': base, 'quote': quote}, {'_id': 0, 'date': 1, 'rate': 1})
+        ]
+        if operations:
+            self._db.rates.bulk_write(operations, ordered=False)
+        # coverage written last: an interrupted copy is simply restarted on the next load
+        self._db.coverage.update_one({'_id': coverage['_id']}, {'$setOnInsert': coverage}, upsert=True)
+        logger.info(f'{len(operations)} rates of {base}/{quote} copied from {self._fallback.name} to {self._db.name}')
+        return coverage
+
+    def _fetch(self, base_code: str, quotes: List[str], fetch_from: date, fetch_to: date):
+        today = date.today()
+        if fetch_from > today:
+            return
+        fetch_to = min(fetch_to, today)
+        params = {'from': base_code, 'to': ",".join(quotes), 'amount': 1}
+        prefixes = ExchangeRate._prefixes(fetch_from.isoformat(), fetch_to.isoformat())
+        try:
+            df = ExchangeRate._fetch_prefixes(prefixes, params)
+        except ExchangeRateError as e:
+            if all((base_code, quote) in self._rates for quote in quotes):
+                logger.warning(f'{e} - serving {base_code}/{quotes} from local store only')
+                return
+            raise
+        df.index = pd.to_datetime(df.index)
+
+        # today's rate may not be published yet, so it is never marked as covered
+        covered_to = min(fetch_to, today - timedelta(days=1))
+        for quote in quotes:
+            pair = (base_code, quote)
+            fetched = df[quote].dropna() if quote in df else self._empty()
+            held = self._rates.get(pair)
+            self._rates[pair] = fetched if held is None else pd.concat([held, fetched]).groupby(level=0).last().sort_index()
+            low, high = self._coverage.get(pair, (fetch_from, covered_to))
+            self._coverage[pair] = (min(low, fetch_from), max(high, covered_to))
+            self._save(pair, fetched)
+
+    def _save(self, pair: Tuple[str, str], rates: pd.Series):
+        if self._db is None:
+            return
+        self._ensure_indexes()
+        base, quote = pair
+        operations = [
+            UpdateOne({'base': base, 'quote': quote, 'date': day}, {'$set': {'rate': float(rate)}}, upsert=True)
+            for day, rate in zip(rates.index.strftime('%Y-%m-%d'), rates.to_numpy())
+        ]
+        if operations:
+            self._db.rates.bulk_write(operations, ordered=False)
+        low, high = self._coverage[pair]
+        self._db.coverage.update_one(
+            {'_id': f'{base}/{quote}'},
+            {'$set': {'base': base, 'quote': quote, 'from': low.isoformat(), 'to': high.isoformat()}},
+            upsert=True)
+
+    def _ensure_indexes(self):
+        if not self._indexed:
+            self._db.rates.create_index([('base', 1), ('quote', 1), ('date', 1)], unique=True)
+            self._indexed = True
+
+    @staticmethod
+    def _empty() -> pd.Series:
+        return pd.Series(dtype=float, index=pd.DatetimeIndex([]))
+
+    @staticmethod
+    def _to_date(value: Union[str, date, datetime]) -> date:
+        if isinstance(value, datetime):
+            return value.date()
+        if isinstance(value, date):
+            return value
+        return datetime.strptime(value[:10], '%Y-%m-%d').date()
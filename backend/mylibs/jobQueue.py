@@ -0,0 +1,128 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Optional, Tuple, Type, Union, TYPE_CHECKING
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+if TYPE_CHECKING:
+    from pymongo import MongoClient
+
+
+logger = logging.getLogger("myapp")
+
+
+def job_status(job: dict) -> dict:
+    '''Public view of a job document, as returned by the polling endpoints'''
+    return {
+        'job_id': str(job['_id']),
+        'status': job['status'],
+        'progress': job.get('progress', {}),
+        'result': job.get('result'),
+        'error': job.get('error'),
+        'error_type': job.get('error_type'),
+        'created': job['created'],
+        'updated': job['updated'],
+    }
+
+def job_http_status(job: dict) -> int:
+    '''HTTP status of the polling response: the status recorded for the error of a failed job, 200 otherwise'''
+    return job.get('http_status') or 200
+
+class JobQueue():
+    '''
+    In-process job queue persisted in the `jobs.jobs` collection.
+
+    Jobs run on a local thread pool and report their progress in their mongo document, which is what the polling endpoints read.
+    A user has at most one active (queued or running) job per kind: submitting again returns the active job.
+    An active job without progress for `stale_after` is considered dead (e.g. worker restarted) and no longer blocks new submissions.
+    A failed job records the type of its error and an HTTP status from `error_statuses` (by exception class, 500 for the others).
+    '''
+    def __init__(self, mongo_client: 'MongoClient', kind: str, max_workers: int = 2, stale_after: timedelta = timedelta(minutes=15),
+                 error_statuses: Optional[Dict[Type[Exception], int]] = None):
+        self.kind = kind
+        self.stale_after = stale_after
+        self.error_statuses = error_statuses or {}
+        self._jobs = mongo_client.jobs.jobs
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'{kind}-jobs')
+        self._indexed = False
+        self._lock = threading.Lock()
+
+    def submit(self, user_id: Union[str, ObjectId], func: Callable, *args, **kwargs) -> Tuple[ObjectId, bool]:
+        '''
+        Queue `func(*args, progress=..., **kwargs)` for the user. `progress(**fields)` stores fields in the job progress.
+        Return the job id, and whether it was created (False when an active job already exists for the user).
+        '''
+        self._ensure_indexes()
+        user_id = ObjectId(user_id)
+        now = datetime.now(timezone.utc)
+        job = {
+            'kind': self.kind,
+            'user_id': user_id,
+            'status': 'queued',
+            'active': True,
+            'progress': {},
+            'result': None,
+            'error': None,
+            'error_type': None,
+            'http_status': None,
+            'created': now,
+            'updated': now,
+        }
+        with self._lock:
+            try:
+                job_id = self._jobs.insert_one(job).inserted_id
+            except DuplicateKeyError:
+                active = self._jobs.find_one({'kind': self.kind, 'user_id': user_id, 'active': True})
+                if active and active['updated'].replace(tzinfo=timezone.utc) > now - self.stale_after:
+                    logger.info(f"{self.kind} job {active['_id']} already active for user {user_id}")
+                    return active['_id'], False
+                if active:
+                    self._finish(active['_id'], 'failed', error='Job stalled', http_status=500)
+                job.pop('_id', None)
+                job_id = self._jobs.insert_one(job).inserted_id
+        self._executor.submit(self._run, job_id, func, args, kwargs)
+        logger.info(f'{self.kind} job {job_id} queued for user {user_id}')
+        return job_id, True
+
+    def get(self, job_id: Union[str, ObjectId], user_id: Optional[Union[str, ObjectId]] = None) -> Optional[dict]:
+        query = {'_id': ObjectId(job_id), 'kind': self.kind}
+        if user_id is not None:
+            query['user_id'] = ObjectId(user_id)
+        return self._jobs.find_one(query)
+
+    def _run(self, job_id: ObjectId, func: Callable, args: tuple, kwargs: dict):
+        self._jobs.update_one({'_id': job_id}, {'$set': {'status': 'running', 'updated': datetime.now(timezone.utc)}})
+
+        def progress(**fields):
+            update = {f'progress.{key}': value for key, value in fields.items()}
+            update['updated'] = datetime.now(timezone.utc)
+            self._jobs.update_one({'_id': job_id}, {'$set': update})
+
+        try:
+            result = func(*args, progress=progress, **kwargs)
+        except Exception as e:
+            logger.exception(f'{self.kind} job {job_id} failed')
+            self._finish(job_id, 'failed', error=str(e), error_type=type(e).__name__, http_status=self._http_status(e))
+        else:
+            self._finish(job_id, 'done', result=result)
+
+    def _http_status(self, error: Exception) -> int:
+        '''Status of the closest class of the error in `error_statuses`'''
+        return next((self.error_statuses[cls] for cls in type(error).__mro__ if cls in self.error_statuses), 500)
+
+    def _finish(self, job_id: ObjectId, status: str, result=None, error: Optional[str] = None, error_type: Optional[str] = None,
+                http_status: Optional[int] = None):
+        self._jobs.update_one(
+            {'_id': job_id},
+            {'$set': {'status': status, 'active': False, 'result': result, 'error': error, 'error_type': error_type,
+                      'http_status': http_status, 'updated': datetime.now(timezone.utc)}})
+
+    def _ensure_indexes(self):
+        if self._indexed:
+            return
+        self._jobs.create_index(
+            [('kind', 1), ('user_id', 1)], unique=True, name='one_active_job_per_user',
+            partialFilterExpression={'active': True})
+        self._indexed = True
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Optional
+
+import bcrypt
+
+logger = logging.getLogger("myapp")
+
+
+class PasswordHasherBusyError(Exception):
+    pass
+
+
+class PasswordHasher():
+    '''
+    Bounded bcrypt pool, so a login burst queues on a few dedicated threads instead of stalling every request worker.
+
+    bcrypt releases the GIL while hashing, so threads run in parallel on several cores without the pickling of a process pool.
+    At most `max_pending` hashes are queued or running: beyond that, calls wait `wait_timeout` seconds then raise PasswordHasherBusyError.
+    `rounds` is the bcrypt work factor of new hashes; `needs_rehash` tells when a stored hash uses another one.
+    '''
+    def __init__(self, rounds: int = 12, max_workers: Optional[int] = None, max_pending: Optional[int] = None, wait_timeout: float = 10):
+        self.rounds = rounds
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.wait_timeout = wait_timeout
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(max_pending or self.max_workers * 8)
+
+    def hash(self, password: str) -> bytes:
+        return self._submit(self._hash, password).result()
+
+    def verify(self, password: str, hashed: bytes) -> bool:
+        return self._submit(self._verify, password, hashed).result()
+
+    async def ahash(self, password: str) -> bytes:
+        return await asyncio.wrap_future(await asyncio.to_thread(self._submit, self._hash, password))
+
+    async def averify(self, password: str, hashed: bytes) -> bool:
+        return await asyncio.wrap_future(await asyncio.to_thread(self._submit, self._verify, password, hashed))
+
+    def needs_rehash(self, hashed: bytes) -> bool:
+        '''Whether the hash was made with another work factor than `rounds` ($2b$<rounds>$...)'''
+        try:
+            return int(hashed.split(b'$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def _submit(self, func: Callable, *args) -> Future:
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            raise PasswordHasherBusyError(f'Password hashing pool saturated for {self.wait_timeout}s')
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _hash(self, password: str) -> bytes:
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=self.rounds))
+
+    @staticmethod
+    def _verify(password: str, hashed: bytes) -> bool:
+        return bcrypt.checkpw(password.encode('utf-8'), hashed)
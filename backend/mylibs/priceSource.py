@@ -0,0 +1,59 @@
+import logging
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Optional, Tuple
+import numpy as np
+import pandas as pd
+import requests
+
+from mylibs.transport import get_session
+
+logger = logging.getLogger("myapp")
+
+CHART_URL = 'https://query1.finance.yahoo.com/v8/finance/chart/{symbol}'
+HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"}
+# Trading212 ids end with the listing venue: AAPL_US_EQ, VODl_EQ (London), SAPd_EQ (Xetra), AIRp_EQ (Paris)...
+VENUE_SUFFIXES = {'l': '.L', 'd': '.DE', 'p': '.PA', 'a': '.AS', 'e': '.MC', 'm': '.MI', 'b': '.BR', 's': '.SW'}
+CURRENCIES = {'GBp': 'GBX'} # quotes in pence, converted through GBP by ExchangeRate
+
+
+class PriceSourceError(Exception):
+    pass
+
+
+def yahoo_symbol(t212_id: Optional[str]) -> Optional[str]:
+    '''Yahoo Finance symbol of a Trading212 instrument, None for an unknown venue'''
+    if not t212_id or not t212_id.endswith('_EQ'):
+        return None
+    if t212_id.endswith('_US_EQ'):
+        return t212_id[:-len('_US_EQ')].replace('.', '-')
+    suffix = VENUE_SUFFIXES.get(t212_id[-4])
+    return t212_id[:-4] + suffix if suffix else None
+
+def yahoo_closes(isin: str, symbol: Optional[str], date_from: date, date_to: date) -> Tuple[pd.Series, str]:
+    '''
+    Daily closes of `symbol` within the dates (pd.Series indexed by day) and their currency, from the Yahoo Finance chart api.
+    Source of PriceStore.refresh.
+    '''
+    if symbol is None:
+        raise PriceSourceError(f'No price symbol known for {isin}')
+    params = {
+        'period1': int(datetime.combine(date_from, time.min, tzinfo=timezone.utc).timestamp()),
+        'period2': int(datetime.combine(date_to + timedelta(days=1), time.min, tzinfo=timezone.utc).timestamp()),
+        'interval': '1d',
+    }
+    try:
+        response = get_session().get(CHART_URL.format(symbol=symbol), params=params, headers=HEADERS, timeout=10)
+        response.raise_for_status()
+        result = response.json()['chart']['result'][0]
+    except requests.RequestException as e:
+        raise PriceSourceError(f'Error fetching prices of {symbol}: {e}')
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        raise PriceSourceError(f'Error parsing prices of {symbol}: {e}')
+
+    meta = result['meta']
+    stamps = np.asarray(result.get('timestamp') or [], dtype='int64')
+    closes = result['indicators']['quote'][0].get('close') if len(stamps) else []
+    # timestamps are the session opens: shifted to the exchange time zone before taking the day
+    days = pd.to_datetime(stamps + meta.get('gmtoffset', 0), unit='s').normalize()
+    series = pd.Series(closes, index=days, dtype=float).dropna() # null closes on halted days
+    return series[~series.index.duplicated(keep='last')], CURRENCIES.get(meta['currency'], meta['currency'])
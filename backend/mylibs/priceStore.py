@@ -0,0 +1,150 @@
+import json
+import os
+import logging
+import threading
+import time
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple, Union
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("myapp")
+
+EPOCH = np.datetime64('1970-01-01', 'D')
+
+
+class PriceStoreError(Exception):
+    pass
+
+
+class PriceStore():
+    '''
+    Local append-only daily close history, one directory per instrument (isin):
+    `dates.i4` (int32 days since 1970-01-01) and `close.f8` (float64) are raw little-endian columns, read through np.memmap,
+    and `meta.json` holds the quote currency.
+
+    Rows are only appended after the last stored date, so readers never see a rewritten file.
+    `source(isin, ticker, date_from, date_to)` is an optional fetcher returning closes (pd.Series indexed by date)
+    and their currency, used by `refresh` to append the missing tail.
+    '''
+    def __init__(self, root: Union[str, Path], source: Optional[Callable[..., tuple]] = None, refresh_ttl: float = 3600):
+        self.root = Path(root)
+        self.source = source
+        self.refresh_ttl = refresh_ttl
+        self._refreshed: Dict[str, Tuple[float, date]] = {} # isin: (monotonic time, date_to) of the last fetch
+        self._lock = threading.Lock()
+
+    def append(self, isin: str, closes: pd.Series, currency: str) -> int:
+        '''Append the closes dated after the last stored one, return the number of rows added'''
+        closes = closes.dropna()
+        days = (pd.to_datetime(closes.index).to_numpy().astype('datetime64[D]') - EPOCH).astype('<i4')
+        order = np.argsort(days, kind='stable')
+        days, values = days[order], closes.to_numpy(dtype='<f8')[order]
+        with self._lock:
+            folder = self.root / isin
+            folder.mkdir(parents=True, exist_ok=True)
+            meta = self._meta(isin)
+            if meta and meta['currency'] != currency:
+                raise PriceStoreError(f"{isin} prices are stored in {meta['currency']}, not {currency}")
+            if not meta:
+                (folder / 'meta.json').write_text(json.dumps({'currency': currency}))
+            self._align(folder)
+            stored_days, _ = self._columns(isin)
+            if len(stored_days):
+                new = days > stored_days[-1]
+                days, values = days[new], values[new]
+            if len(days):
+                days, first = np.unique(days[::-1], return_index=True) # last value of a duplicated day wins
+                values = values[::-1][first]
+                # closes first: a crash between both writes leaves an extra close, ignored by `_columns` and cut by `_align`
+                with open(folder / 'close.f8', 'ab') as file:
+                    file.write(values.tobytes())
+                with open(folder / 'dates.i4', 'ab') as file:
+                    file.write(days.tobytes())
+        return len(days)
+
+    def read(self, isin: str, date_from: Optional[Union[str, date]] = None, date_to: Optional[Union[str, date]] = None) -> pd.Series:
+        '''Stored closes within the dates, as a float Series indexed by day (empty when unknown)'''
+        days, closes = self._columns(isin)
+        start = np.searchsorted(days, self._day(date_from)) if date_from is not None else 0
+        end = np.searchsorted(days, self._day(date_to), side='right') if date_to is not None else len(days)
+        index = pd.DatetimeIndex((days[start:end] + EPOCH).astype('datetime64[ns]'))
+        return pd.Series(np.array(closes[start:end]), index=index, dtype=float)
+
+    def last_date(self, isin: str) -> Optional[date]:
+        days, _ = self._columns(isin)
+        return (days[-1] + EPOCH).astype(object) if len(days) else None
+
+    def currency(self, isin: str) -> Optional[str]:
+        meta = self._meta(isin)
+        return meta['currency'] if meta else None
+
+    def refresh(self, securities: Dict[str, Optional[str]], date_from: Union[str, date], date_to: Union[str, date]) -> Dict[str, int]:
+        '''
+        Fetch from `source` and append the closes after the last stored date, for each {isin: ticker}.
+        An isin fetched up to `date_to` less than `refresh_ttl` seconds ago is skipped: today's close, weekends and holidays
+        have no price yet, and would be asked again on every call.
+        '''
+        if self.source is None:
+            return {}
+        added = {}
+        end = self._to_date(date_to)
+        for isin, ticker in securities.items():
+            last = self.last_date(isin)
+            start = max(self._to_date(date_from), last + timedelta(days=1)) if last else self._to_date(date_from)
+            if start > end:
+                continue
+            fetched_at, fetched_to = self._refreshed.get(isin, (None, None))
+            if fetched_at is not None and fetched_to >= end and time.monotonic() - fetched_at < self.refresh_ttl:
+                continue
+            try:
+                closes, currency = self.source(isin, ticker, start, end)
+                added[isin] = self.append(isin, closes, currency)
+            except Exception as e:
+                logger.warning(f'Prices of {isin} ({ticker}) not refreshed: {e}')
+                continue
+            finally:
+                self._refreshed[isin] = (time.monotonic(), end)
+        return added
+
+    def _columns(self, isin: str):
+        folder = self.root / isin
+        days = self._memmap(folder / 'dates.i4', '<i4')
+        closes = self._memmap(folder / 'close.f8', '<f8')
+        length = min(len(days), len(closes))
+        return days[:length], closes[:length]
+
+    @staticmethod
+    def _align(folder: Path):
+        '''Cut the rows left by an interrupted append (a close without date, a partial value) before appending after them'''
+        paths = {folder / 'dates.i4': 4, folder / 'close.f8': 8}
+        sizes = {path: path.stat().st_size if path.exists() else 0 for path in paths}
+        rows = min(sizes[path] // width for path, width in paths.items())
+        for path, width in paths.items():
+            if sizes[path] > rows * width:
+                logger.warning(f'{path} cut to {rows} rows after an interrupted append')
+                os.truncate(path, rows * width)
+
+    @staticmethod
+    def _memmap(path: Path, dtype: str) -> np.ndarray:
+        rows = path.stat().st_size // np.dtype(dtype).itemsize if path.exists() else 0
+        if rows == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(rows,)) # whole rows only
+
+    def _meta(self, isin: str) -> Optional[dict]:
+        path = self.root / isin / 'meta.json'
+        return json.loads(path.read_text()) if path.exists() else None
+
+    @classmethod
+    def _day(cls, value: Union[str, date]) -> int:
+        return int((np.datetime64(cls._to_date(value), 'D') - EPOCH).astype(int))
+
+    @staticmethod
+    def _to_date(value: Union[str, date, datetime]) -> date:
+        if isinstance(value, datetime):
+            return value.date()
+        if isinstance(value, date):
+            return value
+        return datetime.strptime(value[:10], '%Y-%m-%d').date()
@@ -0,0 +1,128 @@
+import time
+import random
+import asyncio
+import threading
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Mapping
+
+logger = logging.getLogger("myapp")
+
+
+@dataclass
+class EndpointState():
+    remaining: Optional[int] = None # calls left in the current window, None until the api tells us
+    reset: float = 0 # unix time at which the window resets
+    calls: int = 0
+    throttled: int = 0
+    errors: int = 0
+    total_latency: float = 0
+    max_latency: float = 0
+    next_slot: float = 0 # monotonic time of the next call allowed by the fixed rate
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+
+class RateLimiter():
+    '''
+    Client-side rate limiter following the `x-ratelimit-*` headers of the api, with one budget per endpoint.
+    For apis without such headers, `rate` spaces the calls of an endpoint to at most `rate` per second.
+
+    Use `RateLimiter.for_key(api_key)` so every thread calling the api with the same key shares the same limiter.
+    '''
+    _instances: Dict[str, 'RateLimiter'] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, base_delay: float = 1, max_delay: float = 60, rate: Optional[float] = None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.rate = rate
+        self._endpoints: Dict[str, EndpointState] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_key(cls, key: str, rate: Optional[float] = None) -> 'RateLimiter':
+        '''Limiter shared by every caller of `key`; `rate` applies when it is created'''
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(rate=rate)
+            return cls._instances[key]
+
+    def acquire(self, endpoint: str):
+        '''Block until a call to `endpoint` fits in the current window, then reserve it'''
+        while (wait := self._reserve(endpoint)) is not None:
+            logger.debug(f'Rate limit reached on {endpoint}, waiting {wait:.2f}s')
+            time.sleep(wait)
+        time.sleep(self._pace(endpoint))
+
+    async def aacquire(self, endpoint: str):
+        '''acquire for the event loop: waits without blocking it'''
+        while (wait := self._reserve(endpoint)) is not None:
+            logger.debug(f'Rate limit reached on {endpoint}, waiting {wait:.2f}s')
+            await asyncio.sleep(wait)
+        await asyncio.sleep(self._pace(endpoint))
+
+    def _reserve(self, endpoint: str) -> Optional[float]:
+        '''Reserve a call in the window of the headers and return None, or the seconds to wait before the window resets'''
+        state = self._state(endpoint)
+        with state.lock:
+            now = time.time()
+            if state.remaining is None or state.remaining > 0 or now >= state.reset:
+                if state.remaining is not None:
+                    state.remaining = state.remaining - 1 if now < state.reset else None
+                return None
+            return state.reset - now
+
+    def _pace(self, endpoint: str) -> float:
+        '''Reserve the next slot of the fixed rate and return the seconds to wait for it (0 without rate)'''
+        if not self.rate:
+            return 0
+        state = self._state(endpoint)
+        with state.lock:
+            now = time.monotonic()
+            slot = max(now, state.next_slot)
+            state.next_slot = slot + 1 / self.rate
+            return slot - now
+
+    def update(self, endpoint: str, headers: Mapping[str, str], latency: float, throttled: bool = False, error: bool = False):
+        '''Record a response: its rate limit headers, latency and outcome'''
+        state = self._state(endpoint)
+        with state.lock:
+            state.calls += 1
+            state.total_latency += latency
+            state.max_latency = max(state.max_latency, latency)
+            state.throttled += throttled
+            state.errors += error
+            try:
+                if 'x-ratelimit-remaining' in headers:
+                    state.remaining = int(headers['x-ratelimit-remaining'])
+                if 'x-ratelimit-reset' in headers:
+                    state.reset = float(headers['x-ratelimit-reset'])
+            except ValueError:
+                logger.debug(f'Unreadable rate limit headers on {endpoint}: {dict(headers)}')
+            if throttled:
+                state.remaining = 0
+                if state.reset <= time.time():
+                    state.reset = time.time() + self.base_delay
+
+    def backoff(self, attempt: int, base_delay: Optional[float] = None) -> float:
+        '''Exponential backoff with full jitter, bounded by max_delay'''
+        delay = min(self.max_delay, (base_delay or self.base_delay) * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def stats(self) -> Dict[str, dict]:
+        result = {}
+        for endpoint, state in list(self._endpoints.items()):
+            result[endpoint] = {
+                'calls': state.calls,
+                'throttled': state.throttled,
+                'errors': state.errors,
+                'mean_latency': state.total_latency / state.calls if state.calls else 0,
+                'max_latency': state.max_latency,
+            }
+        return result
+
+    def _state(self, endpoint: str) -> EndpointState:
+        with self._lock:
+            if endpoint not in self._endpoints:
+                self._endpoints[endpoint] = EndpointState()
+            return self._endpoints[endpoint]
@@ -1,32 +1,99 @@
 import requests
 import json
-import sys
 import time
 import logging
-from dataclasses import dataclass
-from typing import Union, Dict, List, Any, Optional, TYPE_CHECKING
+import threading
+from urllib.parse import urlparse
+from dataclasses import dataclass, field
+from typing import Union, Dict, List, Any, Optional, Set, ClassVar, Iterator, TYPE_CHECKING
 from datetime import datetime
 import datetime as dt
+from pymongo import UpdateOne, ASCENDING
+from pymongo.errors import OperationFailure
 
 from mylibs.decorators import timing
+from mylibs.rateLimiter import RateLimiter
+from mylibs.transport import get_session
 
 if TYPE_CHECKING:
     from pymongo import MongoClient
+    from pymongo.collection import Collection
 
 
 logger = logging.getLogger("myapp")
 
 
+class Trading212Error(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+class Trading212AuthError(Trading212Error):
+    pass
+
+class Trading212RateLimitError(Trading212Error):
+    pass
+
+
+class InstrumentCatalog():
+    '''
+    In-process cache of the instruments collection, indexed by t212_id, ticker and isin.
+    The whole catalog is reloaded from mongo once older than `ttl` seconds or after an update. Cached documents are shared, do not mutate them.
+    '''
+    keys = ('t212_id', 'ticker', 'isin')
+
+    def __init__(self, ttl: float = 3600):
+        self.ttl = ttl
+        self._indexes: Dict[str, Dict[str, List[dict]]] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def lookup(self, collection: 'Collection', key: str, values: List[str]) -> Optional[Dict[str, List[dict]]]:
+        '''Instruments matching each value, or None when `key` is not indexed in the catalog'''
+        if key not in self.keys:
+            return None
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+                self._load(collection)
+            index = self._indexes[key]
+        return {value: index[value] for value in values if value in index}
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def _load(self, collection: 'Collection'):
+        start = time.monotonic()
+        self._indexes = {key: {} for key in self.keys}
+        for instrument in collection.find({}):
+            for key in self.keys:
+                value = instrument.get(key)
+                if value is not None:
+                    self._indexes[key].setdefault(value, []).append(instrument)
+        self._loaded_at = time.monotonic()
+        logger.info(f"Instrument catalog loaded: {len(self._indexes['t212_id'])} instruments in {self._loaded_at - start:.3f}s")
+
+
+@dataclass()
+class OrderPage:
+    number: int
+    orders: List[dict] # kept orders of the page, newest first
+    cursor: Optional[int] # cursor of the next page, None when paging is over
+
 @dataclass()
 class Trading212:
     t212_key: str
     mongo_client: 'Optional[MongoClient]' = None
+    catalog: ClassVar[InstrumentCatalog] = InstrumentCatalog() # shared by every client of the process
+    last_cursor: Optional[int] = field(default=None, init=False) # cursor left by get_orders when it stopped on max_pages
        
     def get_positions(self, t212_id: Optional[str] = None) -> json:
         url = "https://live.trading212.com/api/v0/equity/portfolio"
+        route = None
         if t212_id is not None:
+            route = urlparse(url).path + '/{ticker}'
             url += "/" + t212_id
-        data = Trading212._handle_request(url=url, api_key=self.t212_key)
+        data = Trading212._handle_request(url=url, api_key=self.t212_key, route=route)
         data = Trading212._change_semantic(data)
         return data
 
@@ -48,58 +115,65 @@ class Trading212:
         if not isinstance(search_values, list):
             search_values = [search_values]
 
-        query = {search_key: {'$in': search_values}}
-        instruments = list(self.mongo_client.brokers.t212_instruments.find(query))
+        instruments_pt = self.mongo_client.brokers.t212_instruments
+        matches = Trading212.catalog.lookup(instruments_pt, search_key, search_values)
+        if matches is None: # key not indexed in the catalog
+            matches = {}
+            for instrument in instruments_pt.find({search_key: {'$in': search_values}}):
+                matches.setdefault(instrument.get(search_key), []).append(instrument)
+
         return_data = []
         missing_values = []
-
         for value in search_values:
-            found = False
-            for instrument in instruments:
-                if instrument.get(search_key) == value:
-                    return_data.append(instrument)
-                    found = True
-            if not found:
+            if value in matches:
+                return_data.extend(matches[value])
+            else:
                 missing_values.append(value)
         if missing_values:
             if update:
                 logger.info(f'Values {missing_values} not found, updating instruments table.')
                 self.update_instruments()
-                for value in missing_values:
-                    result = self.get_instruments({search_key: value}, update=False)
-                    if result:
-                        return_data.extend(result)
+                return_data.extend(self.get_instruments({search_key: missing_values}, update=False))
             else:
                 for value in missing_values:
                     logger.warning(f'{value} does not exist.')
 
         return return_data    
 
-    @timing()
-    def get_orders(self, from_date: Optional[datetime] = None, chunk_size: int = 50, filter_func: Optional[callable] = None) -> list:
+    def iter_orders(self, from_date: Optional[datetime] = None, chunk_size: int = 50, filter_func: Optional[callable] = None,
+                    known_ids: Optional[Set[int]] = None, cursor: Optional[int] = None,
+                    max_pages: Optional[int] = None) -> Iterator[OrderPage]:
+        """
+        Page through the history of orders, newest first, yielding each page as soon as it is fetched:
+        the kept orders of the page, already renamed like the instruments (t212_id, ticker), and the cursor to resume after it.
+        Only one page is held at a time. Arguments are those of `get_orders`.
+        """
         url = "https://live.trading212.com/api/v0/equity/history/orders"
         query = {
         "limit": chunk_size,
-        "cursor": None,
+        "cursor": cursor,
         }
         page_nb = 0
-        orders = []
-        looper = True
 
-        logger.info(f'Starting get_orders with params from_date: {from_date}; chunk_size: {chunk_size}; filter_func: {filter_func}')
-        while looper:
+        logger.info(f'Starting iter_orders with params from_date: {from_date}; chunk_size: {chunk_size}; filter_func: {filter_func}; cursor: {cursor}')
+        while max_pages is None or page_nb < max_pages:
             data = Trading212._handle_request(url=url, api_key=self.t212_key, params=query, delay_btw_calls=4)
             items = data['items']
             if not items:
-                break
-        
+                return
+
             page_nb += 1
             next_cursor_dt = datetime.strptime(items[-1]['dateModified'], '%Y-%m-%dT%H:%M:%S.%fZ')
             next_cursor_ts = int(next_cursor_dt.timestamp()*1000)
             query['cursor'] = next_cursor_ts
             logger.info(f"Page {page_nb:03} - Next cursor at: {next_cursor_ts} - {datetime.fromtimestamp(next_cursor_ts/1000, dt.UTC).strftime('%Y-%m-%dT%H:%M:%S.%fZ')}")
 
+            orders = []
+            looper = len(items) == chunk_size # a shorter page is the last one
             for order in items: # Issues in later operations may arise for none-executed orders that may be modified
+                if known_ids and order['id'] in known_ids: # older orders are already stored
+                    looper = False
+                    break
                 if from_date:
                     date = datetime.strptime(order['dateCreated'], '%Y-%m-%dT%H:%M:%S.%fZ')
                     if date < from_date:
@@ -108,10 +182,36 @@ class Trading212:
                 if filter_func and not filter_func(order):
                     continue
                 orders.append(order)
+            yield OrderPage(page_nb, self._change_semantic(orders), next_cursor_ts if looper else None)
+            if not looper:
+                return
 
+    @timing()
+    def get_orders(self, from_date: Optional[datetime] = None, chunk_size: int = 50, filter_func: Optional[callable] = None,
+                   known_ids: Optional[Set[int]] = None, cursor: Optional[int] = None, max_pages: Optional[int] = None,
+                   on_page: Optional[callable] = None) -> list:
+        """
+        Fetch the history of orders, newest first, in one list (see `iter_orders` to process it page by page).
 
-        orders = self._change_semantic(orders)
-        logger.info(f'Nb transactions fetched: {len(orders)}')
+        Args:
+            from_date (datetime): Orders created before this date are ignored.
+            chunk_size (int): Number of orders per page.
+            filter_func (callable): Orders for which it returns False are ignored.
+            known_ids (set): Ids of the orders already stored. Paging stops at the first known order.
+            cursor (int): Timestamp (ms) to start paging from, to resume an unfinished sync.
+            max_pages (int): Maximum number of pages fetched. When reached, the next cursor is kept in `last_cursor`.
+            on_page (callable): Called after each page with the page number and the number of orders kept so far.
+        """
+        orders = []
+        self.last_cursor = None
+        page = None
+        for page in self.iter_orders(from_date, chunk_size, filter_func, known_ids, cursor, max_pages):
+            orders.extend(page.orders)
+            if on_page:
+                on_page(page.number, len(orders))
+        if page is not None and max_pages is not None and page.number >= max_pages:
+            self.last_cursor = page.cursor
+        logger.info(f'Nb transactions fetched: {len(orders)} in {page.number if page else 0} pages')
         return orders
     
     def get_open_orders(self, id: Optional[str] = None) -> json:
@@ -122,9 +222,11 @@ class Trading212:
         id (str | None): Specific order ID to fetch. Fetches all orders if None.
         '''
         url = 'https://live.trading212.com/api/v0/equity/orders'
+        route = None
         if id is not None:
+            route = urlparse(url).path + '/{id}'
             url += "/" + id
-        return Trading212._handle_request(url=url, api_key=self.t212_key) 
+        return Trading212._handle_request(url=url, api_key=self.t212_key, route=route)
         
     def get_account_stats(self) ->json:
         url = "https://live.trading212.com/api/v0/equity/account/cash"
@@ -143,31 +245,81 @@ class Trading212:
         
         # init mongo client
         instruments_pt = self.mongo_client.brokers.t212_instruments
+        Trading212._ensure_indexes(instruments_pt)
 
-        instruments_id = [ins['t212_id'] for ins in instruments]
-        mongo_ins = instruments_pt.find({'t212_id': {'$in': instruments_id}})
-        mong_ins_id = [ins['t212_id'] for ins in mongo_ins]
-        new_ins = [instrument for instrument in instruments if instrument['t212_id'] not in mong_ins_id]
-        if new_ins:
-            instruments_pt.insert_many(new_ins)
+        # upsert the new and changed instruments only
+        stored = {ins['t212_id']: ins for ins in instruments_pt.find({}, {'_id': 0})}
+        new_ins = [ins for ins in instruments if ins['t212_id'] not in stored]
+        changed_ins = [ins for ins in instruments if ins['t212_id'] in stored and stored[ins['t212_id']] != ins]
+        operations = [UpdateOne({'t212_id': ins['t212_id']}, {'$set': ins}, upsert=True) for ins in new_ins + changed_ins]
+        if operations:
+            instruments_pt.bulk_write(operations, ordered=False)
+            Trading212.catalog.invalidate()
+        logger.info(f'Instruments updated: {len(new_ins)} new, {len(changed_ins)} changed')
         return new_ins
+
+    @staticmethod
+    def _ensure_indexes(instruments_pt: 'Collection'):
+        try:
+            instruments_pt.create_index([('t212_id', ASCENDING)], unique=True)
+        except OperationFailure as e:
+            logger.warning(f'Unique index on t212_id not created: {e}')
+        instruments_pt.create_index([('ticker', ASCENDING)])
+        instruments_pt.create_index([('isin', ASCENDING)])
     
+    def api_stats(self) -> Dict[str, dict]:
+        '''Per endpoint calls, throttles, errors and latencies of the requests made with this key'''
+        return RateLimiter.for_key(self.t212_key).stats()
+
     @staticmethod
-    def _handle_request(url: str, api_key: str, headers: Optional[dict] = None, params: Optional[dict] = None, delay_btw_calls: float = 2) -> json:
+    def _handle_request(url: str, api_key: str, headers: Optional[dict] = None, params: Optional[dict] = None, 
+                        delay_btw_calls: float = 2, max_retries: int = 5, timeout: float = 30, route: Optional[str] = None) -> json:
+        '''
+        GET an endpoint through the rate limiter shared by every call made with `api_key`.
+        Budgets and stats are kept per `route` template (e.g. '/api/v0/equity/orders/{id}'), the url path by default.
+
+        Throttled (429), server side (5xx) and network errors are retried with a jittered exponential backoff
+        starting at `delay_btw_calls`, up to `max_retries` times. Other errors raise a Trading212Error.
+        '''
         full_headers = {"Authorization": api_key}
         if headers is not None:
             full_headers.update(headers)
-        response = requests.get(url, headers=full_headers, params=params)
-        match response.status_code:
-            case 200:
-                return response.json()
-            case 429:
-                time.sleep(delay_btw_calls)
-                new = Trading212._handle_request(url=url, api_key=api_key, headers=headers, params=params)
-                return new
-            case _:
-                logger.error(f"Error: {response.status_code} while fetching data")
-                sys.exit()
+        limiter = RateLimiter.for_key(api_key)
+        endpoint = route or urlparse(url).path
+
+        for attempt in range(max_retries + 1):
+            limiter.acquire(endpoint)
+            start = time.monotonic()
+            try:
+                response = get_session().get(url, headers=full_headers, params=params, timeout=timeout)
+            except requests.RequestException as e:
+                limiter.update(endpoint, {}, time.monotonic() - start, error=True)
+                logger.warning(f"Request to {endpoint} failed (attempt {attempt + 1}): {e}")
+                if attempt == max_retries:
+                    raise Trading212Error(f"Error while fetching {endpoint}: {e}")
+                time.sleep(limiter.backoff(attempt, delay_btw_calls))
+                continue
+
+            status_code = response.status_code
+            limiter.update(endpoint, response.headers, time.monotonic() - start, throttled=status_code == 429, error=status_code >= 500)
+            match status_code:
+                case 200:
+                    return response.json()
+                case 429:
+                    logger.info(f"Rate limited on {endpoint} (attempt {attempt + 1})")
+                    if 'x-ratelimit-reset' not in response.headers:
+                        time.sleep(limiter.backoff(attempt, delay_btw_calls))
+                case 500 | 502 | 503 | 504:
+                    logger.warning(f"Error: {status_code} while fetching {endpoint} (attempt {attempt + 1})")
+                    time.sleep(limiter.backoff(attempt, delay_btw_calls))
+                case 401 | 403:
+                    raise Trading212AuthError(f"Error: {status_code} while fetching {endpoint}, check the api key", status_code)
+                case _:
+                    raise Trading212Error(f"Error: {status_code} while fetching {endpoint}", status_code)
+
+        if status_code == 429:
+            raise Trading212RateLimitError(f"Still rate limited on {endpoint} after {max_retries} retries", status_code)
+        raise Trading212Error(f"Error: {status_code} while fetching {endpoint} after {max_retries} retries", status_code)
     
     @staticmethod
     def _change_semantic(data: list) -> list: # Changement of semantic to avoid confusion in latter operations
@@ -180,7 +332,7 @@ class Trading212:
                 del el['maxOpenQuantity']
                 del el['addedOn']
             except KeyError as e:
-                logger.debug(f"Fail to get key {e} for object {el.get("t212_id", el.get("ticker", None))}")
+                logger.debug(f"Fail to get key {e} for object {el.get('t212_id', el.get('ticker', None))}")
                 continue
             except Exception as e:
                 logger.error(e)
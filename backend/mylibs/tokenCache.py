@@ -0,0 +1,65 @@
+import time
+import threading
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+from bson import ObjectId
+
+logger = logging.getLogger("myapp")
+
+
+@dataclass
+class CachedToken():
+    user_id: ObjectId
+    expiration: datetime # session expiration, as stored in `users.tokens`
+    cached_at: float # monotonic time of the database read
+
+
+class TokenCache():
+    '''
+    In-process cache of validated session tokens, bounded in size (least recently used tokens evicted first).
+
+    An entry is trusted for `ttl` seconds after its database read: a token revoked or rotated by another worker
+    is still accepted here for at most `ttl` seconds.
+    '''
+    def __init__(self, maxsize: int = 10000, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._tokens: 'OrderedDict[str, CachedToken]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> Optional[CachedToken]:
+        with self._lock:
+            entry = self._tokens.get(token)
+            if entry is None or time.monotonic() - entry.cached_at > self.ttl:
+                if entry is not None:
+                    del self._tokens[token]
+                self.misses += 1
+                return None
+            self._tokens.move_to_end(token)
+            self.hits += 1
+            return entry
+
+    def put(self, token: str, user_id: ObjectId, expiration: datetime) -> CachedToken:
+        entry = CachedToken(user_id, expiration, time.monotonic())
+        with self._lock:
+            self._tokens[token] = entry
+            self._tokens.move_to_end(token)
+            while len(self._tokens) > self.maxsize:
+                self._tokens.popitem(last=False)
+        return entry
+
+    def invalidate(self, token: str):
+        with self._lock:
+            self._tokens.pop(token, None)
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+    def __len__(self) -> int:
+        return len(self._tokens)
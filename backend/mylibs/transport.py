@@ -0,0 +1,71 @@
+import asyncio
+import threading
+import weakref
+import importlib.util
+import requests
+import httpx
+from requests.adapters import HTTPAdapter
+from typing import Optional, Tuple, Union
+
+DEFAULT_TIMEOUT: Tuple[float, float] = (5, 30) # (connect, read) seconds
+POOL_CONNECTIONS = 10 # number of hosts kept in the pool
+POOL_MAXSIZE = 20 # keep-alive connections kept per host
+HTTP2 = importlib.util.find_spec('h2') is not None # async clients negotiate HTTP/2 when the h2 package is installed
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    '''HTTPAdapter applying a default timeout to the requests sent without one'''
+    def __init__(self, *args, timeout: Union[float, Tuple[float, float]] = DEFAULT_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+_local = threading.local()
+
+def get_session(timeout: Optional[Union[float, Tuple[float, float]]] = None) -> requests.Session:
+    '''
+    Return the pooled session of the current thread.
+
+    Connections are kept alive per host, so successive calls to the same api reuse the TCP+TLS connection.
+    Sessions are per thread as requests.Session is not guaranteed to be thread safe; worker threads keep theirs between tasks.
+    '''
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = TimeoutHTTPAdapter(timeout=timeout or DEFAULT_TIMEOUT, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _local.session = session
+    return session
+
+def close_session():
+    '''Close the pooled connections of the current thread'''
+    session = getattr(_local, 'session', None)
+    if session is not None:
+        session.close()
+        _local.session = None
+
+
+_async_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]' = weakref.WeakKeyDictionary()
+
+def get_async_client() -> httpx.AsyncClient:
+    '''
+    Return the pooled async client of the running event loop.
+
+    Connections are kept alive per host and HTTP/2 is used when available, so concurrent calls to a host share one connection.
+    '''
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        connect, read = DEFAULT_TIMEOUT
+        client = httpx.AsyncClient(
+            http2=HTTP2,
+            timeout=httpx.Timeout(read, connect=connect),
+            limits=httpx.Limits(max_connections=POOL_CONNECTIONS * POOL_MAXSIZE, max_keepalive_connections=POOL_MAXSIZE))
+        _async_clients[loop] = client
+    return client
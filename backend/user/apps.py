@@ -4,3 +4,12 @@ from django.apps import AppConfig
 class UserConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'user'
+
+    def ready(self):
+        from django.conf import settings
+        from classes.users import User
+        from mylibs.passwordHasher import PasswordHasher
+
+        User.hasher = PasswordHasher(
+            rounds=getattr(settings, 'PASSWORD_HASH_ROUNDS', 12),
+            max_workers=getattr(settings, 'PASSWORD_HASH_WORKERS', None))
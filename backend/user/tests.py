@@ -1,3 +1,122 @@
-from django.test import TestCase
+import threading
+import time
+from datetime import datetime
+from unittest import mock
+
+import bcrypt
+import mongomock
+from bson import ObjectId
+from django.test import SimpleTestCase
+from django.urls import include, path, re_path
+from pymongo.errors import PyMongoError
+
+from classes.users import User, UserError
+from master.middlewares.AuthRequiredMiddleware import RouteIndex
+from mylibs.passwordHasher import PasswordHasher, PasswordHasherBusyError
+from mylibs.tokenCache import TokenCache
 
 # Create your tests here.
+
+view = lambda request: None
+
+
+class TokenCacheTests(SimpleTestCase):
+    def test_entries_expire_after_ttl(self):
+        cache = TokenCache(ttl=0.05)
+        user_id = ObjectId()
+        cache.put('token', user_id, datetime(2030, 1, 1))
+        self.assertEqual(cache.get('token').user_id, user_id)
+        time.sleep(0.06)
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_evicted(self):
+        cache = TokenCache(maxsize=2)
+        for token in ('a', 'b'):
+            cache.put(token, ObjectId(), datetime(2030, 1, 1))
+        cache.get('a')
+        cache.put('c', ObjectId(), datetime(2030, 1, 1))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('a'))
+
+
+class RouteIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.routes = RouteIndex([
+            path('', view),
+            path('login/', include([path('', view), path('reset/<str:token>/', view)])),
+            path('api/', include([path('portfolio/', view), path('portfolio/<int:index>/value/', view)])),
+            re_path(r'^legacy/(?P<year>[0-9]{4})/$', view),
+            path('<slug:page>/', view),
+        ])
+
+    def test_resolvable(self):
+        for url in ('/', '/api/portfolio/', '/api/portfolio/3/value/', '/legacy/2021/', '/about/'):
+            self.assertTrue(self.routes.resolvable(url), url)
+        for url in ('/api/portfolio/x/value/', '/legacy/21/', '/api/unknown/path/', '/favicon.ico'):
+            self.assertFalse(self.routes.resolvable(url), url)
+        self.assertIn('/api/portfolio/', self.routes.static)
+
+    def test_public_prefixes(self):
+        self.assertTrue(self.routes.is_public('/login'))
+        self.assertTrue(self.routes.is_public('/login/reset/abc/'))
+        self.assertFalse(self.routes.is_public('/loginx/'))
+        self.assertFalse(self.routes.is_public('/api/portfolio/'))
+
+
+class PasswordHasherTests(SimpleTestCase):
+    def test_hash_verify_and_rehash(self):
+        hasher = PasswordHasher(rounds=4, max_workers=2)
+        hashed = hasher.hash('password')
+        self.assertTrue(hasher.verify('password', hashed))
+        self.assertFalse(hasher.verify('wrong', hashed))
+        self.assertFalse(hasher.needs_rehash(hashed))
+        self.assertTrue(PasswordHasher(rounds=5).needs_rehash(hashed))
+        self.assertTrue(hasher.needs_rehash(b'not a bcrypt hash'))
+
+    def test_busy_when_the_pool_is_saturated(self):
+        hasher = PasswordHasher(rounds=4, max_workers=1, max_pending=1, wait_timeout=0.05)
+        release = threading.Event()
+        with mock.patch.object(PasswordHasher, '_hash', lambda self, password: release.wait(5)):
+            threading.Thread(target=hasher.hash, args=('password',)).start()
+            time.sleep(0.05)
+            with self.assertRaises(PasswordHasherBusyError):
+                hasher.hash('password')
+            release.set()
+
+
+class UserLoginTests(SimpleTestCase):
+    def setUp(self):
+        self.mongo_client = mongomock.MongoClient()
+        self.user_id = ObjectId()
+        self.old_hash = bcrypt.hashpw(b'password', bcrypt.gensalt(rounds=4))
+        self.mongo_client.users.users.insert_one({'_id': self.user_id, 'email': 'user@example.com', 'password_hash': self.old_hash})
+        patch = mock.patch.object(User, 'hasher', PasswordHasher(rounds=5, max_workers=1))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def login(self, password: str = 'password') -> User:
+        user = User(email='user@example.com', password=password, mongo_client=self.mongo_client)
+        user.connect_user()
+        return user
+
+    def stored_hash(self) -> bytes:
+        return self.mongo_client.users.users.find_one({'_id': self.user_id})['password_hash']
+
+    def test_login_rehashes_with_the_new_work_factor(self):
+        self.assertEqual(self.login()._id, self.user_id)
+        self.assertFalse(User.hasher.needs_rehash(self.stored_hash()))
+        with self.assertRaises(UserError):
+            self.login('wrong')
+
+    def test_rehash_failure_does_not_fail_the_login(self):
+        with mock.patch.object(self.mongo_client.users.users, 'update_one', side_effect=PyMongoError('primary stepped down')):
+            with self.assertLogs(level='WARNING'):
+                self.assertEqual(self.login()._id, self.user_id)
+        with mock.patch.object(PasswordHasher, 'hash', side_effect=PasswordHasherBusyError('saturated')):
+            with self.assertLogs(level='WARNING'):
+                self.login()
+        self.assertEqual(self.stored_hash(), self.old_hash)